@@ -0,0 +1,517 @@
+from openai.types.chat import ChatCompletion
+from typing import Dict, Iterable, List, Optional
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+
+from clustering import DEFAULT_CLUSTER_THRESHOLD, attach_member, cluster_conversations
+from gpt_helpers import parse_ranking, ranking_request
+from integration_context import IntegrationContext
+from issue_cache import ISSUE_CACHE_PATH, IssueCache
+from issue_index import EMBEDDERS, ISSUE_INDEX_PATH, IssueIndex, make_embedder
+from main import (
+    DEFAULT_TOP_K,
+    apply_decision,
+    known_duplicate,
+    prefiltered,
+    prepare_conversation,
+    remember_outcome,
+)
+
+BACKFILL_STATE_PATH = ".cache/backfill.db"
+# The Batch API accepts at most 50,000 requests per batch
+DEFAULT_MAX_BATCH_REQUESTS = 50_000
+DEFAULT_POLL_INTERVAL = 60.0
+COMPLETION_WINDOW = "24h"
+# Requests that keep failing (e.g. because they're invalid) are given up on after this
+MAX_SUBMISSIONS = 3
+# Batches in these states won't make any more progress
+_FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+# The Batch API is outside the live rate limits, so we let the client retry it
+_BATCH_CLIENT_RETRIES = 5
+
+
+class Backfill:
+    """Categorizes a corpus of conversations through the OpenAI Batch API, which
+    costs half as much as live completions and has its own rate limits.
+
+    A backfill runs in four resumable steps, each recorded in a SQLite file at
+    `state_path`: prepare (shortlist candidates and build each ranking request),
+    submit (upload the requests as JSONL batches), wait (poll until every batch has
+    finished and collect its results), and apply (carry out each decision in
+    Linear, in corpus order). Running it again with the same corpus and state file
+    picks up wherever the previous run stopped.
+
+    Candidates are read from the context's issue cache, so preparing lists the
+    backlog once rather than once per conversation. Conversations are ranked
+    against the backlog as it was when they were prepared, so two conversations in
+    one backfill can both decide to create the same task. Give the context a
+    DedupIndex to attribute such repeats to the first one's task when they're
+    applied. With a `cluster_threshold`, the corpus is clustered first
+    (see clustering.py) and only one representative per cluster gets a request; the
+    other members are filed like their representative when it's applied.
+    """
+
+    def __init__(
+        self,
+        ctx: IntegrationContext,
+        state_path: str = BACKFILL_STATE_PATH,
+        top_k: int = DEFAULT_TOP_K,
+        max_batch_requests: int = DEFAULT_MAX_BATCH_REQUESTS,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        cluster_threshold: Optional[float] = None,
+        embedder=None,
+    ):
+        self.ctx = ctx
+        self.cluster_threshold = cluster_threshold
+        self.embedder = embedder
+        self.top_k = top_k
+        self.max_batch_requests = max_batch_requests
+        self.poll_interval = poll_interval
+        if os.path.dirname(state_path):
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        self._db = sqlite3.connect(state_path)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS requests (
+                position INTEGER PRIMARY KEY,
+                conversation TEXT NOT NULL,
+                prompt_conversation TEXT,
+                candidates TEXT,
+                tokens_saved INTEGER NOT NULL DEFAULT 0,
+                request TEXT,
+                submissions INTEGER NOT NULL DEFAULT 0,
+                batch_id TEXT,
+                response TEXT,
+                outcome TEXT,
+                representative INTEGER,
+                similarity REAL,
+                record_key TEXT DEFAULT (lower(hex(randomblob(16)))),
+                file_id TEXT
+            );
+            CREATE TABLE IF NOT EXISTS batches (
+                batch_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL
+            );
+            """
+        )
+        # State files from before clustering lack its columns
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(requests)")}
+        for column, column_type in (
+            ("representative", "INTEGER"),
+            ("similarity", "REAL"),
+            ("file_id", "TEXT"),
+        ):
+            if column not in columns:
+                self._db.execute(
+                    f"ALTER TABLE requests ADD COLUMN {column} {column_type}"
+                )
+        # Identifies each conversation's record, so a task it creates keeps the same
+        # ID when the apply step is retried (see idempotent_issue_id)
+        if "record_key" not in columns:
+            with self._db:
+                self._db.execute("ALTER TABLE requests ADD COLUMN record_key TEXT")
+                self._db.execute(
+                    "UPDATE requests SET record_key = lower(hex(randomblob(16)))"
+                )
+
+    def close(self) -> None:
+        self._db.close()
+
+    async def run(self, conversations: Iterable[str]) -> List[Dict]:
+        await self.prepare(conversations)
+        await self.submit()
+        await self.wait()
+        return await self.apply()
+
+    async def prepare(self, conversations: Iterable[str]) -> None:
+        """Builds the ranking request for every conversation not prepared yet.
+        Conversations the context's DedupIndex already knows, or its PreClassifier
+        drops, are applied right away, without a request"""
+        conversations = list(conversations)
+        representatives = similarities = None
+        if self.cluster_threshold is not None:
+            representatives, similarities = await asyncio.to_thread(
+                cluster_conversations,
+                conversations,
+                self.embedder,
+                self.cluster_threshold,
+            )
+        for position, conversation in enumerate(conversations):
+            row = self._db.execute(
+                "SELECT conversation FROM requests WHERE position = ?", (position,)
+            ).fetchone()
+            if row is not None:
+                if row[0] != conversation:
+                    raise ValueError(
+                        f"Conversation {position} differs from the one in the backfill state, so the corpus has changed since it was prepared"
+                    )
+                continue
+
+            outcome = await known_duplicate(conversation, self.ctx)
+            if outcome is None:
+                dropped = prefiltered(conversation, self.ctx)
+                if dropped is not None:
+                    outcome = remember_outcome(self.ctx, conversation, dropped)
+            if outcome is not None:
+                with self._db:
+                    self._db.execute(
+                        "INSERT INTO requests (position, conversation, outcome) VALUES (?, ?, ?)",
+                        (position, conversation, json.dumps(outcome)),
+                    )
+                continue
+            if representatives is not None and representatives[position] != position:
+                # Filed like its representative once that has been applied
+                with self._db:
+                    self._db.execute(
+                        """
+                        INSERT INTO requests (
+                            position, conversation, representative, similarity
+                        ) VALUES (?, ?, ?, ?)
+                        """,
+                        (
+                            position,
+                            conversation,
+                            representatives[position],
+                            similarities[position],
+                        ),
+                    )
+                continue
+
+            prompt_conversation, issues, tokens_saved = await prepare_conversation(
+                conversation, self.ctx, self.top_k
+            )
+            # Applying a decision only needs each candidate's ID and title
+            candidates = [{"id": i["id"], "title": i["title"]} for i in issues]
+            with self._db:
+                self._db.execute(
+                    """
+                    INSERT INTO requests (
+                        position, conversation, prompt_conversation, candidates,
+                        tokens_saved, request
+                    ) VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        position,
+                        conversation,
+                        prompt_conversation,
+                        json.dumps(candidates),
+                        tokens_saved,
+                        json.dumps(ranking_request(prompt_conversation, issues)),
+                    ),
+                )
+
+    async def submit(self) -> List[str]:
+        """Uploads every request that isn't in a batch yet, returning the new
+        batch IDs. Each uploaded file is recorded before its batch is created, so
+        if a run stops in between, the next one looks for that file's batch
+        before creating another"""
+        batch_ids = []
+        for (file_id,) in self._db.execute(
+            """
+            SELECT DISTINCT file_id FROM requests
+            WHERE file_id IS NOT NULL AND batch_id IS NULL AND response IS NULL
+                AND outcome IS NULL
+            """
+        ).fetchall():
+            batch = await self._existing_batch(file_id)
+            batch_ids.append(await self._create_batch(file_id, batch))
+        while True:
+            rows = self._db.execute(
+                """
+                SELECT position, request FROM requests
+                WHERE request IS NOT NULL AND file_id IS NULL AND batch_id IS NULL
+                    AND response IS NULL AND outcome IS NULL AND submissions < ?
+                ORDER BY position LIMIT ?
+                """,
+                (MAX_SUBMISSIONS, self.max_batch_requests),
+            ).fetchall()
+            if not rows:
+                return batch_ids
+            lines = [
+                json.dumps(
+                    {
+                        "custom_id": str(position),
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": json.loads(request),
+                    }
+                )
+                for position, request in rows
+            ]
+            batch_file = await self._client().files.create(
+                file=("backfill.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch",
+            )
+            with self._db:
+                self._db.executemany(
+                    "UPDATE requests SET file_id = ? WHERE position = ?",
+                    [(batch_file.id, position) for position, _ in rows],
+                )
+            batch_ids.append(await self._create_batch(batch_file.id))
+
+    async def _existing_batch(self, file_id: str):
+        """The batch already created for an uploaded file, or None"""
+        client = self._client()
+        uploaded = await client.files.retrieve(file_id)
+        # Batches are listed newest first, and none can be older than its file
+        async for batch in client.batches.list(limit=100):
+            if batch.input_file_id == file_id:
+                return batch
+            if batch.created_at < uploaded.created_at:
+                return None
+        return None
+
+    async def _create_batch(self, file_id: str, batch=None) -> str:
+        if batch is None:
+            batch = await self._client().batches.create(
+                input_file_id=file_id,
+                endpoint="/v1/chat/completions",
+                completion_window=COMPLETION_WINDOW,
+            )
+        with self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO batches VALUES (?, ?)", (batch.id, batch.status)
+            )
+            count = self._db.execute(
+                """
+                UPDATE requests SET batch_id = ?, submissions = submissions + 1
+                WHERE file_id = ? AND batch_id IS NULL
+                """,
+                (batch.id, file_id),
+            ).rowcount
+        print(f"Submitted batch {batch.id} with {count} requests")
+        if batch.status in _FINISHED_STATUSES:
+            # An earlier run's batch may have finished in the meantime
+            await self._collect(batch)
+        return batch.id
+
+    async def wait(self) -> None:
+        """Polls every unfinished batch until it finishes, then stores its results.
+        Requests that a batch failed, or didn't get to before it expired, are
+        submitted again, up to MAX_SUBMISSIONS times"""
+        client = self._client()
+        while True:
+            unfinished = 0
+            for (batch_id,) in self._db.execute(
+                "SELECT batch_id FROM batches WHERE status NOT IN (?, ?, ?, ?)",
+                _FINISHED_STATUSES,
+            ).fetchall():
+                batch = await client.batches.retrieve(batch_id)
+                if batch.status not in _FINISHED_STATUSES:
+                    unfinished += 1
+                    continue
+                await self._collect(batch)
+                with self._db:
+                    self._db.execute(
+                        "UPDATE batches SET status = ? WHERE batch_id = ?",
+                        (batch.status, batch_id),
+                    )
+                print(f"Batch {batch_id} {batch.status}")
+            if unfinished:
+                await asyncio.sleep(self.poll_interval)
+            elif not await self.submit():
+                return
+
+    async def _collect(self, batch) -> None:
+        results = {}
+        if batch.output_file_id:
+            content = await self._client().files.content(batch.output_file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[int(result["custom_id"])] = json.dumps(response["body"])
+        with self._db:
+            self._db.executemany(
+                "UPDATE requests SET response = ? WHERE position = ?",
+                [(response, position) for position, response in results.items()],
+            )
+            # Anything without a result goes back into the queue for another batch
+            self._db.execute(
+                """
+                UPDATE requests SET batch_id = NULL, file_id = NULL
+                WHERE batch_id = ? AND response IS NULL
+                """,
+                (batch.id,),
+            )
+
+    async def apply(self) -> List[Dict]:
+        """Carries out the decision for every conversation that has a result but
+        hasn't been applied yet, and returns every outcome so far in corpus order"""
+        rows = self._db.execute(
+            """
+            SELECT position, conversation, candidates, tokens_saved, response,
+                record_key
+            FROM requests WHERE response IS NOT NULL AND outcome IS NULL
+            ORDER BY position
+            """
+        ).fetchall()
+        for position, conversation, candidates, tokens, response, key in rows:
+            try:
+                outcome = await self._apply_one(
+                    conversation,
+                    key,
+                    json.loads(candidates),
+                    tokens,
+                    ChatCompletion.model_validate_json(response),
+                )
+            except Exception as e:
+                # Leave it unapplied so the next run retries it
+                print(
+                    f"Failed to apply the decision for conversation {position}: {e!r}"
+                )
+                continue
+            self._store_outcome(position, outcome)
+        await self._apply_members()
+        return self.outcomes()
+
+    async def _apply_members(self) -> None:
+        rows = self._db.execute(
+            """
+            SELECT member.position, member.conversation, member.representative,
+                member.similarity, representative.outcome
+            FROM requests AS member
+            JOIN requests AS representative
+                ON representative.position = member.representative
+            WHERE member.outcome IS NULL AND representative.outcome IS NOT NULL
+            ORDER BY member.position
+            """
+        ).fetchall()
+        for position, conversation, representative, similarity, outcome in rows:
+            try:
+                outcome = await attach_member(
+                    self.ctx,
+                    conversation,
+                    representative,
+                    similarity,
+                    json.loads(outcome),
+                )
+            except Exception as e:
+                print(f"Failed to file conversation {position} with its cluster: {e!r}")
+                continue
+            self._store_outcome(position, outcome)
+
+    def _store_outcome(self, position: int, outcome: Dict) -> None:
+        with self._db:
+            self._db.execute(
+                "UPDATE requests SET outcome = ? WHERE position = ?",
+                (json.dumps(outcome), position),
+            )
+
+    async def _apply_one(
+        self,
+        conversation: str,
+        record_key: str,
+        candidates: List[Dict],
+        tokens_saved: int,
+        response: ChatCompletion,
+    ) -> Dict:
+        # An earlier conversation in this backfill may have created its task since
+        duplicate = await known_duplicate(conversation, self.ctx)
+        if duplicate is not None:
+            return duplicate
+        decision = parse_ranking(response, candidates)
+        outcome = await apply_decision(
+            self.ctx, conversation, candidates, decision, record_key
+        )
+        return remember_outcome(self.ctx, conversation, outcome, tokens_saved)
+
+    def outcomes(self) -> List[Optional[Dict]]:
+        """Outcome of each prepared conversation in corpus order, or None where the
+        decision hasn't been applied yet"""
+        return [
+            json.loads(outcome) if outcome is not None else None
+            for (outcome,) in self._db.execute(
+                "SELECT outcome FROM requests ORDER BY position"
+            )
+        ]
+
+    def _client(self):
+        return self.ctx.openai.with_options(max_retries=_BATCH_CLIENT_RETRIES)
+
+
+def _read_conversations(path: str) -> List[str]:
+    # One conversation per line, either as a JSON string or an object with a
+    # "conversation" field
+    conversations = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                conversations.append(
+                    record["conversation"] if isinstance(record, dict) else record
+                )
+    return conversations
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Categorize a corpus of conversations through the OpenAI Batch API"
+    )
+    parser.add_argument("corpus", help="JSONL file with one conversation per line")
+    parser.add_argument("--state", default=BACKFILL_STATE_PATH)
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K)
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument(
+        "--cluster",
+        type=float,
+        nargs="?",
+        const=DEFAULT_CLUSTER_THRESHOLD,
+        metavar="THRESHOLD",
+        help="Only send one representative per cluster of similar conversations",
+    )
+    parser.add_argument(
+        "--issue-cache", default=ISSUE_CACHE_PATH, help="SQLite file to cache issues in"
+    )
+    parser.add_argument(
+        "--no-issue-cache",
+        action="store_true",
+        help="List the whole backlog for every conversation instead",
+    )
+    parser.add_argument(
+        "--issue-index",
+        default=ISSUE_INDEX_PATH,
+        help="Directory of the index that shortlists --top-k candidate tasks",
+    )
+    parser.add_argument(
+        "--no-issue-index",
+        action="store_true",
+        help="Put every task in the backlog up for matching instead",
+    )
+    parser.add_argument("--embedder", choices=EMBEDDERS, default="hashing")
+    args = parser.parse_args()
+
+    ctx = IntegrationContext(
+        issue_cache=None if args.no_issue_cache else IssueCache(args.issue_cache),
+        issue_cache_path=None,
+    )
+    if not args.no_issue_index:
+        ctx.issue_index = IssueIndex(
+            args.issue_index, make_embedder(args.embedder, ctx)
+        )
+    async with ctx:
+        backfill = Backfill(
+            ctx,
+            args.state,
+            top_k=args.top_k,
+            poll_interval=args.poll_interval,
+            cluster_threshold=args.cluster,
+        )
+        try:
+            outcomes = await backfill.run(_read_conversations(args.corpus))
+        finally:
+            backfill.close()
+    actions = [outcome["action"] for outcome in outcomes if outcome is not None]
+    print(
+        f"Applied {len(actions)} of {len(outcomes)} conversations: "
+        + ", ".join(f"{actions.count(a)} {a}" for a in ("match", "create", "ignore"))
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,361 @@
+"""A local proxy that records the pipeline's OpenAI and Linear traffic to cassette
+files and replays it offline.
+
+Point IntegrationContext at the proxy with a conversation ID in the path
+(linear_url=f"{url}/{id}/graphql", openai_url=f"{url}/{id}/v1") so every call is
+accounted to its conversation. When recording, requests are forwarded upstream
+and successful responses are stored along with how long they took and the tokens
+they used. When replaying, they're answered from the cassette straight away, and
+the recorded time and tokens are accounted instead.
+
+Linear mutations are never forwarded: they're answered locally as if they had
+gone through, so the backlog stays as it was recorded and every conversation is
+categorized against the same snapshot.
+"""
+
+from aiohttp import ClientSession, web
+from graphql import OperationDefinitionNode, build_schema, graphql, parse
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from stub_servers import LINEAR_SCHEMA
+
+# Response headers passed on from upstream while recording, so the pipeline's
+# RateGovernor sees the real limits. Only the content type is stored
+_FORWARDED_HEADERS = ("retry-after", "retry-after-ms", "x-complexity")
+_FORWARDED_PREFIXES = ("x-ratelimit-",)
+# Request headers that belong to the connection to the proxy
+_HOP_HEADERS = ("host", "content-length", "accept-encoding", "connection")
+# Timestamp given to everything a dry-run mutation returns
+_DRY_RUN_TIMESTAMP = "2024-01-01T00:00:00.000Z"
+
+
+def request_key(service: str, path: str, body: bytes) -> str:
+    """Identifies a request by its service, path and body. JSON bodies are compared
+    with sorted keys, so key order doesn't matter"""
+    try:
+        canonical = json.dumps(json.loads(body), sort_keys=True)
+    except ValueError:
+        canonical = body.decode(errors="replace")
+    return hashlib.sha256(f"{service} {path} {canonical}".encode()).hexdigest()
+
+
+def completion_usage(body: str, content_type: str) -> Tuple[int, int]:
+    """Prompt and completion tokens of a chat completion, streamed or not"""
+    usage = None
+    if content_type.startswith("text/event-stream"):
+        for line in body.splitlines():
+            if line.startswith("data:") and line[5:].strip() != "[DONE]":
+                usage = json.loads(line[5:]).get("usage") or usage
+    else:
+        try:
+            usage = json.loads(body).get("usage")
+        except (ValueError, AttributeError):
+            usage = None
+    if not usage:
+        return 0, 0
+    return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+
+class Cassette:
+    """Recorded responses by request_key(), stored as one JSON line per exchange"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.exchanges: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        exchange = json.loads(line)
+                        self.exchanges[exchange["key"]] = exchange
+
+    def __len__(self) -> int:
+        return len(self.exchanges)
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.exchanges.get(key)
+
+    def put(self, exchange: Dict) -> None:
+        self.exchanges[exchange["key"]] = exchange
+
+    def mean_seconds(self, service: str) -> float:
+        seconds = [
+            exchange["seconds"]
+            for exchange in self.exchanges.values()
+            if exchange["service"] == service
+        ]
+        return sum(seconds) / len(seconds) if seconds else 0.0
+
+    def save(self) -> None:
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            for exchange in self.exchanges.values():
+                f.write(json.dumps(exchange) + "\n")
+        os.replace(temporary_path, self.path)
+
+
+class DryRunLinear:
+    """Answers Linear mutations as if they went through, without changing anything"""
+
+    def __init__(self):
+        self.schema = build_schema(LINEAR_SCHEMA)
+        self.root = {
+            "issueCreate": self._issue_create,
+            "issueUpdate": self._issue_update,
+            "commentCreate": self._comment_create,
+        }
+
+    @staticmethod
+    def is_mutation(body: Dict) -> bool:
+        try:
+            document = parse(body.get("query") or "")
+        except Exception:
+            return False
+        return any(
+            isinstance(definition, OperationDefinitionNode)
+            and definition.operation.value == "mutation"
+            for definition in document.definitions
+        )
+
+    @staticmethod
+    def _id(text: str) -> str:
+        # Deterministic, so a replay sends the same requests as the recording
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, text))
+
+    def _issue_create(self, info, input):
+        issue = {
+            "id": input.get("id") or self._id(input["title"]),
+            "title": input["title"],
+            "description": input.get("description"),
+            "updatedAt": _DRY_RUN_TIMESTAMP,
+            "archivedAt": None,
+        }
+        return {"success": True, "issue": issue}
+
+    def _issue_update(self, info, id, input):
+        issue = {
+            "id": id,
+            "title": input.get("title") or "",
+            "description": input.get("description"),
+            "updatedAt": _DRY_RUN_TIMESTAMP,
+            "archivedAt": None,
+        }
+        return {"success": True, "issue": issue}
+
+    def _comment_create(self, info, input):
+        comment = {
+            "id": input.get("id") or self._id(input["issueId"] + input["body"]),
+            **input,
+        }
+        return {"success": True, "comment": comment}
+
+    async def execute(self, body: Dict) -> Dict:
+        result = await graphql(
+            self.schema,
+            body["query"],
+            root_value=self.root,
+            variable_values=body.get("variables"),
+            operation_name=body.get("operationName"),
+        )
+        response = {"data": result.data}
+        if result.errors:
+            response["errors"] = [error.formatted for error in result.errors]
+        return response
+
+
+class CassetteProxy:
+    """Records to or replays from `cassette`. Recording forwards to `linear_url`
+    and `openai_url` (the real APIs, or the stub servers); with neither given, the
+    proxy replays, and answers requests missing from the cassette with a 404.
+
+    `usage` holds, per conversation ID, the calls made to each service, the tokens
+    and cost of its completions, and `seconds`: the recorded response times of its
+    calls added up, which is how long the conversation took when it was recorded.
+    Dry-run mutations are counted at the cassette's mean Linear response time. It's
+    worked out from the cassette as it is when read, so a recording and its
+    replays account every call the same way"""
+
+    def __init__(
+        self,
+        cassette: Cassette,
+        linear_url: Optional[str] = None,
+        openai_url: Optional[str] = None,
+        prices: Optional[Dict[str, Tuple[float, float]]] = None,
+    ):
+        self.cassette = cassette
+        self.linear_url = linear_url
+        self.openai_url = openai_url.rstrip("/") if openai_url else None
+        self.recording = linear_url is not None or openai_url is not None
+        self.prices = prices or {}
+        self.dry_run = DryRunLinear()
+        # Per conversation ID, the cassette key of each call it made, or None for
+        # a dry-run mutation
+        self._calls: Dict[str, List[Optional[str]]] = {}
+        self.misses = 0
+        self._session: Optional[ClientSession] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serves the proxy and returns its base URL"""
+        if self.recording:
+            self._session = ClientSession(auto_decompress=True)
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post("/{conversation}/graphql", self.handle_linear)
+        app.router.add_route("*", "/{conversation}/v1/{tail:.*}", self.handle_openai)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{bound_port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _account(self, conversation: str, key: Optional[str]) -> None:
+        self._calls.setdefault(conversation, []).append(key)
+
+    @property
+    def usage(self) -> Dict[str, Dict]:
+        # While recording, the Linear mean moves and a request two conversations
+        # sent at once can be stored twice, so nothing is added up until the end
+        dry_run = {"service": "linear", "seconds": self.cassette.mean_seconds("linear")}
+        usage = {}
+        for conversation, keys in self._calls.items():
+            totals = usage[conversation] = {
+                "linear_calls": 0,
+                "openai_calls": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cost_usd": 0.0,
+                "seconds": 0.0,
+            }
+            for key in keys:
+                exchange = self.cassette.get(key) if key is not None else dry_run
+                totals[f"{exchange['service']}_calls"] += 1
+                totals["seconds"] += exchange["seconds"]
+                prompt_tokens = exchange.get("prompt_tokens", 0)
+                completion_tokens = exchange.get("completion_tokens", 0)
+                totals["prompt_tokens"] += prompt_tokens
+                totals["completion_tokens"] += completion_tokens
+                prompt_price, completion_price = self.prices.get(
+                    exchange.get("model"), (0.0, 0.0)
+                )
+                totals["cost_usd"] += (
+                    prompt_tokens * prompt_price + completion_tokens * completion_price
+                ) / 1_000_000
+        return usage
+
+    async def handle_linear(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        conversation = request.match_info["conversation"]
+        payload = json.loads(body)
+        if self.dry_run.is_mutation(payload):
+            self._account(conversation, None)
+            return web.json_response(await self.dry_run.execute(payload))
+        return await self._exchange(request, conversation, "linear", "graphql", body)
+
+    async def handle_openai(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        path = request.match_info["tail"]
+        return await self._exchange(
+            request, request.match_info["conversation"], "openai", path, body
+        )
+
+    async def _exchange(
+        self,
+        request: web.Request,
+        conversation: str,
+        service: str,
+        path: str,
+        body: bytes,
+    ) -> web.Response:
+        key = request_key(service, f"{request.method} {path}", body)
+        exchange = self.cassette.get(key)
+        if exchange is not None:
+            self._account(conversation, key)
+            return web.Response(
+                status=exchange["status"],
+                body=exchange["body"].encode(),
+                content_type=exchange["content_type"],
+            )
+        if not self.recording:
+            self.misses += 1
+            return web.json_response(
+                {
+                    "error": {"message": "Not in the cassette", "type": "cassette"},
+                    "errors": [{"message": "Not in the cassette"}],
+                },
+                status=404,
+            )
+        return await self._record(request, conversation, service, path, body, key)
+
+    async def _record(
+        self,
+        request: web.Request,
+        conversation: str,
+        service: str,
+        path: str,
+        body: bytes,
+        key: str,
+    ) -> web.Response:
+        url = self.linear_url if service == "linear" else f"{self.openai_url}/{path}"
+        headers = {
+            name: value
+            for name, value in request.headers.items()
+            if name.lower() not in _HOP_HEADERS
+        }
+        started = time.perf_counter()
+        async with self._session.request(
+            request.method, url, data=body, headers=headers
+        ) as response:
+            data = await response.read()
+            seconds = time.perf_counter() - started
+            content_type = response.headers.get("content-type", "application/json")
+            forwarded = {
+                name: value
+                for name, value in response.headers.items()
+                if name.lower() in _FORWARDED_HEADERS
+                or name.lower().startswith(_FORWARDED_PREFIXES)
+            }
+            status = response.status
+        # Errors (rate limits, outages) are retried by the pipeline rather than
+        # recorded, so the cassette only holds answers
+        if status < 400:
+            exchange = {
+                "key": key,
+                "service": service,
+                "path": path,
+                "status": status,
+                "content_type": content_type.split(";")[0],
+                "body": data.decode(),
+                "seconds": round(seconds, 4),
+            }
+            if service == "openai":
+                try:
+                    exchange["model"] = json.loads(body).get("model")
+                except (ValueError, AttributeError):
+                    pass
+                exchange["prompt_tokens"], exchange["completion_tokens"] = (
+                    completion_usage(exchange["body"], content_type)
+                )
+            self.cassette.put(exchange)
+            self._account(conversation, key)
+        return web.Response(
+            status=status,
+            body=data,
+            content_type=content_type.split(";")[0],
+            headers=forwarded,
+        )
@@ -0,0 +1,183 @@
+from typing import Dict, List, Optional, Tuple
+import difflib
+import random
+import re
+
+# The same three shapes of conversation as main.test_cases()
+BUG_REPORT_TEMPLATE = "[User]: 'I can't change my {topic}', [Agent]: 'Sorry for the inconvenience we will get that fixed right away'"
+FEATURE_REQUEST_TEMPLATE = "[User]: 'I would like to be able to change my {topic}', [Agent]: 'Thanks for the suggestion!'"
+GENERAL_QUERY_TEMPLATE = "[User]: 'Hi, I can't figure out how to change my {topic}', [Agent]: 'You can change it by going to Settings > User Information > {setting}', [User]: 'Thanks!'"
+TEMPLATES = {
+    "bug_report": BUG_REPORT_TEMPLATE,
+    "feature_request": FEATURE_REQUEST_TEMPLATE,
+    "general_query": GENERAL_QUERY_TEMPLATE,
+}
+
+THINGS = [
+    "delivery address",
+    "profile picture",
+    "current location",
+    "password",
+    "email address",
+    "phone number",
+    "payment method",
+    "notification settings",
+    "language",
+    "time zone",
+    "display name",
+    "billing address",
+    "shipping preferences",
+    "saved cards",
+    "two-factor settings",
+    "username",
+    "privacy settings",
+    "home screen layout",
+    "default currency",
+    "order history view",
+]
+PLATFORMS = ["on iOS", "on Android", "on the website", "on the desktop app"]
+# Other names users give some of the THINGS, which hard_conversation() uses
+SYNONYMS = {
+    "profile picture": "avatar",
+    "delivery address": "drop-off spot",
+    "current location": "whereabouts",
+    "password": "passcode",
+    "email address": "inbox",
+    "phone number": "mobile",
+    "payment method": "way of paying",
+    "notification settings": "alerts",
+    "display name": "screen name",
+    "username": "handle",
+    "language": "locale",
+    "time zone": "clock offset",
+}
+# Every word the templates and topics use, and the ones typos are corrected to
+_VOCABULARY = set(
+    re.findall(r"[a-z]+", " ".join([*TEMPLATES.values(), *THINGS, *PLATFORMS]).lower())
+)
+_THING_WORDS = sorted(set(re.findall(r"[a-z]+", " ".join(THINGS))))
+
+
+def topics(count: int) -> List[str]:
+    """`count` distinct things a user could want to change"""
+    names = [f"{thing} {platform}" for platform in PLATFORMS for thing in THINGS]
+    variant = 2
+    while len(names) < count:
+        names += [
+            f"{thing} {platform} (v{variant})"
+            for platform in PLATFORMS
+            for thing in THINGS
+        ]
+        variant += 1
+    return names[:count]
+
+
+def conversation(kind: str, topic: str) -> str:
+    return TEMPLATES[kind].format(topic=topic, setting=topic.title())
+
+
+def hard_conversation(kind: str, topic: str, rng: random.Random) -> str:
+    """Like conversation(), but the user names the thing with a synonym or a typo,
+    which a word-based index can't see past, though canonical_title() can"""
+    thing = next(thing for thing in THINGS if topic.startswith(thing))
+    if thing in SYNONYMS and rng.random() < 0.5:
+        return conversation(kind, topic.replace(thing, SYNONYMS[thing], 1))
+    # Swap two letters of the thing's longest word, like "locatino"
+    word = max(re.findall(r"[a-z]+", thing), key=len)
+    i = rng.randrange(1, len(word) - 2)
+    typo = word[:i] + word[i + 1] + word[i] + word[i + 2 :]
+    return conversation(kind, topic.replace(word, typo, 1))
+
+
+def canonical_title(text: str) -> Optional[str]:
+    """The task_title() of a conversation once the synonyms and typos of
+    hard_conversation() are undone, i.e. the title of the task it's really about"""
+    for thing, synonym in SYNONYMS.items():
+        text = text.replace(synonym, thing)
+
+    def correct(match: re.Match) -> str:
+        word = match.group(0)
+        if word.lower() in _VOCABULARY:
+            return word
+        close = difflib.get_close_matches(word.lower(), _THING_WORDS, 1, 0.75)
+        return close[0] if close else word
+
+    return task_title(re.sub(r"[A-Za-z]+", correct, text))
+
+
+def task_title(text: str) -> Optional[str]:
+    """Title the stub model gives the task a conversation describes, or None for
+    general queries. Conversations built from the same template and topic get the
+    same title, so the stub can tell when a candidate task matches"""
+    match = re.search(r"\[User\]:\s*'?(.*?)'?(?:, \[|\n|$)", text)
+    request = match.group(1).strip() if match else text.strip()
+    if "figure out" in request:
+        return None
+    if request.startswith("I would like"):
+        return f"Feature request: {request}"
+    return f"Bug report: {request}"
+
+
+def backlog_issues(size: int, seed: int = 0) -> List[Dict]:
+    """Existing tasks for the bug reports and feature requests about the first
+    topics, so part of a corpus over the same topics matches the backlog"""
+    rng = random.Random(seed)
+    issues = []
+    for topic in topics(size):
+        kind = rng.choice(["bug_report", "feature_request"])
+        issues.append(
+            {
+                "title": task_title(conversation(kind, topic)),
+                "description": f"Users have reported this about their {topic}.",
+            }
+        )
+    return issues
+
+
+def labelled_corpus(
+    size: int,
+    topic_count: int = 100,
+    duplicate_rate: float = 0.0,
+    kind_weights: Dict[str, float] = None,
+    seed: int = 0,
+    hard_rate: float = 0.0,
+) -> List[Tuple[str, str]]:
+    """`size` (conversation, kind) pairs about `topic_count` topics. A
+    `duplicate_rate` share of them repeat an earlier conversation word for word,
+    and a `hard_rate` share of the bug reports and feature requests are
+    hard_conversation()s"""
+    rng = random.Random(seed)
+    kind_weights = kind_weights or {
+        "bug_report": 0.4,
+        "feature_request": 0.3,
+        "general_query": 0.3,
+    }
+    kinds, weights = zip(*kind_weights.items())
+    names = topics(topic_count)
+    corpus = []
+    for _ in range(size):
+        if corpus and rng.random() < duplicate_rate:
+            corpus.append(rng.choice(corpus))
+        else:
+            kind = rng.choices(kinds, weights)[0]
+            topic = rng.choice(names)
+            if kind != "general_query" and rng.random() < hard_rate:
+                corpus.append((hard_conversation(kind, topic, rng), kind))
+            else:
+                corpus.append((conversation(kind, topic), kind))
+    return corpus
+
+
+def synthetic_corpus(
+    size: int,
+    topic_count: int = 100,
+    duplicate_rate: float = 0.0,
+    kind_weights: Dict[str, float] = None,
+    seed: int = 0,
+) -> List[str]:
+    return [
+        text
+        for text, _ in labelled_corpus(
+            size, topic_count, duplicate_rate, kind_weights, seed
+        )
+    ]
@@ -0,0 +1,540 @@
+"""Measures how well each matching strategy categorizes a labelled corpus, next to
+what it costs: API calls, tokens, dollars and latency per conversation.
+
+Recording runs every strategy over the corpus through a cassettes.CassetteProxy
+in front of the real APIs (or, with --stub, the stub servers and a synthetic
+corpus labelled against the stub's backlog). Replaying runs them again from the
+cassettes, offline and with one process per strategy, so configurations can be
+compared as often as needed without spending anything:
+
+    python benchmarks/evaluate.py record --stub --cassettes .cache/eval
+    python benchmarks/evaluate.py replay --cassettes .cache/eval --output eval.json
+
+`python -m benchmarks.evaluate ...` works as well.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+# The pipeline's modules live in the parent directory and read their API keys at
+# import time, so give them placeholders before importing them: only a live record
+# needs the real keys, and it loads them once the arguments are parsed. The other
+# benchmark modules are imported as siblings, however this one was started
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARKS)
+KEY_SOURCES = {
+    "openai_key": ("OPENAI_API_KEY", "openai_key.txt"),
+    "linear_key": ("LINEAR_API_KEY", "linear_key.txt"),
+}
+_ENVIRONMENT_KEYS = {name: os.environ.get(name) for name, _ in KEY_SOURCES.values()}
+for name, _ in KEY_SOURCES.values():
+    os.environ.setdefault(name, "benchmark")
+
+from cascade import DEFAULT_MODELS, MODEL_PRICES, ModelCascade  # noqa: E402
+from compaction import Compactor  # noqa: E402
+from constants import LINEAR_API_URL  # noqa: E402
+from integration_context import IntegrationContext  # noqa: E402
+from issue_index import HashingEmbedder, IssueIndex  # noqa: E402
+from main import DEFAULT_TOP_K, categorize_conversation_async  # noqa: E402
+from mentions import MentionCounter  # noqa: E402
+from rate_limits import RateGovernor  # noqa: E402
+
+from cassettes import Cassette, CassetteProxy  # noqa: E402
+from corpus import backlog_issues, canonical_title, labelled_corpus  # noqa: E402
+from run import UNLIMITED_GOVERNOR, git_revision, percentile  # noqa: E402
+from stub_servers import LinearStub, OpenAIStub, start_stub_servers  # noqa: E402
+
+CORPUS_FILE = "corpus.jsonl"
+ACTIONS = ("match", "create", "ignore")
+# What a strategy changes about the pipeline. "top_k" shortlists candidates with
+# an IssueIndex (the whole backlog is used without it), "compact" trims prompts
+# with a Compactor, and "cascade" tries the models in order. The "batched" mode
+# isn't here: its prompts depend on which conversations happen to arrive
+# together, so they can't be replayed
+STRATEGIES = {
+    "per_issue": {"matching_mode": "per_issue"},
+    "per_issue_top5": {"matching_mode": "per_issue", "top_k": 5},
+    "per_issue_cascade": {"matching_mode": "per_issue", "cascade": DEFAULT_MODELS},
+    "ranked": {"matching_mode": "ranked"},
+    "ranked_top20": {"matching_mode": "ranked", "top_k": 20},
+    "ranked_top5": {"matching_mode": "ranked", "top_k": 5},
+    "ranked_compact": {"matching_mode": "ranked", "compact": True},
+    "ranked_cascade": {"matching_mode": "ranked", "cascade": DEFAULT_MODELS},
+}
+# Share of the synthetic bug reports and feature requests that are hard to file
+DEFAULT_HARD_RATE = 0.3
+# Share of conversations each stub model misreads. These are made up, not measured:
+# they only give the smaller model more noise than the larger one
+DEFAULT_MISREAD_RATES = "gpt-4o-mini=0.1,gpt-4o=0.02"
+# Compared on the Pareto front: higher is better for the first, lower for the rest
+PARETO_METRICS = ("f1", "cost_usd_per_conversation", "latency_mean")
+
+
+def expected_outcome(label: Dict) -> Tuple[str, Optional[str]]:
+    """The action a labelled conversation should end in, and for a match, the
+    title of the task it should be matched to"""
+    if label["kind"] == "general_query":
+        return "ignore", None
+    if label.get("task"):
+        return "match", label["task"]
+    return "create", None
+
+
+def synthetic_labels(
+    size: int,
+    topic_count: int,
+    backlog_size: int,
+    seed: int,
+    hard_rate: float = DEFAULT_HARD_RATE,
+) -> List[Dict]:
+    """A corpus.labelled_corpus, with each conversation's task in the stub backlog
+    of the same size and seed when it has one. A `hard_rate` share of the bug
+    reports and feature requests misspell the thing or call it something else,
+    and are labelled with the task they'd have without that (see
+    corpus.canonical_title)"""
+    backlog = {issue["title"] for issue in backlog_issues(backlog_size, seed)}
+    labels = []
+    for conversation, kind in labelled_corpus(
+        size, topic_count, seed=seed, hard_rate=hard_rate
+    ):
+        title = canonical_title(conversation)
+        labels.append(
+            {
+                "conversation": conversation,
+                "kind": kind,
+                "task": title if kind != "general_query" and title in backlog else None,
+            }
+        )
+    return labels
+
+
+def load_labels(path: str) -> List[Dict]:
+    """Reads a labelled corpus: JSON lines with the "conversation", its "kind"
+    (bug_report, feature_request or general_query), and the title of the existing
+    "task" it should be matched to, if any"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def score(labels: List[Dict], outcomes: List[Optional[Dict]]) -> Dict:
+    """Precision and recall of each action, and their macro averages. A match only
+    counts as correct when it's to the labelled task, and errors count as wrong"""
+    counts = {
+        action: {"correct": 0, "predicted": 0, "expected": 0} for action in ACTIONS
+    }
+    correct = 0
+    for label, outcome in zip(labels, outcomes):
+        action, task = expected_outcome(label)
+        counts[action]["expected"] += 1
+        if outcome is None:
+            continue
+        predicted = outcome["action"]
+        counts[predicted]["predicted"] += 1
+        if predicted == action and (
+            task is None or (outcome.get("title") or "").strip() == task.strip()
+        ):
+            counts[action]["correct"] += 1
+            correct += 1
+    report = {}
+    for action, count in counts.items():
+        report[action] = {
+            "precision": (
+                round(count["correct"] / count["predicted"], 4)
+                if count["predicted"]
+                else 0.0
+            ),
+            "recall": (
+                round(count["correct"] / count["expected"], 4)
+                if count["expected"]
+                else 0.0
+            ),
+            **count,
+        }
+    # Averaged over the actions the corpus has examples of
+    labelled = [action for action in ACTIONS if counts[action]["expected"]] or ACTIONS
+    precision = sum(report[action]["precision"] for action in labelled) / len(labelled)
+    recall = sum(report[action]["recall"] for action in labelled) / len(labelled)
+    return {
+        "accuracy": round(correct / len(labels), 4) if labels else 0.0,
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": (
+            round(2 * precision * recall / (precision + recall), 4)
+            if precision + recall
+            else 0.0
+        ),
+        "actions": report,
+    }
+
+
+def live_keys() -> Dict[str, str]:
+    """The API keys to record against the real APIs with, as IntegrationContext
+    arguments: from the environment this process started with, or else the key
+    files, as in constants.py"""
+    keys = {}
+    for argument, (name, path) in KEY_SOURCES.items():
+        if _ENVIRONMENT_KEYS[name]:
+            keys[argument] = _ENVIRONMENT_KEYS[name]
+        else:
+            with open(path) as f:
+                keys[argument] = f.read().strip("\n")
+    return keys
+
+
+async def run_strategy(
+    name: str,
+    labels: List[Dict],
+    proxy: CassetteProxy,
+    url: str,
+    concurrency: int,
+    state_dir: str,
+    governor: RateGovernor,
+    api_keys: Optional[Dict[str, str]] = None,
+) -> Dict:
+    """Categorizes every labelled conversation with the strategy through the
+    proxy, each with a context of its own so no conversation sees another's
+    outcome, and reports its scores and costs. `api_keys` are passed on to the
+    contexts, for recording against the real APIs"""
+    strategy = STRATEGIES[name]
+    cascade = ModelCascade(strategy["cascade"]) if strategy.get("cascade") else None
+    schema_cache_path = os.path.join(state_dir, "schema.json")
+
+    def context(conversation_id: str) -> IntegrationContext:
+        top_k = strategy.get("top_k")
+        return IntegrationContext(
+            linear_url=f"{url}/{conversation_id}/graphql",
+            openai_url=f"{url}/{conversation_id}/v1",
+            schema_cache_path=schema_cache_path,
+            governor=governor,
+            mentions=MentionCounter(),
+            # Each conversation lists the backlog once either way, and a cache
+            # kept between runs would outlive the stubs' backlog
+            issue_cache_path=None,
+            issue_index=(
+                IssueIndex(
+                    os.path.join(state_dir, f"index-{conversation_id}"),
+                    HashingEmbedder(),
+                )
+                if top_k is not None
+                else None
+            ),
+            compactor=Compactor() if strategy.get("compact") else None,
+            cascade=cascade,
+            **(api_keys or {}),
+        )
+
+    # The schema is fetched once, outside any conversation's account
+    async with context("setup"):
+        pass
+    outcomes: List[Optional[Dict]] = [None] * len(labels)
+    errors: List[str] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def categorize(index: int, conversation: str) -> None:
+        async with semaphore:
+            try:
+                async with context(str(index)) as ctx:
+                    outcomes[index] = await categorize_conversation_async(
+                        conversation,
+                        ctx,
+                        strategy["matching_mode"],
+                        strategy.get("top_k", DEFAULT_TOP_K),
+                    )
+            except Exception as e:
+                errors.append(repr(e))
+
+    started = time.perf_counter()
+    # The pipeline prints a line per conversation, which we don't need
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        await asyncio.gather(
+            *(
+                categorize(index, label["conversation"])
+                for index, label in enumerate(labels)
+            )
+        )
+    elapsed = time.perf_counter() - started
+
+    count = len(labels)
+    usage = [proxy.usage.get(str(index), {}) for index in range(count)]
+    latencies = [entry.get("seconds", 0.0) for entry in usage]
+
+    def per_conversation(field: str, digits: int = 3) -> float:
+        return round(sum(entry.get(field, 0) for entry in usage) / count, digits)
+
+    return {
+        "strategy": name,
+        **strategy,
+        **score(labels, outcomes),
+        "openai_calls_per_conversation": per_conversation("openai_calls"),
+        "linear_calls_per_conversation": per_conversation("linear_calls"),
+        "tokens_per_conversation": round(
+            per_conversation("prompt_tokens") + per_conversation("completion_tokens"),
+            1,
+        ),
+        "cost_usd_per_conversation": per_conversation("cost_usd", 6),
+        "latency_mean": round(sum(latencies) / count, 4),
+        "latency_p50": round(percentile(latencies, 0.50), 4),
+        "latency_p95": round(percentile(latencies, 0.95), 4),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "cassette_misses": proxy.misses,
+        "seconds": round(elapsed, 3),
+    }
+
+
+def pareto_front(reports: List[Dict]) -> List[str]:
+    """Strategies no other strategy beats on every PARETO_METRICS at once"""
+    quality, *costs = PARETO_METRICS
+
+    def dominates(a: Dict, b: Dict) -> bool:
+        no_worse = a[quality] >= b[quality] and all(a[m] <= b[m] for m in costs)
+        better = a[quality] > b[quality] or any(a[m] < b[m] for m in costs)
+        return no_worse and better
+
+    return [
+        report["strategy"]
+        for report in reports
+        if not any(dominates(other, report) for other in reports)
+    ]
+
+
+def parse_misread_rates(text: str) -> Dict[str, float]:
+    """Parses "model=rate,model=rate" """
+    rates = {}
+    for pair in filter(None, text.split(",")):
+        model, rate = pair.split("=")
+        rates[model.strip()] = float(rate)
+    return rates
+
+
+def _cassette_path(directory: str, strategy: str) -> str:
+    return os.path.join(directory, f"{strategy}.jsonl")
+
+
+async def record(args: argparse.Namespace, labels: List[Dict]) -> List[Dict]:
+    stubs = None
+    api_keys = None
+    if args.stub:
+        linear = LinearStub(
+            backlog_size=args.backlog, latency=args.linear_latency, seed=args.seed
+        )
+        openai = OpenAIStub(
+            latency=args.openai_latency,
+            seed=args.seed,
+            misread_rates=parse_misread_rates(args.misread_rates),
+        )
+        stubs, stub_url = await start_stub_servers(linear, openai)
+        linear_url, openai_url = f"{stub_url}/graphql", f"{stub_url}/v1"
+        governor = RateGovernor(**UNLIMITED_GOVERNOR)
+    else:
+        # One governor for every strategy, as they share the API keys' limits
+        governor = RateGovernor()
+        api_keys = live_keys()
+        linear_url = LINEAR_API_URL
+        openai_url = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+    reports = []
+    try:
+        for name in args.strategies:
+            cassette = Cassette(_cassette_path(args.cassettes, name))
+            proxy = CassetteProxy(cassette, linear_url, openai_url, MODEL_PRICES)
+            url = await proxy.start()
+            try:
+                with tempfile.TemporaryDirectory() as state_dir:
+                    reports.append(
+                        await run_strategy(
+                            name,
+                            labels,
+                            proxy,
+                            url,
+                            args.concurrency,
+                            state_dir,
+                            governor,
+                            api_keys,
+                        )
+                    )
+            finally:
+                await proxy.stop()
+                cassette.save()
+            print(f"Recorded {len(cassette)} responses for {name}")
+    finally:
+        if stubs is not None:
+            await stubs.cleanup()
+    return reports
+
+
+async def _replay_strategy(
+    directory: str, name: str, labels: List[Dict], concurrency: int
+) -> Dict:
+    path = _cassette_path(directory, name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No cassette for {name} at {path}, record it first")
+    proxy = CassetteProxy(Cassette(path), prices=MODEL_PRICES)
+    url = await proxy.start()
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            # Nothing leaves the machine, so there are no limits to respect
+            return await run_strategy(
+                name,
+                labels,
+                proxy,
+                url,
+                concurrency,
+                state_dir,
+                RateGovernor(**UNLIMITED_GOVERNOR),
+            )
+    finally:
+        await proxy.stop()
+
+
+def replay_strategy(
+    directory: str, name: str, labels: List[Dict], concurrency: int
+) -> Dict:
+    """Replays one strategy's cassette in this process"""
+    return asyncio.run(_replay_strategy(directory, name, labels, concurrency))
+
+
+def replay(args: argparse.Namespace, labels: List[Dict]) -> List[Dict]:
+    # Strategies don't share anything, so each gets a process (and a CPU) of its own
+    with ProcessPoolExecutor(min(args.jobs, len(args.strategies))) as pool:
+        futures = [
+            pool.submit(replay_strategy, args.cassettes, name, labels, args.concurrency)
+            for name in args.strategies
+        ]
+        return [future.result() for future in futures]
+
+
+def print_reports(reports: List[Dict], front: List[str]) -> None:
+    columns = (
+        "accuracy",
+        "precision",
+        "recall",
+        "f1",
+        "openai_calls_per_conversation",
+        "tokens_per_conversation",
+        "cost_usd_per_conversation",
+        "latency_mean",
+    )
+    headers = ("accuracy", "prec", "recall", "f1", "openai", "tokens", "usd", "latency")
+    print(f"{'strategy':20}" + "".join(f"{h:>11}" for h in headers))
+    for report in reports:
+        line = f"{report['strategy']:20}" + "".join(
+            f"{report[column]:>11}" for column in columns
+        )
+        if report["strategy"] in front:
+            line += "  pareto"
+        if report["errors"]:
+            line += f"  ({report['errors']} errors)"
+        print(line)
+    print(
+        "Per conversation. Pareto front on "
+        + ", ".join(PARETO_METRICS)
+        + ": "
+        + ", ".join(front)
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Evaluate matching strategies on a labelled corpus, recording API responses to cassettes and replaying them offline"
+    )
+    parser.add_argument("mode", choices=("record", "replay"))
+    parser.add_argument(
+        "--cassettes",
+        default=".cache/eval",
+        help="Directory of one cassette per strategy, and the corpus they were recorded on",
+    )
+    parser.add_argument(
+        "--corpus",
+        help="Labelled JSONL corpus to record (see load_labels). Defaults to a synthetic one with --stub, and to the recorded one when replaying",
+    )
+    parser.add_argument(
+        "--strategies",
+        default=",".join(STRATEGIES),
+        help=f"Comma separated, out of {', '.join(STRATEGIES)}",
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Strategies replayed at the same time",
+    )
+    parser.add_argument(
+        "--stub",
+        action="store_true",
+        help="Record against the stub servers instead of the real APIs",
+    )
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--topics", type=int, default=100)
+    parser.add_argument("--backlog", type=int, default=50)
+    parser.add_argument(
+        "--hard-rate",
+        type=float,
+        default=DEFAULT_HARD_RATE,
+        help="Share of synthetic bug reports and feature requests with a misspelled or renamed thing",
+    )
+    parser.add_argument(
+        "--misread-rates",
+        default=DEFAULT_MISREAD_RATES,
+        help="Comma separated MODEL=RATE shares of conversations each stub model misreads",
+    )
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--linear-latency", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+    args.strategies = args.strategies.split(",")
+    unknown = [name for name in args.strategies if name not in STRATEGIES]
+    if unknown:
+        parser.error(f"Unknown strategies: {', '.join(unknown)}")
+
+    corpus_path = os.path.join(args.cassettes, CORPUS_FILE)
+    if args.corpus:
+        labels = load_labels(args.corpus)
+    elif args.mode == "record" and args.stub:
+        labels = synthetic_labels(
+            args.conversations, args.topics, args.backlog, args.seed, args.hard_rate
+        )
+    elif args.mode == "replay" and os.path.exists(corpus_path):
+        labels = load_labels(corpus_path)
+    else:
+        parser.error("--corpus is needed to record against the real APIs")
+    if args.mode == "record":
+        # Replays must use the corpus the cassettes were recorded on
+        os.makedirs(args.cassettes, exist_ok=True)
+        with open(corpus_path, "w") as f:
+            for label in labels:
+                f.write(json.dumps(label) + "\n")
+        reports = asyncio.run(record(args, labels))
+    else:
+        reports = replay(args, labels)
+
+    front = pareto_front(reports)
+    print_reports(reports, front)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "revision": git_revision(),
+                    "mode": args.mode,
+                    "conversations": len(labels),
+                    "strategies": reports,
+                    "pareto_front": front,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+"""Runs the categorization pipeline over a synthetic corpus against the stub servers
+and reports throughput, latency, API calls and tokens per conversation.
+
+    python benchmarks/run.py --conversations 500 --openai-latency 0.8 --output base.json
+    python benchmarks/run.py --conversations 500 --openai-latency 0.8 --dedup \\
+        --compare base.json
+"""
+
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# The pipeline's modules live in the parent directory and read their API keys at
+# import time, so point the keys at the stubs before importing them
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("LINEAR_API_KEY", "benchmark")
+
+from cascade import DEFAULT_MIN_CONFIDENCE, ModelCascade  # noqa: E402
+from clustering import categorize_clustered  # noqa: E402
+from compaction import Compactor  # noqa: E402
+from dedup import DedupIndex  # noqa: E402
+from integration_context import IntegrationContext  # noqa: E402
+from issue_cache import IssueCache  # noqa: E402
+from issue_index import HashingEmbedder, IssueIndex  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from prefilter import PreClassifier  # noqa: E402
+from main import (  # noqa: E402
+    DEFAULT_CONCURRENCY,
+    DEFAULT_TOP_K,
+    MATCHING_MODES,
+    categorize_conversation_async,
+)
+from rate_limits import RateGovernor  # noqa: E402
+from routing import (  # noqa: E402
+    MultiTeamCategorizer,
+    Team,
+    TeamRouter,
+    team_context,
+    team_shares,
+)
+from ranking_batcher import (  # noqa: E402
+    DEFAULT_MAX_BATCH_SIZE as DEFAULT_RANKING_BATCH_SIZE,
+    DEFAULT_MAX_WAIT as DEFAULT_RANKING_BATCH_WAIT,
+    RankingBatcher,
+)
+
+from corpus import labelled_corpus, synthetic_corpus  # noqa: E402
+from stub_servers import LinearStub, OpenAIStub, start_stub_servers  # noqa: E402
+
+# The stubs don't rate limit, so the governor's limits are set out of the way
+# unless --real-limits is given
+UNLIMITED_GOVERNOR = dict(
+    openai_requests_per_minute=1e9,
+    openai_tokens_per_minute=1e12,
+    linear_requests_per_hour=1e9,
+    linear_complexity_per_hour=1e12,
+)
+# One team per platform in the synthetic corpus, for --teams
+BENCHMARK_TEAMS = [
+    Team("ios", "team-ios", "The iOS app", ["iOS"]),
+    Team("android", "team-android", "The Android app", ["Android"]),
+    Team("web", "team-web", "The website", ["website"]),
+    Team("desktop", "team-desktop", "The desktop app", ["desktop app"]),
+]
+# Metrics compared by --compare, and whether higher is better
+COMPARED_METRICS = {
+    "conversations_per_second": True,
+    "latency_p50": False,
+    "latency_p95": False,
+    "latency_p99": False,
+    "openai_calls_per_conversation": False,
+    "linear_calls_per_conversation": False,
+    "tokens_per_conversation": False,
+    "retries": False,
+    "errors": False,
+}
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict:
+    corpus = synthetic_corpus(
+        args.conversations,
+        topic_count=args.topics,
+        duplicate_rate=args.duplicate_rate,
+        seed=args.seed,
+    )
+    linear = LinearStub(
+        backlog_size=args.backlog,
+        latency=args.linear_latency,
+        error_rate=args.linear_error_rate,
+        seed=args.seed,
+        teams=(
+            {team.team_id: team.keywords[0] for team in BENCHMARK_TEAMS}
+            if args.teams
+            else None
+        ),
+    )
+    openai = OpenAIStub(
+        latency=args.openai_latency,
+        error_rate=args.openai_error_rate,
+        seed=args.seed,
+        model_latency={
+            model: args.openai_latency * float(factor)
+            for model, factor in args.model_latency_factor
+        },
+        uncertain_rate=args.uncertain_rate,
+        token_latency=args.token_latency,
+    )
+    prefilter = None
+    if args.prefilter is not None:
+        # Trained on a separate sample, so it hasn't seen the benchmark corpus
+        training = labelled_corpus(args.conversations, args.topics, seed=args.seed + 1)
+        prefilter = PreClassifier.train(
+            [text for text, _ in training],
+            [int(kind != "general_query") for _, kind in training],
+            threshold=args.prefilter,
+        )
+    runner, url = await start_stub_servers(linear, openai)
+    governor = (
+        RateGovernor() if args.real_limits else RateGovernor(**UNLIMITED_GOVERNOR)
+    )
+
+    metrics = Metrics() if args.metrics else None
+    cascade = (
+        ModelCascade(args.cascade.split(","), args.min_confidence)
+        if args.cascade
+        else None
+    )
+    with tempfile.TemporaryDirectory() as state_dir:
+        options = dict(
+            linear_url=f"{url}/graphql",
+            openai_url=f"{url}/v1",
+            schema_cache_path=os.path.join(state_dir, "schema.json"),
+            batch_mutations=args.batch_mutations,
+            compactor=Compactor() if args.compact else None,
+            metrics=metrics,
+            prefilter=prefilter,
+            cascade=cascade,
+            streaming=args.stream,
+        )
+        ctx = IntegrationContext(
+            governor=governor,
+            issue_cache=(
+                IssueCache(os.path.join(state_dir, "issues.db"))
+                if args.issue_cache
+                else None
+            ),
+            issue_cache_path=None,
+            issue_index=(
+                IssueIndex(os.path.join(state_dir, "index"), HashingEmbedder())
+                if args.index
+                else None
+            ),
+            dedup=DedupIndex() if args.dedup else None,
+            **options,
+        )
+        categorizer = None
+        if args.teams:
+            # One shard, worker pool and rate budget per team, with every team's
+            # backlog cache and index always on
+            shares = team_shares(BENCHMARK_TEAMS)
+            categorizer = MultiTeamCategorizer(
+                TeamRouter(BENCHMARK_TEAMS),
+                {
+                    team.name: team_context(
+                        team,
+                        governor.share(shares[team.name]),
+                        os.path.join(state_dir, "teams"),
+                        dedup=DedupIndex() if args.dedup else None,
+                        **options,
+                    )
+                    for team in BENCHMARK_TEAMS
+                },
+                args.matching_mode,
+                args.top_k,
+            )
+        if args.matching_mode == "batched":
+            ctx.ranking_batcher = RankingBatcher(
+                ctx, args.ranking_batch_size, args.ranking_batch_wait
+            )
+        latencies: List[float] = []
+        outcomes: Dict[str, int] = {}
+        errors: List[str] = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def categorize(conversation: str) -> None:
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    outcome = await categorize_conversation_async(
+                        conversation, ctx, args.matching_mode, args.top_k
+                    )
+                except Exception as e:
+                    errors.append(repr(e))
+                    return
+                latencies.append(time.perf_counter() - started)
+                outcomes[outcome["action"]] = outcomes.get(outcome["action"], 0) + 1
+
+        team_latencies: Dict[str, List[float]] = {}
+        team_semaphore = asyncio.Semaphore(args.concurrency * len(BENCHMARK_TEAMS))
+
+        async def categorize_routed(conversation: str) -> None:
+            # Submitted a few at a time per team, so latency is mostly processing
+            # rather than waiting in the teams' queues
+            async with team_semaphore:
+                started = time.perf_counter()
+                try:
+                    outcome = await categorizer.categorize(conversation)
+                except Exception as e:
+                    errors.append(repr(e))
+                    return
+                latencies.append(time.perf_counter() - started)
+                team_latencies.setdefault(outcome["team"], []).append(latencies[-1])
+                outcomes[outcome["action"]] = outcomes.get(outcome["action"], 0) + 1
+
+        async def categorize_batch() -> None:
+            # Bulk mode has no per-conversation latency, every conversation waits
+            # for the whole batch
+            started = time.perf_counter()
+            results = await categorize_clustered(
+                corpus,
+                ctx,
+                args.matching_mode,
+                args.top_k,
+                args.concurrency,
+                threshold=args.cluster,
+            )
+            latencies.extend([time.perf_counter() - started] * len(corpus))
+            for result in results:
+                if isinstance(result, Exception):
+                    errors.append(repr(result))
+                else:
+                    outcomes[result["action"]] = outcomes.get(result["action"], 0) + 1
+
+        try:
+            async with categorizer if categorizer is not None else ctx:
+                # Setup (schema, first backlog sync) isn't part of the measurement
+                openai_before, linear_before = openai.requests, linear.requests
+                started = time.perf_counter()
+                # The pipeline prints a line per conversation, which we don't need
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+                    sys.stdout if args.verbose else devnull
+                ):
+                    if args.cluster is not None:
+                        await categorize_batch()
+                    elif categorizer is not None:
+                        await asyncio.gather(*(categorize_routed(c) for c in corpus))
+                    else:
+                        await asyncio.gather(*(categorize(c) for c in corpus))
+                elapsed = time.perf_counter() - started
+        finally:
+            await runner.cleanup()
+
+    count = len(corpus)
+    tokens = openai.prompt_tokens + openai.completion_tokens
+    return {
+        "label": args.label,
+        "revision": git_revision(),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare", "label", "verbose")
+        },
+        "conversations": count,
+        "seconds": round(elapsed, 3),
+        "conversations_per_second": round(count / elapsed, 3),
+        "latency_p50": round(percentile(latencies, 0.50), 4),
+        "latency_p95": round(percentile(latencies, 0.95), 4),
+        "latency_p99": round(percentile(latencies, 0.99), 4),
+        "openai_calls_per_conversation": round(
+            (openai.requests - openai_before) / count, 3
+        ),
+        "linear_calls_per_conversation": round(
+            (linear.requests - linear_before) / count, 3
+        ),
+        "tokens_per_conversation": round(tokens / count, 1),
+        "prompt_tokens": openai.prompt_tokens,
+        "completion_tokens": openai.completion_tokens,
+        "retries": governor.retries,
+        "injected_errors": {"openai": openai.errors, "linear": linear.errors},
+        "outcomes": outcomes,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "operations": metrics.summary() if metrics is not None else None,
+        "prefilter": prefilter.stats() if prefilter is not None else None,
+        "ranking_batches": (
+            ctx.ranking_batcher.stats() if ctx.ranking_batcher is not None else None
+        ),
+        "openai_calls_by_model": openai.model_requests,
+        "streams": {"opened": openai.streams, "cancelled": openai.streams_cancelled},
+        "cascade": cascade.stats() if cascade is not None else None,
+        "teams": (
+            {
+                name: {
+                    "conversations": len(values),
+                    "latency_p50": round(percentile(values, 0.50), 4),
+                    "latency_p95": round(percentile(values, 0.95), 4),
+                }
+                for name, values in sorted(team_latencies.items())
+            }
+            if categorizer is not None
+            else None
+        ),
+    }
+
+
+def print_report(report: Dict, baseline: Optional[Dict] = None) -> None:
+    print(
+        f"{report['conversations']} conversations in {report['seconds']}s"
+        + (f" ({report['label']})" if report["label"] else "")
+    )
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        line = f"  {metric:32} {report[metric]:>10}"
+        if baseline is not None and metric in baseline:
+            before = baseline[metric]
+            change = report[metric] - before
+            if before:
+                line += f"  {change:+.3g} ({change / before:+.1%})"
+            else:
+                line += f"  {change:+.3g}"
+            if change and (change > 0) == higher_is_better:
+                line += " better"
+            elif change:
+                line += " worse"
+        print(line)
+    for operation, stats in (report.get("operations") or {}).items():
+        print(f"  {operation:32} " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+    if report.get("ranking_batches"):
+        print(
+            "  ranking batches: "
+            + ", ".join(f"{k}={v}" for k, v in report["ranking_batches"].items())
+        )
+    for name, stats in (report.get("teams") or {}).items():
+        print(f"  team {name:27} " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+    if report.get("cascade"):
+        cascade = report["cascade"]
+        print(
+            f"  cascade: escalation_rate={cascade['escalation_rate']}, mean_seconds={cascade['mean_seconds']}, cost_per_decision_usd={cascade['cost_per_decision_usd']}"
+        )
+        for tier in cascade["tiers"]:
+            print(
+                f"    {tier['model']:30} "
+                + ", ".join(f"{k}={v}" for k, v in tier.items() if k != "model")
+            )
+    print(
+        "  outcomes: "
+        + ", ".join(f"{n} {action}" for action, n in sorted(report["outcomes"].items()))
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline against local stub OpenAI and Linear servers"
+    )
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument(
+        "--topics", type=int, default=100, help="Distinct topics in the corpus"
+    )
+    parser.add_argument(
+        "--duplicate-rate",
+        type=float,
+        default=0.0,
+        help="Share of conversations that repeat an earlier one word for word",
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=50, help="Existing tasks in the stub Linear team"
+    )
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--linear-latency", type=float, default=0.1)
+    parser.add_argument(
+        "--token-latency",
+        type=float,
+        default=0.0,
+        help="Seconds the stub model takes per completion token, after --openai-latency",
+    )
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--linear-error-rate", type=float, default=0.0)
+    parser.add_argument("--matching-mode", choices=MATCHING_MODES, default="ranked")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        "--ranking-batch-size",
+        type=int,
+        default=DEFAULT_RANKING_BATCH_SIZE,
+        help="Conversations per prompt with --matching-mode batched",
+    )
+    parser.add_argument(
+        "--ranking-batch-wait",
+        type=float,
+        default=DEFAULT_RANKING_BATCH_WAIT,
+        help="Seconds a conversation waits for others to share its prompt",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream completions and act as soon as the answer is decided",
+    )
+    parser.add_argument(
+        "--teams",
+        action="store_true",
+        help="Route conversations to one team per platform, each with its own shard, workers (--concurrency each) and rate budget",
+    )
+    parser.add_argument("--batch-mutations", action="store_true")
+    parser.add_argument("--issue-cache", action="store_true")
+    parser.add_argument("--index", action="store_true")
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument(
+        "--cluster",
+        type=float,
+        metavar="THRESHOLD",
+        help="Categorize the corpus as one batch with clustering.categorize_clustered",
+    )
+    parser.add_argument(
+        "--cascade",
+        metavar="MODELS",
+        help="Comma separated models to cascade through, e.g. gpt-4o-mini,gpt-4o",
+    )
+    parser.add_argument("--min-confidence", type=float, default=DEFAULT_MIN_CONFIDENCE)
+    parser.add_argument(
+        "--model-latency-factor",
+        nargs=2,
+        action="append",
+        metavar=("MODEL", "FACTOR"),
+        default=[["gpt-4o-mini", "0.4"]],
+        type=str,
+        help="Scale the stub's --openai-latency for a model",
+    )
+    parser.add_argument(
+        "--uncertain-rate",
+        type=float,
+        default=0.1,
+        help="Share of prompts the stub model is unsure about when asked for a confidence",
+    )
+    parser.add_argument(
+        "--prefilter",
+        type=float,
+        metavar="THRESHOLD",
+        help="Drop conversations a pre-classifier (trained on a separate sample) puts at or above this probability of needing nothing filed",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="Record per-operation metrics (which adds their own overhead)",
+    )
+    parser.add_argument(
+        "--real-limits",
+        action="store_true",
+        help="Keep the RateGovernor's default limits instead of lifting them",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the pipeline's own output"
+    )
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="Earlier results to print the change against")
+    args = parser.parse_args()
+    if args.teams and args.cluster is not None:
+        parser.error("--teams and --cluster can't be combined")
+
+    report = asyncio.run(run_benchmark(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,633 @@
+"""Local stand-ins for the OpenAI and Linear APIs with configurable latency, error
+rates and backlog size, so the pipeline can be measured without spending money.
+
+The OpenAI stub answers the prompts in gpt_helpers.py deterministically (see
+corpus.task_title), fakes the Files and Batch endpoints used by backfill.py, and
+hashes words into embeddings.
+The Linear stub runs a small subset of Linear's GraphQL schema over an in-memory
+backlog.
+"""
+
+from aiohttp import web
+from graphql import build_schema, graphql
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import datetime
+import difflib
+import itertools
+import json
+import random
+import re
+import uuid
+import zlib
+
+from corpus import backlog_issues, task_title
+
+LINEAR_SCHEMA = """
+type Issue {
+    id: String!
+    title: String!
+    description: String
+    updatedAt: String!
+    archivedAt: String
+}
+type PageInfo { hasNextPage: Boolean! endCursor: String }
+type IssueConnection { nodes: [Issue!]! pageInfo: PageInfo! }
+input DateComparator { gt: String, gte: String }
+input IssueFilter { updatedAt: DateComparator }
+enum PaginationOrderBy { createdAt updatedAt }
+type Team {
+    id: String!
+    issues(
+        first: Int
+        after: String
+        filter: IssueFilter
+        includeArchived: Boolean
+        orderBy: PaginationOrderBy
+    ): IssueConnection!
+}
+type IssuePayload { success: Boolean! issue: Issue }
+input IssueCreateInput { id: String title: String! description: String teamId: String! }
+input IssueUpdateInput { title: String description: String }
+type Comment { id: String! body: String! }
+type CommentPayload { success: Boolean! comment: Comment }
+input CommentCreateInput { id: String issueId: String! body: String! }
+type Query {
+    issue(id: String!): Issue
+    team(id: String!): Team
+    comment(id: String!): Comment
+}
+type Mutation {
+    issueCreate(input: IssueCreateInput!): IssuePayload!
+    issueUpdate(id: String!, input: IssueUpdateInput!): IssuePayload!
+    commentCreate(input: CommentCreateInput!): CommentPayload!
+}
+"""
+
+STUB_EMBEDDING_DIMENSIONS = 64
+
+
+async def _simulate_latency(rng: random.Random, latency: float) -> None:
+    if latency > 0:
+        # Jittered around the mean, like a real service
+        await asyncio.sleep(latency * rng.uniform(0.5, 1.5))
+
+
+class LinearStub:
+    def __init__(
+        self,
+        backlog_size: int = 0,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        teams: Optional[Dict[str, str]] = None,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        # Team ID to the keyword that puts a backlog issue in that team. Issues in
+        # no team are listed for every team
+        self.teams = teams or {}
+        self.schema = build_schema(LINEAR_SCHEMA)
+        self.issues: Dict[str, Dict] = {}
+        self.comments: List[Dict] = []
+        self.requests = 0
+        self.errors = 0
+        self._clock = itertools.count()
+        for issue in backlog_issues(backlog_size, seed):
+            for team_id, keyword in self.teams.items():
+                if keyword in issue["title"]:
+                    issue["teamId"] = team_id
+            self._create(issue)
+
+    def _now(self) -> str:
+        # Strictly increasing timestamps, so incremental syncs are exact
+        start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        moment = start + datetime.timedelta(milliseconds=next(self._clock))
+        return moment.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+    def _create(self, values: Dict) -> Dict:
+        issue_id = values.get("id") or str(uuid.uuid4())
+        if issue_id in self.issues:
+            raise ValueError(f"Entity {issue_id} already exists")
+        self.issues[issue_id] = {
+            "id": issue_id,
+            "title": values["title"],
+            "description": values.get("description"),
+            "updatedAt": self._now(),
+            "archivedAt": None,
+            "teamId": values.get("teamId"),
+        }
+        return self.issues[issue_id]
+
+    def _team(self, info, id):
+        def issues(
+            info,
+            first=50,
+            after=None,
+            filter=None,
+            includeArchived=False,
+            orderBy=None,
+        ):
+            nodes = sorted(self.issues.values(), key=lambda issue: issue["updatedAt"])
+            nodes = [issue for issue in nodes if issue["teamId"] in (None, id)]
+            if not includeArchived:
+                nodes = [issue for issue in nodes if not issue["archivedAt"]]
+            updated = (filter or {}).get("updatedAt") or {}
+            if updated.get("gt"):
+                nodes = [i for i in nodes if i["updatedAt"] > updated["gt"]]
+            if updated.get("gte"):
+                nodes = [i for i in nodes if i["updatedAt"] >= updated["gte"]]
+            start = int(after) if after else 0
+            return {
+                "nodes": nodes[start : start + first],
+                "pageInfo": {
+                    "hasNextPage": start + first < len(nodes),
+                    "endCursor": str(start + first),
+                },
+            }
+
+        return {"id": id, "issues": issues}
+
+    def _issue_update(self, info, id, input):
+        if id not in self.issues:
+            raise ValueError(f"Entity {id} not found")
+        self.issues[id].update(input)
+        self.issues[id]["updatedAt"] = self._now()
+        return {"success": True, "issue": self.issues[id]}
+
+    def _comment_create(self, info, input):
+        if input["issueId"] not in self.issues:
+            raise ValueError(f"Entity {input['issueId']} not found")
+        comment = {**input, "id": input.get("id") or str(uuid.uuid4())}
+        if any(existing["id"] == comment["id"] for existing in self.comments):
+            raise ValueError(f"Entity {comment['id']} already exists")
+        self.comments.append(comment)
+        return {"success": True, "comment": comment}
+
+    def _comment(self, info, id):
+        for comment in self.comments:
+            if comment["id"] == id:
+                return comment
+        raise ValueError(f"Entity {id} not found")
+
+    def _issue(self, info, id):
+        if id not in self.issues:
+            raise ValueError(f"Entity {id} not found")
+        return self.issues[id]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await _simulate_latency(self.rng, self.latency)
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            if self.rng.random() < 0.5:
+                return web.json_response(
+                    {
+                        "errors": [
+                            {
+                                "message": "Rate limit exceeded",
+                                "extensions": {"code": "RATELIMITED"},
+                            }
+                        ]
+                    },
+                    status=400,
+                )
+            return web.Response(status=503, text="Service unavailable")
+
+        body = await request.json()
+        root = {
+            "issue": self._issue,
+            "team": self._team,
+            "comment": self._comment,
+            "issueCreate": lambda info, input: {
+                "success": True,
+                "issue": self._create(input),
+            },
+            "issueUpdate": self._issue_update,
+            "commentCreate": self._comment_create,
+        }
+        result = await graphql(
+            self.schema,
+            body["query"],
+            root_value=root,
+            variable_values=body.get("variables"),
+            operation_name=body.get("operationName"),
+        )
+        response = {"data": result.data}
+        if result.errors:
+            response["errors"] = [error.formatted for error in result.errors]
+        return web.json_response(response, headers={"X-Complexity": "10"})
+
+
+def _between(text: str, start: str, end: str) -> str:
+    match = re.search(re.escape(start) + r"(.*?)" + re.escape(end), text, re.DOTALL)
+    return match.group(1).strip() if match else text
+
+
+def _same_task(first: str, second: str) -> bool:
+    """Whether two titles are the same but for typos: word for word, where
+    words of four letters or more only have to be close"""
+    first, second = first.split(), second.split()
+    return len(first) == len(second) and all(
+        a == b
+        or (
+            min(len(a), len(b)) >= 4
+            and a.isalpha()
+            and b.isalpha()
+            and difflib.SequenceMatcher(None, a.lower(), b.lower()).ratio() >= 0.75
+        )
+        for a, b in zip(first, second)
+    )
+
+
+class OpenAIStub:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        model_latency: Optional[Dict[str, float]] = None,
+        uncertain_rate: float = 0.0,
+        token_latency: float = 0.0,
+        misread_rates: Optional[Dict[str, float]] = None,
+    ):
+        self.latency = latency
+        # Time to generate each completion token, on top of the time to the first
+        self.token_latency = token_latency
+        # Mean latency of particular models, e.g. a faster small model
+        self.model_latency = model_latency or {}
+        # Share of prompts the stub model gives a low confidence when asked for one
+        self.uncertain_rate = uncertain_rate
+        # Share of conversations each model misreads, confidently filing nothing
+        self.misread_rates = misread_rates or {}
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.model_requests: Dict[str, int] = {}
+        self.streams = 0
+        # Streams the client closed before the stub finished sending them
+        self.streams_cancelled = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict] = {}
+        # Inputs embedded through /v1/embeddings
+        self.embedded = 0
+        # Creation times of files and batches, which only need to be ordered
+        self._created = itertools.count(1)
+        self._file_created_at: Dict[str, int] = {}
+
+    def _title(self, model: Optional[str], conversation: str) -> Optional[str]:
+        # Every model reads the same title, but misreads are picked by a hash of
+        # the model and conversation, so each model gets different ones wrong
+        rate = self.misread_rates.get(model, 0.0)
+        if zlib.crc32(f"{model}\n{conversation}".encode()) % 1000 < rate * 1000:
+            return None
+        return task_title(conversation)
+
+    def _rank(
+        self, model: str, conversation: str, candidates: List[Tuple[str, str]]
+    ) -> Dict:
+        title = self._title(model, conversation)
+        if title is None:
+            return {"action": "ignore"}
+        for issue_id, candidate in candidates:
+            if _same_task(candidate.strip(), title):
+                return {"action": "match", "issue_id": issue_id}
+        return {
+            "action": "create",
+            "title": title,
+            "description": f"Reported in: {conversation}",
+        }
+
+    def decide(self, request: Dict) -> Tuple[Optional[str], Optional[Dict]]:
+        """Returns the tool the stub model calls and its arguments, or (None, None)
+        when it answers without calling a tool"""
+        prompt = request["messages"][-1]["content"]
+        model = request.get("model")
+        tool = (request.get("tools") or [{}])[0].get("function", {}).get("name")
+        if tool == "categorize_conversation":
+            conversation = _between(
+                prompt, "Conversation:", "Candidate existing tasks:"
+            )
+            candidates = re.findall(r"ID: (\S+)\nTitle: (.*)", prompt)
+            return tool, self._rank(model, conversation, candidates)
+        if tool == "categorize_conversations":
+            candidates = re.findall(r"ID: (\S+)\nTitle: (.*)", prompt)
+            decisions = []
+            for number, conversation in re.findall(
+                r'<conversation number="(\d+)">\n(.*?)\n</conversation>',
+                prompt,
+                re.DOTALL,
+            ):
+                decisions.append(
+                    {
+                        "conversation": int(number),
+                        **self._rank(model, conversation, candidates),
+                    }
+                )
+            return tool, {"decisions": decisions}
+        if tool == "match_issue":
+            conversation = _between(prompt, "Conversation:", ". Existing Task Title:")
+            existing = _between(
+                prompt, "Existing Task Title:", ". Existing Task Description:"
+            )
+            title = self._title(model, conversation)
+            if title is not None and _same_task(existing, title):
+                return tool, {}
+            return None, None
+        if tool == "create_issue":
+            conversation = prompt.split("Conversation:", 1)[-1].strip()
+            title = self._title(model, conversation)
+            if title is None:
+                return None, None
+            return tool, {"title": title, "description": f"Reported in: {conversation}"}
+        if tool == "route_conversation":
+            # The team whose description shares the most words with the
+            # conversation, or the first one
+            words = set(
+                re.findall(r"\w+", _between(prompt, "Conversation:", "Teams:").lower())
+            )
+            teams = re.findall(r"^\s*- (\S+): (.*)$", prompt, re.MULTILINE)
+            best = max(
+                teams,
+                key=lambda team: len(words & set(re.findall(r"\w+", team[1].lower()))),
+            )
+            return tool, {"team": best[0]}
+        return None, None
+
+    def _confidence(self, request: Dict) -> float:
+        # Decided by the prompt, so a rerun is as (un)sure as the first run
+        prompt = request["messages"][-1]["content"]
+        uncertain = zlib.crc32(prompt.encode()) % 1000 < self.uncertain_rate * 1000
+        return 0.5 if uncertain else 0.95
+
+    def complete(self, request: Dict) -> Dict:
+        model = request.get("model")
+        self.model_requests[model] = self.model_requests.get(model, 0) + 1
+        tool, arguments = self.decide(request)
+        parameters = (
+            (request.get("tools") or [{}])[0].get("function", {}).get("parameters", {})
+        )
+        if arguments is not None and "confidence" in parameters.get("properties", {}):
+            arguments["confidence"] = self._confidence(request)
+        message = {"role": "assistant", "content": None, "tool_calls": None}
+        if tool is None:
+            message["content"] = (
+                "No task is needed, as the conversation doesn't describe a bug "
+                "report or feature request that this task should record."
+            )
+            completion_text = message["content"]
+        else:
+            completion_text = json.dumps(arguments)
+            message["tool_calls"] = [
+                {
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": tool, "arguments": completion_text},
+                }
+            ]
+        # Roughly four characters per token, like rate_limits.estimate_prompt_tokens
+        prompt_tokens = len(json.dumps(request.get("messages", []))) // 4
+        prompt_tokens += len(json.dumps(request.get("tools", []))) // 4
+        completion_tokens = len(completion_text) // 4 + 10
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": 0,
+            "model": request["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "stop" if tool is None else "tool_calls",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        await _simulate_latency(
+            self.rng, self.model_latency.get(body.get("model"), self.latency)
+        )
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            if self.rng.random() < 0.5:
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "requests"}},
+                    status=429,
+                    headers={"retry-after-ms": "100"},
+                )
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "The server had an error",
+                        "type": "server_error",
+                    }
+                },
+                status=500,
+            )
+        response = self.complete(body)
+        if body.get("stream"):
+            return await self._stream(request, body, response)
+        await asyncio.sleep(response["usage"]["completion_tokens"] * self.token_latency)
+        return web.json_response(response)
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        """Embeds each input as its words hashed into a small vector, so texts
+        sharing words come out similar"""
+        self.requests += 1
+        body = await request.json()
+        await _simulate_latency(self.rng, self.latency)
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self.embedded += len(texts)
+        data, tokens = [], 0
+        for index, text in enumerate(texts):
+            vector = [0.0] * STUB_EMBEDDING_DIMENSIONS
+            words = re.findall(r"[a-z0-9]+", text.lower())
+            for word in words:
+                vector[zlib.crc32(word.encode()) % len(vector)] += 1.0
+            tokens += len(words)
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        return web.json_response(
+            {
+                "object": "list",
+                "data": data,
+                "model": body.get("model"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        )
+
+    async def _stream(
+        self, request: web.Request, body: Dict, response: Dict
+    ) -> web.StreamResponse:
+        """Sends the completion as server-sent chunks of about a token each"""
+        self.streams += 1
+        stream = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await stream.prepare(request)
+        message = response["choices"][0]["message"]
+        base = {
+            "id": response["id"],
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": response["model"],
+        }
+
+        def chunk(delta: Dict, finish_reason: Optional[str] = None) -> Dict:
+            return {
+                **base,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+
+        chunks = [chunk({"role": "assistant", "content": ""})]
+        if message["tool_calls"]:
+            call = message["tool_calls"][0]
+            chunks.append(
+                chunk(
+                    {
+                        "tool_calls": [
+                            {
+                                "index": 0,
+                                "id": call["id"],
+                                "type": "function",
+                                "function": {
+                                    "name": call["function"]["name"],
+                                    "arguments": "",
+                                },
+                            }
+                        ]
+                    }
+                )
+            )
+            text = call["function"]["arguments"]
+        else:
+            text = message["content"]
+        # Roughly four characters per token, as in complete()
+        for i in range(0, len(text), 4):
+            piece = text[i : i + 4]
+            if message["tool_calls"]:
+                delta = {"tool_calls": [{"index": 0, "function": {"arguments": piece}}]}
+            else:
+                delta = {"content": piece}
+            chunks.append(chunk(delta))
+        chunks.append(chunk({}, response["choices"][0]["finish_reason"]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunks.append({**base, "choices": [], "usage": response["usage"]})
+        try:
+            for i, data in enumerate(chunks):
+                if i > 1:
+                    await asyncio.sleep(self.token_latency)
+                await stream.write(f"data: {json.dumps(data)}\n\n".encode())
+            await stream.write(b"data: [DONE]\n\n")
+            await stream.write_eof()
+        except (ConnectionResetError, asyncio.CancelledError):
+            self.streams_cancelled += 1
+            raise
+        return stream
+
+    async def upload_file(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        content = form["file"].file.read()
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self.files[file_id] = content
+        self._file_created_at[file_id] = next(self._created)
+        return web.json_response(self._file(file_id, form.get("purpose", "batch")))
+
+    def _file(self, file_id: str, purpose: str) -> Dict:
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(self.files[file_id]),
+            "created_at": self._file_created_at.get(file_id, 0),
+            "filename": f"{file_id}.jsonl",
+            "purpose": purpose,
+            "status": "processed",
+        }
+
+    async def retrieve_file(self, request: web.Request) -> web.Response:
+        return web.json_response(self._file(request.match_info["file_id"], "batch"))
+
+    async def file_content(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.files[request.match_info["file_id"]])
+
+    async def create_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "in_progress",
+            "created_at": next(self._created),
+            "output_file_id": None,
+        }
+        return web.json_response(self.batches[batch_id])
+
+    async def list_batches(self, request: web.Request) -> web.Response:
+        # Newest first, in a single page
+        batches = sorted(
+            self.batches.values(), key=lambda batch: batch["created_at"], reverse=True
+        )
+        return web.json_response({"object": "list", "data": batches, "has_more": False})
+
+    async def retrieve_batch(self, request: web.Request) -> web.Response:
+        batch = self.batches[request.match_info["batch_id"]]
+        if batch["status"] == "in_progress":
+            # Batches finish the first time they're polled
+            results = []
+            for line in self.files[batch["input_file_id"]].decode().splitlines():
+                if line.strip():
+                    item = json.loads(line)
+                    results.append(
+                        {
+                            "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                            "custom_id": item["custom_id"],
+                            "response": {
+                                "status_code": 200,
+                                "body": self.complete(item["body"]),
+                            },
+                            "error": None,
+                        }
+                    )
+            output_file_id = f"file-{uuid.uuid4().hex[:12]}"
+            self.files[output_file_id] = "\n".join(map(json.dumps, results)).encode()
+            batch.update(status="completed", output_file_id=output_file_id)
+        return web.json_response(batch)
+
+
+async def start_stub_servers(
+    linear: LinearStub, openai: OpenAIStub, host: str = "127.0.0.1", port: int = 0
+) -> Tuple[web.AppRunner, str]:
+    """Serves both stubs from one local server and returns its runner and base URL.
+    Point IntegrationContext at it with linear_url=f"{url}/graphql" and
+    openai_url=f"{url}/v1" """
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app.router.add_post("/graphql", linear.handle)
+    app.router.add_post("/v1/chat/completions", openai.chat_completions)
+    app.router.add_post("/v1/embeddings", openai.embeddings)
+    app.router.add_post("/v1/files", openai.upload_file)
+    app.router.add_get("/v1/files/{file_id}", openai.retrieve_file)
+    app.router.add_get("/v1/files/{file_id}/content", openai.file_content)
+    app.router.add_post("/v1/batches", openai.create_batch)
+    app.router.add_get("/v1/batches", openai.list_batches)
+    app.router.add_get("/v1/batches/{batch_id}", openai.retrieve_batch)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}"
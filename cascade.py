@@ -0,0 +1,207 @@
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+import time
+
+# The model the cascade starts with, and the one it escalates to
+DEFAULT_MODELS = ("gpt-4o-mini", "gpt-4o")
+# A cheaper tier's answer is only kept when the model is at least this confident
+DEFAULT_MIN_CONFIDENCE = 0.8
+# Answers that change something in Linear are always confirmed by the next tier
+DEFAULT_ESCALATE_ACTIONS = ("match", "create")
+# USD per million prompt and completion tokens
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+# Builds the chat completion parameters for a model, asking it for a confidence
+# when the flag is set
+RequestBuilder = Callable[[str, bool], Dict]
+# Turns a response into the result, the action it stands for, and the model's
+# confidence (None when it didn't give one)
+ResponseParser = Callable[[Any], Tuple[Any, str, Optional[float]]]
+# Sends the chat completion parameters through the context and returns the
+# response, e.g. streaming it when the context streams
+Completer = Callable[[Any, Dict], Awaitable[Any]]
+
+
+class ModelCascade:
+    """Asks the cheapest model first and only escalates to the next one when the
+    answer is not confident enough or would change something in Linear.
+
+    Every tier but the last is asked for a confidence between 0 and 1 along with
+    its answer. The answer is kept if its action isn't in `escalate_actions` and
+    the confidence is at least that tier's `min_confidence`; otherwise the same
+    question goes to the next tier. An answer without a confidence, like a
+    declined tool call, is never confident enough. The last tier's answer is
+    always kept, and a tier that fails outright escalates too.
+
+    Give it to the context as `IntegrationContext(cascade=ModelCascade())`, and
+    every ranking and per-issue check goes through it. `stats()` reports the
+    calls, latency, tokens and cost of each tier.
+    """
+
+    def __init__(
+        self,
+        models: Sequence[str] = DEFAULT_MODELS,
+        min_confidence: Union[float, Sequence[float]] = DEFAULT_MIN_CONFIDENCE,
+        escalate_actions: Sequence[str] = DEFAULT_ESCALATE_ACTIONS,
+        prices: Optional[Dict[str, Tuple[float, float]]] = None,
+    ):
+        if not models:
+            raise ValueError("A cascade needs at least one model")
+        if isinstance(min_confidence, (int, float)):
+            min_confidence = [min_confidence] * (len(models) - 1)
+        if len(min_confidence) != len(models) - 1:
+            raise ValueError(
+                f"Expected {len(models) - 1} confidence thresholds for {len(models)} models"
+            )
+        self.models = list(models)
+        self.min_confidence = list(min_confidence)
+        self.escalate_actions = set(escalate_actions)
+        self.prices = prices if prices is not None else MODEL_PRICES
+        self.decisions = 0
+        self.seconds = 0.0
+        self.tiers: List[Dict] = [
+            {
+                "model": model,
+                "calls": 0,
+                "accepted": 0,
+                "escalated": 0,
+                "errors": 0,
+                "seconds": 0.0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+            }
+            for model in self.models
+        ]
+
+    async def decide(
+        self,
+        ctx,
+        build: RequestBuilder,
+        parse: ResponseParser,
+        complete: Optional[Completer] = None,
+    ) -> Any:
+        """Runs one question up the cascade and returns the result of the first
+        tier whose answer is kept. Each tier is asked through `complete`, or
+        ctx.chat_completion() without it"""
+        started = time.perf_counter()
+        self.decisions += 1
+        try:
+            for tier in range(len(self.models)):
+                last = tier == len(self.models) - 1
+                result, accepted = await self._ask(
+                    ctx, tier, build, parse, complete, last
+                )
+                if accepted:
+                    return result
+        finally:
+            self.seconds += time.perf_counter() - started
+
+    async def _ask(
+        self,
+        ctx,
+        tier: int,
+        build: RequestBuilder,
+        parse: ResponseParser,
+        complete: Optional[Completer],
+        last: bool,
+    ) -> Tuple[Any, bool]:
+        stats = self.tiers[tier]
+        stats["calls"] += 1
+        started = time.perf_counter()
+        try:
+            request = build(stats["model"], not last)
+            if complete is not None:
+                response = await complete(ctx, request)
+            else:
+                response = await ctx.chat_completion(**request)
+        except Exception:
+            stats["errors"] += 1
+            self._record(ctx, stats, "error", time.perf_counter() - started)
+            if last:
+                raise
+            return None, False
+        seconds = time.perf_counter() - started
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            stats["prompt_tokens"] += usage.prompt_tokens
+            stats["completion_tokens"] += usage.completion_tokens
+
+        result, action, confidence = parse(response)
+        # A declined tool call comes without a confidence, so it can't tell a
+        # sure "no" from a guess and goes up like any other unsure answer
+        accepted = last or (
+            action not in self.escalate_actions
+            and confidence is not None
+            and confidence >= self.min_confidence[tier]
+        )
+        stats["accepted" if accepted else "escalated"] += 1
+        self._record(ctx, stats, "accepted" if accepted else "escalated", seconds)
+        return result, accepted
+
+    def _record(self, ctx, stats: Dict, result: str, seconds: float) -> None:
+        stats["seconds"] += seconds
+        if ctx.metrics is not None:
+            ctx.metrics.inc(
+                "cascade_answers_total", model=stats["model"], result=result
+            )
+            ctx.metrics.observe(
+                "cascade_tier_duration_seconds", seconds, model=stats["model"]
+            )
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        """USD for the tokens at the model's price, or NaN for unknown models"""
+        if model not in self.prices:
+            return float("nan")
+        prompt_price, completion_price = self.prices[model]
+        return (
+            prompt_tokens * prompt_price + completion_tokens * completion_price
+        ) / 1e6
+
+    def stats(self) -> Dict:
+        tiers = []
+        for stats in self.tiers:
+            cost = self.cost(
+                stats["model"], stats["prompt_tokens"], stats["completion_tokens"]
+            )
+            tiers.append(
+                {
+                    **{key: value for key, value in stats.items() if key != "seconds"},
+                    "mean_seconds": (
+                        round(stats["seconds"] / stats["calls"], 4)
+                        if stats["calls"]
+                        else 0
+                    ),
+                    "cost_usd": round(cost, 6),
+                }
+            )
+        cost = sum(tier["cost_usd"] for tier in tiers)
+        first = self.tiers[0]
+        return {
+            "decisions": self.decisions,
+            # Share of decisions the first model didn't settle on its own
+            "escalation_rate": (
+                round((first["escalated"] + first["errors"]) / self.decisions, 4)
+                if self.decisions
+                else 0
+            ),
+            "mean_seconds": (
+                round(self.seconds / self.decisions, 4) if self.decisions else 0
+            ),
+            "cost_usd": round(cost, 6),
+            "cost_per_decision_usd": (
+                round(cost / self.decisions, 8) if self.decisions else 0
+            ),
+            "tiers": tiers,
+        }
@@ -0,0 +1,153 @@
+from typing import Dict, Iterable, List, Tuple, Union
+import asyncio
+
+import numpy as np
+
+from integration_context import IntegrationContext
+from issue_index import HashingEmbedder
+from main import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_TOP_K,
+    attach_to_outcome,
+    categorize_conversations,
+    remember_outcome,
+)
+
+# Cosine similarity at or above which a conversation joins a cluster. With
+# HashingEmbedder, the same complaint about two different platforms scores around
+# 0.93, so this errs on the side of keeping distinct problems apart. Semantic
+# embeddings (OpenAIEmbedder) group paraphrases, and usually want a lower threshold
+DEFAULT_CLUSTER_THRESHOLD = 0.95
+# Conversations are embedded and compared to the clusters this many at a time
+_CHUNK_SIZE = 1024
+
+
+def cluster_conversations(
+    conversations: List[str],
+    embedder=None,
+    threshold: float = DEFAULT_CLUSTER_THRESHOLD,
+) -> Tuple[List[int], List[float]]:
+    """Greedy single-pass clustering: each conversation joins the most similar
+    earlier representative if it's at least `threshold` similar, and becomes the
+    representative of a new cluster otherwise. Returns, for each conversation, the
+    position of its cluster's representative and its similarity to it"""
+    embedder = embedder if embedder is not None else HashingEmbedder()
+    representatives = [0] * len(conversations)
+    similarities = [1.0] * len(conversations)
+    leader_positions: List[int] = []
+    leaders = None
+    for start in range(0, len(conversations), _CHUNK_SIZE):
+        vectors = embedder.embed(conversations[start : start + _CHUNK_SIZE])
+        # One matrix product against the clusters that existed before this chunk,
+        # then the chunk's own new clusters are compared one at a time
+        known = vectors @ leaders.T if leaders is not None else None
+        new_leaders: List[int] = []
+        for offset, vector in enumerate(vectors):
+            best_position, best_similarity = None, threshold
+            if known is not None:
+                j = int(np.argmax(known[offset]))
+                if known[offset, j] >= best_similarity:
+                    best_position, best_similarity = (
+                        leader_positions[j],
+                        known[offset, j],
+                    )
+            if new_leaders:
+                chunk_similarities = vectors[new_leaders] @ vector
+                j = int(np.argmax(chunk_similarities))
+                if chunk_similarities[j] >= best_similarity:
+                    best_position = start + new_leaders[j]
+                    best_similarity = chunk_similarities[j]
+            position = start + offset
+            if best_position is None:
+                new_leaders.append(offset)
+                best_position, best_similarity = position, 1.0
+            representatives[position] = best_position
+            similarities[position] = round(float(best_similarity), 4)
+        if new_leaders:
+            leader_positions.extend(start + offset for offset in new_leaders)
+            leaders = (
+                vectors[new_leaders]
+                if leaders is None
+                else np.vstack([leaders, vectors[new_leaders]])
+            )
+    return representatives, similarities
+
+
+async def attach_member(
+    ctx: IntegrationContext,
+    conversation: str,
+    representative: int,
+    similarity: float,
+    representative_outcome: Dict,
+) -> Dict:
+    """Files a cluster member the way its representative was filed"""
+    outcome = await attach_to_outcome(
+        ctx,
+        conversation,
+        representative_outcome,
+        {"clustered": True, "representative": representative, "similarity": similarity},
+    )
+    return remember_outcome(ctx, conversation, outcome)
+
+
+async def categorize_clustered(
+    conversations: Iterable[str],
+    ctx: IntegrationContext,
+    matching_mode: str = "ranked",
+    top_k: int = DEFAULT_TOP_K,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    embedder=None,
+    threshold: float = DEFAULT_CLUSTER_THRESHOLD,
+) -> List[Union[Dict, Exception]]:
+    """Categorizes a batch of conversations by clustering them first and only
+    categorizing one representative per cluster. The other members are recorded as
+    mentions of the representative's task (or ignored along with it), so OpenAI
+    calls scale with the number of distinct problems rather than conversations, and
+    members never race each other to create the same task.
+
+    Returns one result per conversation, in input order, like
+    categorize_conversations. Members of a cluster whose representative failed get
+    the representative's exception."""
+    conversations = list(conversations)
+    representatives, similarities = await asyncio.to_thread(
+        cluster_conversations, conversations, embedder, threshold
+    )
+    leader_positions = sorted(set(representatives))
+    leader_results = await categorize_conversations(
+        [conversations[i] for i in leader_positions],
+        ctx,
+        matching_mode,
+        top_k,
+        concurrency,
+    )
+    results: Dict[int, Union[Dict, Exception]] = dict(
+        zip(leader_positions, leader_results)
+    )
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def attach(position: int) -> None:
+        representative_result = results[representatives[position]]
+        if isinstance(representative_result, Exception):
+            results[position] = representative_result
+            return
+        async with semaphore:
+            try:
+                results[position] = await attach_member(
+                    ctx,
+                    conversations[position],
+                    representatives[position],
+                    similarities[position],
+                    representative_result,
+                )
+            except Exception as e:
+                results[position] = e
+
+    await asyncio.gather(
+        *(
+            attach(position)
+            for position in range(len(conversations))
+            if representatives[position] != position
+        )
+    )
+    return [results[position] for position in range(len(conversations))]
@@ -0,0 +1,211 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import re
+
+from constants import OPENAI_MODEL
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULT_CONVERSATION_TOKENS = 1500
+DEFAULT_DESCRIPTION_TOKENS = 200
+# Compacted descriptions kept, least recently used first out
+DEFAULT_MAX_DESCRIPTIONS = 4096
+# Share of a truncated conversation's budget kept from its beginning, which is where
+# the user usually describes their problem. The rest is kept from the end
+HEAD_SHARE = 0.7
+TRUNCATION_MARKER = " [...] "
+
+# Agent sentences made up of nothing but these are pleasantries. Apologies and
+# thanks for a suggestion aren't here: they're how the agent confirms a bug report
+# or a feature request
+_PLEASANTRY = (
+    r"(hi|hello|hey)( there)?|"
+    r"(thanks?|thank you)( so much| very much)?"
+    r"( for (reaching out|contacting us|your patience|waiting))?|"
+    r"(you'?re|you are) (very )?welcome|"
+    r"(i'?m |we'?re |i am |we are )?(happy|glad) (to|i could|we could) help|"
+    r"(is there )?anything else (i|we) can (help( you)? with|do( for you)?)|"
+    r"have a (great|nice|good|wonderful) (day|evening|weekend)|"
+    r"(i |we )?hope (this|that) helps"
+)
+AGENT_BOILERPLATE = re.compile(
+    rf"\W*({_PLEASANTRY})(\W+({_PLEASANTRY}))*\W*", re.IGNORECASE
+)
+_TURN_TAG = re.compile(r"\[(User|Agent)\]:\s*")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+class Tokenizer:
+    """Counts and truncates tokens with tiktoken's encoding for `model`. Without
+    tiktoken (or its encoding files, which are downloaded on first use) it falls
+    back to roughly four characters per token"""
+
+    def __init__(self, model: str = OPENAI_MODEL):
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except Exception:
+                self.encoding = None
+
+    def count(self, text: str) -> int:
+        if self.encoding is None:
+            return (len(text) + 3) // 4
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def head(self, text: str, max_tokens: int) -> str:
+        if self.encoding is None:
+            return text[: max_tokens * 4]
+        tokens = self.encoding.encode(text, disallowed_special=())
+        return self.encoding.decode(tokens[:max_tokens])
+
+    def tail(self, text: str, max_tokens: int) -> str:
+        if max_tokens <= 0:
+            return ""
+        if self.encoding is None:
+            return text[-max_tokens * 4 :]
+        tokens = self.encoding.encode(text, disallowed_special=())
+        return self.encoding.decode(tokens[-max_tokens:])
+
+
+def parse_turns(conversation: str) -> List[Tuple[str, str]]:
+    """Splits a `[User]: ... [Agent]: ...` transcript into (speaker, text) turns.
+    A transcript without speaker tags is returned as a single turn with no speaker"""
+    parts = _TURN_TAG.split(conversation)
+    if len(parts) == 1:
+        return [("", conversation.strip())]
+    turns = []
+    if parts[0].strip():
+        turns.append(("", parts[0].strip()))
+    for speaker, text in zip(parts[1::2], parts[2::2]):
+        # Turns are written as quoted strings separated by commas
+        text = text.strip().rstrip(",").strip()
+        if len(text) >= 2 and text[0] == text[-1] and text[0] in "'\"":
+            text = text[1:-1]
+        turns.append((speaker, text.strip()))
+    return turns
+
+
+def format_turns(turns: List[Tuple[str, str]]) -> str:
+    return "\n".join(
+        f"[{speaker}]: {text}" if speaker else text for speaker, text in turns
+    )
+
+
+def strip_agent_boilerplate(turns: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """Drops agent sentences that are nothing but pleasantries (greetings, thanks
+    for waiting, sign-offs), and agent turns that were nothing but"""
+    stripped = []
+    for speaker, text in turns:
+        if speaker == "Agent":
+            text = " ".join(
+                sentence
+                for sentence in _SENTENCE_END.split(text)
+                if not AGENT_BOILERPLATE.fullmatch(sentence)
+            )
+            if not text:
+                continue
+        stripped.append((speaker, text))
+    return stripped
+
+
+class Compactor:
+    """Shrinks conversations and task descriptions to a token budget before they're
+    put into prompts, and keeps count of the tokens that saved.
+
+    Conversations are parsed into turns, stripped of agent boilerplate and, if still
+    over `conversation_tokens`, truncated to their beginning and end. Descriptions
+    are truncated to `description_tokens`.
+    """
+
+    def __init__(
+        self,
+        conversation_tokens: int = DEFAULT_CONVERSATION_TOKENS,
+        description_tokens: int = DEFAULT_DESCRIPTION_TOKENS,
+        model: str = OPENAI_MODEL,
+        tokenizer: Optional[Tokenizer] = None,
+        max_descriptions: int = DEFAULT_MAX_DESCRIPTIONS,
+    ):
+        self.conversation_tokens = conversation_tokens
+        self.description_tokens = description_tokens
+        self.tokenizer = tokenizer if tokenizer is not None else Tokenizer(model)
+        self.conversations = 0
+        self.conversation_tokens_in = 0
+        self.conversation_tokens_out = 0
+        self.description_tokens_saved = 0
+        # Descriptions are compacted once per candidate per conversation, so keep the
+        # most recently used `max_descriptions` of them
+        self.max_descriptions = max_descriptions
+        self._descriptions: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+
+    def compact_conversation(self, conversation: str) -> Tuple[str, int]:
+        """Returns the compacted conversation and the number of tokens saved"""
+        original_tokens = self.tokenizer.count(conversation)
+        text = format_turns(strip_agent_boilerplate(parse_turns(conversation)))
+        text = self._truncate(text, self.conversation_tokens)
+        tokens = self.tokenizer.count(text)
+        if tokens >= original_tokens:
+            text, tokens = conversation, original_tokens
+        self.conversations += 1
+        self.conversation_tokens_in += original_tokens
+        self.conversation_tokens_out += tokens
+        return text, original_tokens - tokens
+
+    def compact_description(self, description: Optional[str]) -> Tuple[str, int]:
+        """Returns the truncated description and the number of tokens saved"""
+        description = description or ""
+        if description in self._descriptions:
+            self._descriptions.move_to_end(description)
+        else:
+            original_tokens = self.tokenizer.count(description)
+            if original_tokens <= self.description_tokens:
+                self._descriptions[description] = (description, 0)
+            else:
+                text = (
+                    self.tokenizer.head(description, self.description_tokens).rstrip()
+                    + "..."
+                )
+                saved = max(0, original_tokens - self.tokenizer.count(text))
+                self._descriptions[description] = (text, saved)
+            while len(self._descriptions) > self.max_descriptions:
+                self._descriptions.popitem(last=False)
+        text, saved = self._descriptions[description]
+        self.description_tokens_saved += saved
+        return text, saved
+
+    def compact_issues(self, issues: List[Dict]) -> Tuple[List[Dict], int]:
+        """Returns copies of `issues` with compacted descriptions, and the tokens
+        saved across them"""
+        compacted, saved = [], 0
+        for issue in issues:
+            description, issue_saved = self.compact_description(
+                issue.get("description")
+            )
+            compacted.append({**issue, "description": description})
+            saved += issue_saved
+        return compacted, saved
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        if self.tokenizer.count(text) <= max_tokens:
+            return text
+        marker_tokens = self.tokenizer.count(TRUNCATION_MARKER)
+        head_tokens = int((max_tokens - marker_tokens) * HEAD_SHARE)
+        tail_tokens = max_tokens - marker_tokens - head_tokens
+        return (
+            self.tokenizer.head(text, head_tokens).rstrip()
+            + TRUNCATION_MARKER
+            + self.tokenizer.tail(text, tail_tokens).lstrip()
+        )
+
+    def stats(self) -> Dict:
+        return {
+            "conversations": self.conversations,
+            "conversation_tokens_in": self.conversation_tokens_in,
+            "conversation_tokens_out": self.conversation_tokens_out,
+            "conversation_tokens_saved": self.conversation_tokens_in
+            - self.conversation_tokens_out,
+            "description_tokens_saved": self.description_tokens_saved,
+        }
@@ -0,0 +1,157 @@
+from openai.types.chat import ChatCompletion
+from collections import OrderedDict
+from typing import Dict, Optional
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_MAX_MEMORY_ENTRIES = 1024
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL = 7 * 24 * 60 * 60
+# Checking the on-disk size on every write would be wasteful, so we only check it
+# every so many writes
+_EVICTION_CHECK_INTERVAL = 100
+
+
+def completion_key(request: Dict) -> str:
+    """Content address of a chat completion request: a hash of the model, messages,
+    tools and tool_choice, plus any other parameters (e.g. temperature) it sets"""
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """Two-tier cache of chat completions keyed on the request contents.
+
+    An in-memory LRU tier answers repeated requests in microseconds, and an optional
+    SQLite tier at `path` keeps completions across runs. Entries older than `ttl`
+    seconds are ignored, and the least recently used entries are evicted once the
+    tiers grow past `max_memory_entries` / `max_disk_bytes`.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_memory_entries: int = DEFAULT_MAX_MEMORY_ENTRIES,
+        max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES,
+        ttl: float = DEFAULT_TTL,
+    ):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._writes = 0
+        self._db = None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS completions_accessed_at
+                    ON completions (accessed_at);
+                """
+            )
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get(self, key: str) -> Optional[ChatCompletion]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None and now - entry[1] <= self.ttl:
+            self._memory.move_to_end(key)
+            return self._hit(entry[0])
+
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT response, created_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] <= self.ttl:
+                with self._db:
+                    self._db.execute(
+                        "UPDATE completions SET accessed_at = ? WHERE key = ?",
+                        (now, key),
+                    )
+                response = ChatCompletion.model_validate_json(row[0])
+                self._remember(key, response, row[1])
+                return self._hit(response)
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, response: ChatCompletion) -> None:
+        now = time.time()
+        self._remember(key, response, now)
+        if self._db is None:
+            return
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, response.model_dump_json(), now, now),
+            )
+        self._writes += 1
+        if self._writes % _EVICTION_CHECK_INTERVAL == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """Drops expired entries, then the least recently used ones until the SQLite
+        tier fits in `max_disk_bytes`"""
+        if self._db is None:
+            return
+        with self._db:
+            self._db.execute(
+                "DELETE FROM completions WHERE created_at < ?",
+                (time.time() - self.ttl,),
+            )
+            size, count = self._db.execute(
+                "SELECT COALESCE(SUM(LENGTH(response)), 0), COUNT(*) FROM completions"
+            ).fetchone()
+            if size > self.max_disk_bytes and count:
+                # Assume similar sized entries and drop enough of the oldest ones
+                excess = int(count * (1 - self.max_disk_bytes / size)) + 1
+                self._db.execute(
+                    """
+                    DELETE FROM completions WHERE key IN (
+                        SELECT key FROM completions ORDER BY accessed_at LIMIT ?
+                    )
+                    """,
+                    (excess,),
+                )
+
+    def _remember(self, key: str, response: ChatCompletion, created_at: float) -> None:
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _hit(self, response: ChatCompletion) -> ChatCompletion:
+        self.hits += 1
+        if response.usage is not None:
+            self.saved_prompt_tokens += response.usage.prompt_tokens
+            self.saved_completion_tokens += response.usage.completion_tokens
+        return response
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_prompt_tokens": self.saved_prompt_tokens,
+            "saved_completion_tokens": self.saved_completion_tokens,
+        }
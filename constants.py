@@ -1,8 +1,21 @@
+import os
+
 LINEAR_TEAM_ID = "a409ee5a-1f47-4e5f-bf16-332272fefacf"
 
+LINEAR_API_URL = "https://api.linear.app/graphql"
+
+OPENAI_MODEL = "gpt-4o"
+
+
 # Reading from text files from now to avoid pushing these keys...
-with open("openai_key.txt") as f:
-    OPENAI_KEY = f.read().strip("\n")
+# The environment variables take precedence, e.g. for the benchmarks' stub servers
+def _read_key(env_var: str, path: str) -> str:
+    if os.environ.get(env_var):
+        return os.environ[env_var]
+    with open(path) as f:
+        return f.read().strip("\n")
+
+
+OPENAI_KEY = _read_key("OPENAI_API_KEY", "openai_key.txt")
 
-with open("linear_key.txt") as f:
-    LINEAR_KEY = f.read().strip("\n")
+LINEAR_KEY = _read_key("LINEAR_API_KEY", "linear_key.txt")
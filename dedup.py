@@ -0,0 +1,181 @@
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import json
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_NUM_PERM = 128
+DEFAULT_BANDS = 32
+SHINGLE_SIZE = 3
+
+
+def normalize_conversation(conversation: str) -> str:
+    """Lowercases, drops punctuation and collapses whitespace and digits, so trivially
+    different copies of a transcript normalize to the same text"""
+    text = conversation.lower()
+    text = re.sub(r"\d+", "0", text)
+    # "can't" and "cant" are the same word
+    text = re.sub(r"['\u2019]", "", text)
+    text = re.sub(r"[^a-z0\s]+", " ", text)
+    return " ".join(text.split())
+
+
+def exact_fingerprint(normalized: str) -> str:
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def _shingles(normalized: str) -> List[str]:
+    words = normalized.split()
+    if len(words) <= SHINGLE_SIZE:
+        return [" ".join(words)]
+    return [
+        " ".join(words[i : i + SHINGLE_SIZE])
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    ]
+
+
+class MinHasher:
+    """MinHash signatures over word shingles, using a multiply-shift hash family
+    with fixed seeds so signatures are stable across runs"""
+
+    def __init__(self, num_perm: int = DEFAULT_NUM_PERM):
+        rng = np.random.default_rng(1)
+        self.num_perm = num_perm
+        # Multipliers must be odd for multiply-shift hashing
+        self._a = rng.integers(1, 2**63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+
+    def signature(self, normalized: str) -> np.ndarray:
+        hashes = np.array(
+            [
+                int.from_bytes(
+                    hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(),
+                    "little",
+                )
+                for s in set(_shingles(normalized))
+            ],
+            dtype=np.uint64,
+        )
+        # uint64 arithmetic wraps around, which is exactly what multiply-shift wants
+        permuted = (hashes[:, None] * self._a[None, :] + self._b[None, :]) >> np.uint64(
+            32
+        )
+        return permuted.min(axis=0)
+
+
+class DedupIndex:
+    """Remembers the outcome of every categorized conversation by fingerprint, so
+    exact and near-duplicate conversations can reuse it without any OpenAI calls.
+
+    Exact duplicates are found by a hash of the normalized conversation. Near
+    duplicates are found with MinHash signatures and banded locality sensitive
+    hashing, and accepted when their estimated Jaccard similarity is at least
+    `threshold`. Pass a `path` to persist fingerprints in SQLite across runs.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        threshold: float = DEFAULT_THRESHOLD,
+        num_perm: int = DEFAULT_NUM_PERM,
+        bands: int = DEFAULT_BANDS,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self.lookups = 0
+        self.exact_hits = 0
+        self.near_hits = 0
+        self._outcomes: Dict[str, Dict] = {}
+        self._signatures: Dict[str, np.ndarray] = {}
+        self._buckets: Dict[Tuple[int, bytes], List[str]] = {}
+        self._db = None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS fingerprints (
+                    fingerprint TEXT PRIMARY KEY,
+                    signature BLOB NOT NULL,
+                    outcome TEXT NOT NULL
+                )
+                """
+            )
+            for fingerprint, signature, outcome in self._db.execute(
+                "SELECT fingerprint, signature, outcome FROM fingerprints"
+            ):
+                self._add(
+                    fingerprint,
+                    np.frombuffer(signature, dtype=np.uint64),
+                    json.loads(outcome),
+                )
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        return [
+            (band, signature[band * self.rows : (band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def _add(self, fingerprint: str, signature: np.ndarray, outcome: Dict) -> None:
+        if fingerprint not in self._signatures:
+            for key in self._band_keys(signature):
+                self._buckets.setdefault(key, []).append(fingerprint)
+        self._signatures[fingerprint] = signature
+        self._outcomes[fingerprint] = outcome
+
+    def lookup(self, conversation: str) -> Optional[Dict]:
+        """Returns the remembered outcome of an exact or near duplicate, with the
+        `similarity` it was matched at, or None"""
+        self.lookups += 1
+        normalized = normalize_conversation(conversation)
+        fingerprint = exact_fingerprint(normalized)
+        if fingerprint in self._outcomes:
+            self.exact_hits += 1
+            return {**self._outcomes[fingerprint], "similarity": 1.0}
+
+        signature = self.hasher.signature(normalized)
+        best, best_similarity = None, 0.0
+        for key in self._band_keys(signature):
+            for candidate in self._buckets.get(key, ()):
+                similarity = float(np.mean(self._signatures[candidate] == signature))
+                if similarity > best_similarity:
+                    best, best_similarity = candidate, similarity
+        if best is None or best_similarity < self.threshold:
+            return None
+        self.near_hits += 1
+        return {**self._outcomes[best], "similarity": best_similarity}
+
+    def remember(self, conversation: str, outcome: Dict) -> None:
+        normalized = normalize_conversation(conversation)
+        fingerprint = exact_fingerprint(normalized)
+        signature = self.hasher.signature(normalized)
+        self._add(fingerprint, signature, outcome)
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)",
+                    (fingerprint, signature.tobytes(), json.dumps(outcome)),
+                )
+
+    def stats(self) -> Dict:
+        hits = self.exact_hits + self.near_hits
+        return {
+            "lookups": self.lookups,
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "hit_rate": hits / self.lookups if self.lookups else 0.0,
+        }
@@ -0,0 +1,421 @@
+from typing import Dict, List, Optional, Tuple
+import copy
+import json
+
+from constants import OPENAI_MODEL
+from integration_context import IntegrationContext
+from streaming import EarlyDecision, early_ranking_decision, stream_completion
+
+# Existing task descriptions can be arbitrarily long, so we only put the first
+# few hundred characters of each candidate into the ranking prompt
+CANDIDATE_DESCRIPTION_CHARS = 300
+
+# Mentions are counted locally and appended to the task as comments, so a match
+# only needs the model to say which task it is, not to rewrite its description
+MATCH_ISSUE_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "match_issue",
+        "description": "Records that the conversation mentions the existing task",
+        "parameters": {"type": "object", "properties": {}},
+    },
+}
+
+CREATE_ISSUE_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "create_issue",
+        "description": "Creates a new task in linear using the GraphQL API",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "title": {
+                    "type": "string",
+                    "description": "Title for the task. This title summarizes the feature request/bug report described in the conversation",
+                },
+                "description": {
+                    "type": "string",
+                    "description": "Description for the task. This description is a more length summary of the feature request/bug report described in the conversation",
+                },
+            },
+        },
+    },
+}
+
+CATEGORIZE_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "categorize_conversation",
+        "description": "Records what should happen in Linear for a customer support conversation",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "action": {
+                    "type": "string",
+                    "enum": ["match", "create", "ignore"],
+                    "description": "'match' if one of the candidate tasks already describes the issue, 'create' if the conversation describes a new bug report or feature request, 'ignore' otherwise",
+                },
+                "issue_id": {
+                    "type": "string",
+                    "description": "ID of the matching candidate task. Only set when action is 'match'",
+                },
+                "title": {
+                    "type": "string",
+                    "description": "Title of the new task. Only set when action is 'create'",
+                },
+                "description": {
+                    "type": "string",
+                    "description": "Description summarizing the bug report/feature request for the new task. Only set when action is 'create'",
+                },
+            },
+            "required": ["action"],
+        },
+    },
+}
+
+
+CATEGORIZE_BATCH_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "categorize_conversations",
+        "description": "Records what should happen in Linear for each of several customer support conversations",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "decisions": {
+                    "type": "array",
+                    "description": "One decision per conversation",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "conversation": {
+                                "type": "integer",
+                                "description": "Number of the conversation this decision is for",
+                            },
+                            **CATEGORIZE_TOOL["function"]["parameters"]["properties"],
+                        },
+                        "required": ["conversation", "action"],
+                    },
+                }
+            },
+            "required": ["decisions"],
+        },
+    },
+}
+
+
+# Asked of every model in a cascade but the last, so it knows when to escalate
+CONFIDENCE_PROPERTY = {
+    "type": "number",
+    "description": "How confident you are in this answer, from 0 (guessing) to 1 (certain)",
+}
+
+
+def with_confidence(tool: Dict) -> Dict:
+    """A copy of the tool that also requires a confidence"""
+    tool = copy.deepcopy(tool)
+    parameters = tool["function"]["parameters"]
+    parameters["properties"]["confidence"] = CONFIDENCE_PROPERTY
+    parameters["required"] = parameters.get("required", []) + ["confidence"]
+    return tool
+
+
+def format_candidates(
+    candidates: List[Dict], max_description_chars: int = CANDIDATE_DESCRIPTION_CHARS
+) -> str:
+    if not candidates:
+        return "(there are no existing tasks)"
+    lines = []
+    for issue in candidates:
+        description = issue.get("description") or ""
+        if len(description) > max_description_chars:
+            description = description[:max_description_chars].rstrip() + "..."
+        lines.append(
+            f"ID: {issue['id']}\nTitle: {issue['title']}\nDescription: {description}"
+        )
+    return "\n\n".join(lines)
+
+
+def _first_tool_call_args(response) -> Optional[Dict]:
+    tool_calls = response.choices[0].message.tool_calls
+    if not tool_calls:
+        return None
+    return json.loads(tool_calls[0].function.arguments)
+
+
+def ranking_request(
+    conversation: str,
+    candidates: List[Dict],
+    model: str = OPENAI_MODEL,
+    confidence: bool = False,
+) -> Dict:
+    """Chat completion parameters for rank_candidates, kept separate so the same
+    request can be sent through the Batch API"""
+    prompt = f"""You are triaging a customer support conversation into Linear tasks.
+    Conversation: {conversation}
+
+    Candidate existing tasks:
+    {format_candidates(candidates)}
+
+    If one of the candidate tasks already describes the bug report and/or feature request in the conversation, choose 'match' with that task's ID, and nothing else.
+    If the conversation describes a bug report or feature request that none of the candidate tasks describe, choose 'create' with a title and description for a new task.
+    If the conversation captures neither a feature request nor a bug report (e.g. if the Agent was able to successfully answer the User's question), choose 'ignore'.
+    """
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "tools": [with_confidence(CATEGORIZE_TOOL) if confidence else CATEGORIZE_TOOL],
+        "tool_choice": {
+            "type": "function",
+            "function": {"name": CATEGORIZE_TOOL["function"]["name"]},
+        },
+    }
+
+
+def parse_ranking(response, candidates: List[Dict]) -> Dict:
+    return _check_match(
+        _first_tool_call_args(response) or {"action": "ignore"}, candidates
+    )
+
+
+def _confidence(args: Optional[Dict]) -> Optional[float]:
+    # None when the model declined the tool, and 0 when it left out the confidence
+    if args is None:
+        return None
+    try:
+        return float(args.pop("confidence"))
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+def _parse_ranking_answer(
+    response, candidates: List[Dict]
+) -> Tuple[Dict, str, Optional[float]]:
+    args = _first_tool_call_args(response) or {"action": "ignore"}
+    confidence = _confidence(args)
+    # Escalate on the action the model chose, even if it matched an unknown ID
+    return _check_match(dict(args), candidates), args.get("action"), confidence
+
+
+def _check_match(decision: Dict, candidates: List[Dict]) -> Dict:
+    # Guard against the model inventing an ID that wasn't in the shortlist
+    if decision.get("action") == "match" and decision.get("issue_id") not in {
+        issue["id"] for issue in candidates
+    }:
+        print(
+            f"Model matched unknown task ID {decision.get('issue_id')!r}, ignoring the decision"
+        )
+        decision = {"action": "ignore"}
+    return decision
+
+
+def batch_ranking_request(conversations: List[str], candidates: List[Dict]) -> Dict:
+    """Chat completion parameters for ranking several conversations against one
+    shared list of candidate tasks, so the instructions, tool schema and
+    candidates are only sent once"""
+    numbered = "\n\n".join(
+        f'<conversation number="{n}">\n{conversation}\n</conversation>'
+        for n, conversation in enumerate(conversations, start=1)
+    )
+    prompt = f"""You are triaging {len(conversations)} customer support conversations into Linear tasks. Decide each conversation on its own.
+    Candidate existing tasks:
+    {format_candidates(candidates)}
+
+    Conversations:
+    {numbered}
+
+    Record exactly one decision per conversation, with the conversation's number.
+    If one of the candidate tasks already describes the bug report and/or feature request in a conversation, choose 'match' with that task's ID, and nothing else.
+    If a conversation describes a bug report or feature request that none of the candidate tasks describe, choose 'create' with a title and description for a new task.
+    If a conversation captures neither a feature request nor a bug report (e.g. if the Agent was able to successfully answer the User's question), choose 'ignore'.
+    """
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "tools": [CATEGORIZE_BATCH_TOOL],
+        "tool_choice": {
+            "type": "function",
+            "function": {"name": CATEGORIZE_BATCH_TOOL["function"]["name"]},
+        },
+    }
+
+
+def parse_batch_ranking(
+    response, count: int, candidates: List[Dict]
+) -> List[Optional[Dict]]:
+    """Decision for each of the `count` conversations in a batch_ranking_request,
+    or None where the model didn't give (exactly) one"""
+    decisions: List[Optional[Dict]] = [None] * count
+    seen = set()
+    for decision in (_first_tool_call_args(response) or {}).get("decisions", []):
+        number = decision.pop("conversation", None)
+        if not isinstance(number, int) or not 1 <= number <= count:
+            continue
+        if number in seen:
+            # Two answers for one conversation, so trust neither
+            decisions[number - 1] = None
+            continue
+        seen.add(number)
+        decisions[number - 1] = _check_match(decision, candidates)
+    return decisions
+
+
+async def _complete(
+    ctx: IntegrationContext, request: Dict, early: Optional[EarlyDecision] = None
+):
+    # Also how a cascade asks each of its tiers, without `early`: a decision cut
+    # short there would lose the confidence the cascade needs
+    if ctx.streaming:
+        return await stream_completion(ctx, request, early)
+    return await ctx.chat_completion(**request)
+
+
+async def rank_candidates(
+    ctx: IntegrationContext, conversation: str, candidates: List[Dict]
+) -> Dict:
+    """Decides in a single call whether the conversation matches one of the
+    candidate tasks, describes a new task, or should be ignored"""
+    if ctx.cascade is not None:
+        return await ctx.cascade.decide(
+            ctx,
+            lambda model, confidence: ranking_request(
+                conversation, candidates, model, confidence
+            ),
+            lambda response: _parse_ranking_answer(response, candidates),
+            _complete,
+        )
+    response = await _complete(
+        ctx, ranking_request(conversation, candidates), early_ranking_decision
+    )
+    return parse_ranking(response, candidates)
+
+
+def routing_request(conversation: str, teams: List[Dict]) -> Dict:
+    """Chat completion parameters for picking which of `teams` (dicts with a
+    "name" and a "description") a conversation belongs to"""
+    team_list = "\n".join(f"- {team['name']}: {team['description']}" for team in teams)
+    prompt = f"""Which team should handle the following customer support conversation?
+    Conversation: {conversation}
+
+    Teams:
+    {team_list}
+
+    Choose the team whose product or area the conversation is about.
+    """
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "tools": [
+            {
+                "type": "function",
+                "function": {
+                    "name": "route_conversation",
+                    "description": "Records which team should handle the conversation",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "team": {
+                                "type": "string",
+                                "enum": [team["name"] for team in teams],
+                            }
+                        },
+                        "required": ["team"],
+                    },
+                },
+            }
+        ],
+        "tool_choice": {"type": "function", "function": {"name": "route_conversation"}},
+    }
+
+
+def parse_routing(response) -> Optional[str]:
+    return (_first_tool_call_args(response) or {}).get("team")
+
+
+def match_request(
+    conversation: str, issue: Dict, model: str = OPENAI_MODEL, confidence: bool = False
+) -> Dict:
+    """Chat completion parameters for check_issue_match"""
+    prompt = f"""Does the following conversation describe a new bug report and/or feature request that isn't described in the following existing task?
+    Conversation: {conversation}. Existing Task Title: {issue["title"]}. Existing Task Description: {issue["description"]}.
+    If this issue is already described in the existing task, please record that the conversation mentions it.
+    If the issue described in the conversation is different from the issue described in the existing task, please do not record a mention!
+    If the conversation captures neither a feature request nor a bug report (e.g. if the Agent was able to successfully answer the User's question), please don't record a mention!
+    """
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "tools": [
+            with_confidence(MATCH_ISSUE_TOOL) if confidence else MATCH_ISSUE_TOOL
+        ],
+        "tool_choice": "auto",
+    }
+
+
+async def check_issue_match(
+    ctx: IntegrationContext, conversation: str, issue: Dict
+) -> bool:
+    """Asks whether a single existing task describes the conversation"""
+    if ctx.cascade is not None:
+
+        def parse(response) -> Tuple[bool, str, Optional[float]]:
+            args = _first_tool_call_args(response)
+            return (
+                args is not None,
+                "ignore" if args is None else "match",
+                _confidence(args),
+            )
+
+        return await ctx.cascade.decide(
+            ctx,
+            lambda model, confidence: match_request(
+                conversation, issue, model, confidence
+            ),
+            parse,
+            _complete,
+        )
+    response = await _complete(ctx, match_request(conversation, issue))
+    return _first_tool_call_args(response) is not None
+
+
+def new_issue_request(
+    conversation: str, model: str = OPENAI_MODEL, confidence: bool = False
+) -> Dict:
+    """Chat completion parameters for propose_new_issue"""
+    prompt = f"""
+    If there is a feature request or bug report described in the following conversation, please create a new task for it.
+    Otherwise, for example if the Agent was successfully able to answer a user's question, please do not create a new task!
+    Conversation: {conversation}
+    """
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "tools": [
+            with_confidence(CREATE_ISSUE_TOOL) if confidence else CREATE_ISSUE_TOOL
+        ],
+        "tool_choice": "auto",
+    }
+
+
+async def propose_new_issue(
+    ctx: IntegrationContext, conversation: str
+) -> Optional[Dict]:
+    """Asks whether the conversation warrants a new task, returning the
+    create_issue arguments if it does"""
+    if ctx.cascade is not None:
+
+        def parse(response) -> Tuple[Optional[Dict], str, Optional[float]]:
+            args = _first_tool_call_args(response)
+            confidence = _confidence(args)
+            return args, "ignore" if args is None else "create", confidence
+
+        return await ctx.cascade.decide(
+            ctx,
+            lambda model, confidence: new_issue_request(
+                conversation, model, confidence
+            ),
+            parse,
+            _complete,
+        )
+    response = await _complete(ctx, new_issue_request(conversation))
+    return _first_tool_call_args(response)
@@ -0,0 +1,423 @@
+from typing import AsyncIterator, BinaryIO, Dict, Iterable, List, Optional, Set, Tuple
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import os
+import sys
+import time
+
+from cascade import DEFAULT_MIN_CONFIDENCE, ModelCascade
+from completion_cache import CompletionCache
+from dedup import DedupIndex
+from integration_context import IntegrationContext
+from issue_cache import ISSUE_CACHE_PATH, IssueCache
+from issue_index import EMBEDDERS, ISSUE_INDEX_PATH, IssueIndex, make_embedder
+from main import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_TOP_K,
+    MATCHING_MODES,
+    categorize_stream,
+)
+from mentions import MentionCounter
+from metrics import Metrics
+from prefilter import DEFAULT_THRESHOLD, PreClassifier
+from rate_limits import RateGovernor
+from routing import (
+    DEFAULT_ROUTER_SHARE,
+    MultiTeamCategorizer,
+    TeamRouter,
+    load_teams,
+    team_context,
+    team_shares,
+)
+
+CHECKPOINT_PATH = ".cache/ingest_checkpoint.json"
+OUTCOME_LOG_PATH = "outcomes.jsonl"
+# The checkpoint is saved after this many records or this many seconds, whichever
+# comes first
+CHECKPOINT_EVERY = 100
+CHECKPOINT_INTERVAL = 5.0
+# Lines are read off the event loop in chunks of this many
+_READ_CHUNK_LINES = 256
+
+
+def open_source(source: str) -> BinaryIO:
+    """Opens a JSONL file, a gzipped one (ending in .gz), or stdin for "-" """
+    if source == "-":
+        return sys.stdin.buffer
+    if source.endswith(".gz"):
+        return gzip.open(source, "rb")
+    return open(source, "rb")
+
+
+def source_key(source: str) -> str:
+    return source if source == "-" else os.path.abspath(source)
+
+
+def parse_record(raw: bytes) -> Tuple[str, object]:
+    """Returns the conversation and (optional) ID from a JSONL line, which is either
+    a JSON string or an object with a "conversation" field"""
+    record = json.loads(raw)
+    if isinstance(record, str):
+        return record, None
+    if isinstance(record, dict) and isinstance(record.get("conversation"), str):
+        return record["conversation"], record.get("id")
+    raise ValueError('expected a string or an object with a "conversation" string')
+
+
+def record_key(record: Dict) -> str:
+    """Identifies a record by its source and its ID, or its line where it has none,
+    so the task created for it keeps the same ID however often it's retried"""
+    if record.get("id") is not None:
+        return f"{record['source']}#{record['id']}"
+    return f"{record['source']}:{record['line']}"
+
+
+def _seek(f: BinaryIO, offset: int) -> None:
+    try:
+        f.seek(offset)
+        return
+    except (OSError, io.UnsupportedOperation):
+        pass
+    # Pipes can't seek, so read our way past what was already processed
+    while offset > 0:
+        chunk = f.read(min(offset, 1 << 20))
+        if not chunk:
+            return
+        offset -= len(chunk)
+
+
+def _read_lines(f: BinaryIO, count: int) -> List[bytes]:
+    lines = []
+    for _ in range(count):
+        line = f.readline()
+        if not line:
+            break
+        lines.append(line)
+    return lines
+
+
+class Checkpoint:
+    """For each source, the byte offset (into the decompressed stream) and line
+    number up to which every record has been processed and logged"""
+
+    def __init__(self, path: str = CHECKPOINT_PATH):
+        self.path = path
+        self.positions: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.positions = json.load(f)
+
+    def position(self, source: str) -> Tuple[int, int]:
+        position = self.positions.get(source, {})
+        return position.get("offset", 0), position.get("line", 0)
+
+    def advance(self, source: str, offset: int, line: int) -> None:
+        self.positions[source] = {"offset": offset, "line": line}
+
+    def save(self) -> None:
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self.positions, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+
+
+async def read_records(
+    sources: Iterable[str], checkpoint: Checkpoint
+) -> AsyncIterator[Dict]:
+    """Streams the lines of each source from its checkpointed offset onwards"""
+    for source in sources:
+        key = source_key(source)
+        offset, line = checkpoint.position(key)
+        f = open_source(source)
+        try:
+            await asyncio.to_thread(_seek, f, offset)
+            while True:
+                lines = await asyncio.to_thread(_read_lines, f, _READ_CHUNK_LINES)
+                if not lines:
+                    break
+                for raw in lines:
+                    offset += len(raw)
+                    line += 1
+                    yield {"source": key, "line": line, "offset": offset, "raw": raw}
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+
+def _logged_since_checkpoint(log_path: str, checkpoint: Checkpoint) -> Set[Tuple]:
+    # Records that were logged after the last checkpoint was saved must not be
+    # processed again when we resume from that checkpoint
+    logged = set()
+    if not os.path.exists(log_path):
+        return logged
+    with open(log_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line can be cut short by a crash
+                continue
+            if entry["line"] > checkpoint.position(entry["source"])[1]:
+                logged.add((entry["source"], entry["line"]))
+    return logged
+
+
+async def ingest(
+    sources: Iterable[str],
+    ctx: IntegrationContext,
+    log_path: str = OUTCOME_LOG_PATH,
+    checkpoint_path: str = CHECKPOINT_PATH,
+    matching_mode: str = "ranked",
+    top_k: int = DEFAULT_TOP_K,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    categorizer: Optional[MultiTeamCategorizer] = None,
+) -> Dict[str, int]:
+    """Categorizes every conversation in `sources`, appending one JSON line per
+    conversation to `log_path` with its outcome or error. Progress is checkpointed,
+    so running it again with the same sources resumes after the last conversation
+    that was logged. Returns how many conversations ended in each action.
+
+    With a `categorizer` (already entered), conversations are routed to its teams
+    and categorized with their contexts instead of `ctx`, and the team is logged
+    with each outcome"""
+    checkpoint = Checkpoint(checkpoint_path)
+    logged = _logged_since_checkpoint(log_path, checkpoint)
+    counts: Dict[str, int] = {}
+    # Records that have been read, by sequence number, until everything up to them
+    # has been logged and the checkpoint can move past them
+    pending: Dict[int, Dict] = {}
+    finished: Set[int] = set()
+    sequence_numbers: Dict[int, int] = {}
+    read = yielded = lowest_pending = unsaved = 0
+    saved_at = time.time()
+
+    log = open(log_path, "a")
+
+    def save() -> None:
+        nonlocal unsaved, saved_at
+        log.flush()
+        os.fsync(log.fileno())
+        checkpoint.save()
+        unsaved = 0
+        saved_at = time.time()
+
+    def finish(sequence_number: int, entry: Dict = None) -> None:
+        nonlocal lowest_pending, unsaved
+        if entry is not None:
+            log.write(json.dumps(entry) + "\n")
+            action = entry["outcome"]["action"] if "outcome" in entry else "error"
+            counts[action] = counts.get(action, 0) + 1
+        finished.add(sequence_number)
+        while lowest_pending in finished:
+            record = pending.pop(lowest_pending)
+            finished.remove(lowest_pending)
+            checkpoint.advance(record["source"], record["offset"], record["line"])
+            lowest_pending += 1
+            unsaved += 1
+        if unsaved >= CHECKPOINT_EVERY or time.time() - saved_at >= CHECKPOINT_INTERVAL:
+            save()
+
+    async def conversations() -> AsyncIterator[Tuple[str, str]]:
+        nonlocal read, yielded
+        async for record in read_records(sources, checkpoint):
+            sequence_number = read
+            read += 1
+            pending[sequence_number] = record
+            already_logged = (record["source"], record["line"]) in logged
+            if already_logged or not record["raw"].strip():
+                finish(sequence_number)
+                continue
+            try:
+                conversation, record["id"] = parse_record(record.pop("raw"))
+            except ValueError as e:
+                finish(
+                    sequence_number,
+                    {
+                        "source": record["source"],
+                        "line": record["line"],
+                        "error": f"Invalid record: {e}",
+                    },
+                )
+                continue
+            # categorize_stream numbers conversations in the order we yield them
+            sequence_numbers[yielded] = sequence_number
+            yielded += 1
+            yield record_key(record), conversation
+
+    results = (
+        categorizer.categorize_stream(conversations())
+        if categorizer is not None
+        else categorize_stream(conversations(), ctx, matching_mode, top_k, concurrency)
+    )
+    try:
+        async for index, result in results:
+            sequence_number = sequence_numbers.pop(index)
+            record = pending[sequence_number]
+            entry = {"source": record["source"], "line": record["line"]}
+            if record.get("id") is not None:
+                entry["id"] = record["id"]
+            if isinstance(result, Exception):
+                entry["error"] = repr(result)
+            else:
+                entry["outcome"] = result
+            finish(sequence_number, entry)
+    finally:
+        save()
+        log.close()
+    return counts
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Categorize conversations from JSONL files (optionally gzipped) or stdin"
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        default=["-"],
+        help='JSONL files with one conversation per line, as a JSON string or an object with a "conversation" field. Defaults to stdin',
+    )
+    parser.add_argument("--log", default=OUTCOME_LOG_PATH)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--matching-mode", choices=MATCHING_MODES, default="ranked")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--batch-mutations", action="store_true")
+    parser.add_argument(
+        "--issue-cache", default=ISSUE_CACHE_PATH, help="SQLite file to cache issues in"
+    )
+    parser.add_argument(
+        "--no-issue-cache",
+        action="store_true",
+        help="List the whole backlog for every conversation instead",
+    )
+    parser.add_argument(
+        "--issue-index",
+        default=ISSUE_INDEX_PATH,
+        help="Directory of the index that shortlists --top-k candidate tasks",
+    )
+    parser.add_argument(
+        "--no-issue-index",
+        action="store_true",
+        help="Put every task in the backlog up for matching instead",
+    )
+    parser.add_argument("--embedder", choices=EMBEDDERS, default="hashing")
+    parser.add_argument("--dedup", help="SQLite file to keep fingerprints in")
+    parser.add_argument(
+        "--completion-cache", help="SQLite file to cache completions in"
+    )
+    parser.add_argument("--mentions", help="SQLite file to count mentions in")
+    parser.add_argument(
+        "--metrics", help="File to write Prometheus metrics to when the run ends"
+    )
+    parser.add_argument(
+        "--prefilter", help="Pre-classifier model trained with prefilter.py"
+    )
+    parser.add_argument("--prefilter-threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument(
+        "--cascade",
+        metavar="MODELS",
+        help="Comma separated models to try in order, e.g. gpt-4o-mini,gpt-4o",
+    )
+    parser.add_argument("--min-confidence", type=float, default=DEFAULT_MIN_CONFIDENCE)
+    parser.add_argument("--trace", action="store_true", help="Emit OpenTelemetry spans")
+    parser.add_argument(
+        "--teams",
+        help="JSON file of teams to route conversations to (see routing.py), each with its own issue cache, index, workers and rate budget. Replaces --issue-cache, --issue-index and --concurrency",
+    )
+    args = parser.parse_args()
+
+    governor = RateGovernor()
+    options = dict(
+        batch_mutations=args.batch_mutations,
+        dedup=DedupIndex(args.dedup) if args.dedup else None,
+        completion_cache=(
+            CompletionCache(args.completion_cache) if args.completion_cache else None
+        ),
+        mentions=MentionCounter(args.mentions) if args.mentions else None,
+        metrics=Metrics(tracing=args.trace) if args.metrics or args.trace else None,
+        prefilter=(
+            PreClassifier.load(args.prefilter, args.prefilter_threshold)
+            if args.prefilter
+            else None
+        ),
+        cascade=(
+            ModelCascade(args.cascade.split(","), args.min_confidence)
+            if args.cascade
+            else None
+        ),
+    )
+    categorizer = None
+    if args.teams:
+        # The router's context only asks the model about conversations keywords
+        # don't settle, so it gets a small share of the limits
+        teams = load_teams(args.teams)
+        shares = team_shares(teams, reserved=DEFAULT_ROUTER_SHARE)
+        ctx = IntegrationContext(
+            governor=governor.share(DEFAULT_ROUTER_SHARE),
+            issue_cache_path=None,
+            **options,
+        )
+        categorizer = MultiTeamCategorizer(
+            TeamRouter(teams, ctx),
+            {
+                team.name: team_context(
+                    team,
+                    governor.share(shares[team.name]),
+                    embedder=args.embedder,
+                    **options,
+                )
+                for team in teams
+            },
+            args.matching_mode,
+            args.top_k,
+        )
+    else:
+        ctx = IntegrationContext(
+            governor=governor,
+            issue_cache=None if args.no_issue_cache else IssueCache(args.issue_cache),
+            issue_cache_path=None,
+            **options,
+        )
+        if not args.no_issue_index:
+            ctx.issue_index = IssueIndex(
+                args.issue_index, make_embedder(args.embedder, ctx)
+            )
+    try:
+        async with categorizer if categorizer is not None else ctx:
+            counts = await ingest(
+                args.sources,
+                ctx,
+                log_path=args.log,
+                checkpoint_path=args.checkpoint,
+                matching_mode=args.matching_mode,
+                top_k=args.top_k,
+                concurrency=args.concurrency,
+                categorizer=categorizer,
+            )
+    finally:
+        if args.metrics:
+            ctx.metrics.write(args.metrics)
+    print(
+        "Processed "
+        + ", ".join(f"{count} {action}" for action, count in sorted(counts.items()))
+    )
+    if categorizer is not None:
+        for name, stats in categorizer.stats()["teams"].items():
+            print(f"{name}: {stats['processed']} processed, {stats['issues']} issues")
+    if ctx.cascade is not None:
+        for tier in ctx.cascade.stats()["tiers"]:
+            print(
+                f"{tier['model']}: {tier['calls']} calls, {tier['escalated']} escalated, {tier['mean_seconds']}s mean, ${tier['cost_usd']}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
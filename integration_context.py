@@ -0,0 +1,376 @@
+from openai import AsyncOpenAI
+from gql import Client, GraphQLRequest
+from gql.client import AsyncClientSession
+from gql.transport.aiohttp import AIOHTTPTransport
+from graphql import FieldNode, OperationDefinitionNode, VariableNode
+from typing import Any, Coroutine, Dict, Optional, Tuple
+import aiohttp
+import asyncio
+import json
+import os
+import time
+
+from cascade import ModelCascade
+from completion_cache import CompletionCache, completion_key
+from compaction import Compactor
+from dedup import DedupIndex
+from mentions import MentionCounter
+from metrics import Metrics, openai_operation
+from prefilter import PreClassifier
+from constants import LINEAR_API_URL, LINEAR_KEY, LINEAR_TEAM_ID, OPENAI_KEY
+from issue_cache import ISSUE_CACHE_PATH, IssueCache
+from issue_index import IssueIndex
+from linear_batcher import DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT, MutationBatcher
+from rate_limits import RateGovernor
+
+SCHEMA_CACHE_PATH = ".cache/linear_schema.json"
+# Linear's schema changes rarely, so one introspection query a day is plenty
+SCHEMA_CACHE_TTL = 24 * 60 * 60
+
+
+def load_cached_schema(path: str, ttl: float) -> Optional[Dict]:
+    """Returns the cached introspection result, or None if it's missing or stale"""
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def store_cached_schema(path: str, introspection: Dict) -> None:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(introspection, f)
+    os.replace(tmp_path, path)
+
+
+def _operation_name(request: GraphQLRequest) -> str:
+    if request.operation_name:
+        return request.operation_name
+    for definition in request.document.definitions:
+        if isinstance(definition, OperationDefinitionNode) and definition.name:
+            return definition.name.value
+    return "anonymous"
+
+
+def _is_idempotent(request: GraphQLRequest) -> bool:
+    """Queries, and mutations that only create issues with a client-chosen ID, can
+    safely be sent again when it's unclear whether they went through"""
+    variables = request.variable_values or {}
+    for definition in request.document.definitions:
+        if not isinstance(definition, OperationDefinitionNode):
+            continue
+        if definition.operation.value != "mutation":
+            continue
+        for field in definition.selection_set.selections:
+            if not isinstance(field, FieldNode) or field.name.value != "issueCreate":
+                return False
+            inputs = [a.value for a in field.arguments if a.name.value == "input"]
+            if not inputs or not isinstance(inputs[0], VariableNode):
+                return False
+            if not (variables.get(inputs[0].name.value) or {}).get("id"):
+                return False
+    return True
+
+
+async def _store_response_headers(session, trace_config_ctx, params) -> None:
+    # The trace context is the dict passed with that one request, so concurrent
+    # requests each see their own response's headers
+    if isinstance(trace_config_ctx.trace_request_ctx, dict):
+        trace_config_ctx.trace_request_ctx["headers"] = params.response.headers
+
+
+def response_headers_trace() -> aiohttp.TraceConfig:
+    """Stores each response's headers in the `trace_request_ctx` dict sent with
+    its request"""
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(_store_response_headers)
+    return trace
+
+
+class GovernedSession:
+    """Drop-in replacement for a gql AsyncClientSession that runs every request
+    through a RateGovernor, and records it in `metrics` if given. The transport's
+    ClientSession must have a response_headers_trace() so the governor sees
+    the rate limit headers of each response"""
+
+    def __init__(
+        self,
+        session: AsyncClientSession,
+        transport: AIOHTTPTransport,
+        governor: RateGovernor,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.session = session
+        self.transport = transport
+        self.governor = governor
+        self.metrics = metrics
+
+    async def execute(self, request: GraphQLRequest, **kwargs):
+        operation_name = _operation_name(request)
+        extra_args = kwargs.pop("extra_args", None) or {}
+        response = {}
+
+        async def attempt():
+            response.clear()
+            return await self.session.execute(
+                request,
+                extra_args={**extra_args, "trace_request_ctx": response},
+                **kwargs,
+            )
+
+        call = self.governor.linear_call(
+            attempt,
+            operation_name,
+            lambda: response.get("headers"),
+            idempotent=_is_idempotent(request),
+        )
+        if self.metrics is None:
+            return await call
+        started = time.perf_counter()
+        outcome = "error"
+        with self.metrics.span("linear." + operation_name):
+            try:
+                result = await call
+                outcome = "ok"
+                return result
+            finally:
+                self.metrics.record_call(
+                    "linear", operation_name, time.perf_counter() - started, outcome
+                )
+
+
+class IntegrationContext:
+    """Long-lived Linear and OpenAI clients shared across many conversations.
+
+    Both clients keep their HTTP connections alive between requests, and the Linear
+    schema is loaded once from a local file cache instead of being introspected for
+    every conversation. With `batch_mutations`, issue creates and comments from
+    concurrent conversations are sent to Linear together, and a CompletionCache
+    answers repeated OpenAI requests without calling the API. Every request goes
+    through the context's RateGovernor, which can be shared with other contexts.
+    The clients are asynchronous, so the context can be used from async code:
+
+        async with IntegrationContext() as ctx:
+            await categorize_conversations(conversations, ctx=ctx)
+
+    or from sync code, in which case it runs on its own private event loop:
+
+        with IntegrationContext() as ctx:
+            for conversation in conversations:
+                categorize_conversation(conversation, ctx=ctx)
+    """
+
+    def __init__(
+        self,
+        linear_key: str = LINEAR_KEY,
+        openai_key: str = OPENAI_KEY,
+        linear_url: str = LINEAR_API_URL,
+        openai_url: Optional[str] = None,
+        schema_cache_path: str = SCHEMA_CACHE_PATH,
+        schema_cache_ttl: float = SCHEMA_CACHE_TTL,
+        issue_cache: Optional[IssueCache] = None,
+        issue_cache_path: Optional[str] = ISSUE_CACHE_PATH,
+        issue_index: Optional[IssueIndex] = None,
+        governor: Optional[RateGovernor] = None,
+        batch_mutations: bool = False,
+        mutation_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        mutation_batch_wait: float = DEFAULT_MAX_WAIT,
+        completion_cache: Optional[CompletionCache] = None,
+        dedup: Optional[DedupIndex] = None,
+        mentions: Optional[MentionCounter] = None,
+        compactor: Optional[Compactor] = None,
+        metrics: Optional[Metrics] = None,
+        prefilter: Optional[PreClassifier] = None,
+        cascade: Optional[ModelCascade] = None,
+        streaming: bool = False,
+        team_id: str = LINEAR_TEAM_ID,
+    ):
+        self.linear_key = linear_key
+        self.openai_key = openai_key
+        self.linear_url = linear_url
+        self.openai_url = openai_url
+        self.schema_cache_path = schema_cache_path
+        self.schema_cache_ttl = schema_cache_ttl
+        # Without a cache, every conversation pages through the whole backlog, so
+        # one is kept at `issue_cache_path` unless that's None too
+        if issue_cache is None and issue_cache_path is not None:
+            issue_cache = IssueCache(issue_cache_path)
+        self.issue_cache = issue_cache
+        self.issue_index = issue_index
+        self.governor = governor if governor is not None else RateGovernor()
+        self.batch_mutations = batch_mutations
+        self.mutation_batch_size = mutation_batch_size
+        self.mutation_batch_wait = mutation_batch_wait
+        self.mutation_batcher = None
+        # A ranking_batcher.RankingBatcher, created by the "batched" matching mode on
+        # first use unless one is set beforehand
+        self.ranking_batcher = None
+        self.completion_cache = completion_cache
+        self.dedup = dedup
+        self.mentions = mentions if mentions is not None else MentionCounter()
+        self.compactor = compactor
+        self.metrics = metrics
+        self.prefilter = prefilter
+        self.cascade = cascade
+        # Stream completions and act as soon as the model has committed to an
+        # answer (see streaming.py)
+        self.streaming = streaming
+        # The Linear team whose backlog is matched against and new tasks go to
+        self.team_id = team_id
+        if metrics is not None and self.governor.metrics is None:
+            self.governor.metrics = metrics
+        self.linear = None
+        self.openai = None
+        self.sync_lock = None
+        # The loop the context was opened on, which OpenAIEmbedder sends its calls
+        # to from worker threads
+        self.event_loop = None
+        self._linear_client = None
+        self._loop = None
+
+    async def aopen(self) -> "IntegrationContext":
+        introspection = load_cached_schema(
+            self.schema_cache_path, self.schema_cache_ttl
+        )
+        transport = AIOHTTPTransport(
+            url=self.linear_url,
+            headers={"Authorization": self.linear_key},
+            client_session_args={"trace_configs": [response_headers_trace()]},
+        )
+        self._linear_client = Client(
+            transport=transport,
+            introspection=introspection,
+            fetch_schema_from_transport=introspection is None,
+        )
+        # The session keeps a single aiohttp ClientSession (and its connection pool) open
+        session = await self._linear_client.connect_async()
+        self.linear = GovernedSession(session, transport, self.governor, self.metrics)
+        if self.batch_mutations:
+            self.mutation_batcher = MutationBatcher(
+                self.linear, self.mutation_batch_size, self.mutation_batch_wait
+            )
+        if introspection is None and self._linear_client.introspection is not None:
+            store_cached_schema(
+                self.schema_cache_path, self._linear_client.introspection
+            )
+
+        # Retries are handled by the governor, so the client shouldn't retry on its own
+        # openai_url defaults to $OPENAI_BASE_URL, or OpenAI itself
+        self.openai = AsyncOpenAI(
+            api_key=self.openai_key, base_url=self.openai_url, max_retries=0
+        )
+        # Stops concurrent conversations from syncing the issue cache at the same time
+        self.sync_lock = asyncio.Lock()
+        self.event_loop = asyncio.get_running_loop()
+        return self
+
+    async def aclose(self) -> None:
+        if self.ranking_batcher is not None:
+            await self.ranking_batcher.flush()
+        if self.mutation_batcher is not None:
+            await self.mutation_batcher.flush()
+            self.mutation_batcher = None
+        if self._linear_client is not None:
+            await self._linear_client.close_async()
+            self._linear_client = None
+            self.linear = None
+        if self.openai is not None:
+            await self.openai.close()
+            self.openai = None
+        self.event_loop = None
+
+    async def __aenter__(self) -> "IntegrationContext":
+        return await self.aopen()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    def open(self) -> "IntegrationContext":
+        self._loop = asyncio.new_event_loop()
+        return self.run(self.aopen())
+
+    def close(self) -> None:
+        if self._loop is not None:
+            self.run(self.aclose())
+            self._loop.close()
+            self._loop = None
+
+    def run(self, coroutine: Coroutine) -> Any:
+        """Runs a coroutine to completion on the context's private event loop"""
+        if self._loop is None:
+            raise RuntimeError(
+                "IntegrationContext.run() needs a context opened with `with`"
+            )
+        return self._loop.run_until_complete(coroutine)
+
+    def __enter__(self) -> "IntegrationContext":
+        return self.open()
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    async def chat_completion(self, **kwargs):
+        if self.metrics is None:
+            response, _ = await self._chat_completion(kwargs)
+            return response
+        operation = openai_operation(kwargs)
+        started = time.perf_counter()
+        outcome, usage = "error", None
+        with self.metrics.span("openai." + operation, model=kwargs.get("model")):
+            try:
+                response, cached = await self._chat_completion(kwargs)
+                outcome = "cached" if cached else "ok"
+                usage = None if cached else getattr(response, "usage", None)
+                return response
+            finally:
+                self.metrics.record_call(
+                    "openai",
+                    operation,
+                    time.perf_counter() - started,
+                    outcome,
+                    usage.prompt_tokens if usage is not None else None,
+                    usage.completion_tokens if usage is not None else None,
+                )
+
+    async def create_embeddings(self, **kwargs):
+        """Creates embeddings under the governor's OpenAI limits"""
+        call = self.governor.openai_call(
+            lambda: self.openai.embeddings.with_raw_response.create(**kwargs), kwargs
+        )
+        if self.metrics is None:
+            return await call
+        started = time.perf_counter()
+        outcome, usage = "error", None
+        with self.metrics.span("openai.embeddings", model=kwargs.get("model")):
+            try:
+                response = await call
+                outcome, usage = "ok", getattr(response, "usage", None)
+                return response
+            finally:
+                self.metrics.record_call(
+                    "openai",
+                    "embeddings",
+                    time.perf_counter() - started,
+                    outcome,
+                    usage.prompt_tokens if usage is not None else None,
+                )
+
+    async def _chat_completion(self, kwargs: Dict) -> Tuple[Any, bool]:
+        # Returns the response and whether it came from the completion cache
+        if self.completion_cache is not None:
+            key = completion_key(kwargs)
+            cached = self.completion_cache.get(key)
+            if cached is not None:
+                return cached, True
+        response = await self.governor.openai_call(
+            lambda: self.openai.chat.completions.with_raw_response.create(**kwargs),
+            kwargs,
+        )
+        if self.completion_cache is not None:
+            self.completion_cache.put(key, response)
+        return response, False
@@ -0,0 +1,182 @@
+from gql import Client
+from gql.client import AsyncClientSession
+from typing import Dict, Iterable, List, Optional
+import os
+import sqlite3
+import time
+
+from linear_helpers import alist_issues, list_issues
+
+# Where IntegrationContext keeps its issue cache unless told otherwise
+ISSUE_CACHE_PATH = ".cache/issues.db"
+# How long we trust the cache before asking Linear for issues updated since the
+# last sync watermark
+DEFAULT_SYNC_INTERVAL = 60.0
+
+
+class IssueCache:
+    """Persistent SQLite cache of each team's (non-archived) issues.
+
+    The first sync for a team pages through the whole backlog. Later syncs only
+    fetch issues whose `updatedAt` is at or after the team's watermark, which is
+    the latest `updatedAt` Linear has returned to us, and skip the ones already
+    cached at that version. Reads are served from an
+    in-memory copy of the table.
+    """
+
+    def __init__(self, path: str, sync_interval: float = DEFAULT_SYNC_INTERVAL):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.sync_interval = sync_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS issues (
+                id TEXT PRIMARY KEY,
+                team_id TEXT NOT NULL,
+                title TEXT,
+                description TEXT,
+                updated_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS issues_team_id ON issues (team_id);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                team_id TEXT PRIMARY KEY,
+                watermark TEXT NOT NULL
+            );
+            """
+        )
+        self._issues: Dict[str, Dict[str, Dict]] = {}
+        self._last_synced: Dict[str, float] = {}
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _team_issues(self, team_id: str) -> Dict[str, Dict]:
+        if team_id not in self._issues:
+            rows = self._db.execute(
+                "SELECT id, title, description, updated_at FROM issues WHERE team_id = ?",
+                (team_id,),
+            )
+            self._issues[team_id] = {
+                row[0]: {
+                    "id": row[0],
+                    "title": row[1],
+                    "description": row[2],
+                    "updatedAt": row[3],
+                }
+                for row in rows
+            }
+        return self._issues[team_id]
+
+    def issues(self, team_id: str) -> List[Dict]:
+        return list(self._team_issues(team_id).values())
+
+    def get(self, team_id: str, issue_id: str) -> Optional[Dict]:
+        return self._team_issues(team_id).get(issue_id)
+
+    def watermark(self, team_id: str) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT watermark FROM sync_state WHERE team_id = ?", (team_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def upsert(self, team_id: str, issues: Iterable[Dict]) -> None:
+        """Stores created or edited issues without moving the sync watermark"""
+        cached = self._team_issues(team_id)
+        with self._db:
+            for issue in issues:
+                previous = cached.get(issue["id"], {})
+                issue = {
+                    "id": issue["id"],
+                    "title": issue.get("title"),
+                    "description": issue.get("description"),
+                    "updatedAt": issue.get("updatedAt") or previous.get("updatedAt"),
+                }
+                cached[issue["id"]] = issue
+                self._db.execute(
+                    "INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?)",
+                    (
+                        issue["id"],
+                        team_id,
+                        issue["title"],
+                        issue["description"],
+                        issue["updatedAt"],
+                    ),
+                )
+
+    def remove(self, team_id: str, issue_ids: Iterable[str]) -> None:
+        cached = self._team_issues(team_id)
+        with self._db:
+            for issue_id in issue_ids:
+                cached.pop(issue_id, None)
+                self._db.execute("DELETE FROM issues WHERE id = ?", (issue_id,))
+
+    def apply_sync(self, team_id: str, nodes: List[Dict]) -> int:
+        """Applies issue nodes returned by Linear and advances the watermark,
+        returning how many cached issues changed"""
+        cached = self._team_issues(team_id)
+        # An issue updated while we paged can come back twice, so keep its latest
+        latest: Dict[str, Dict] = {}
+        for node in nodes:
+            seen = latest.get(node["id"])
+            if seen is None or node["updatedAt"] >= seen["updatedAt"]:
+                latest[node["id"]] = node
+        removed = [
+            issue_id
+            for issue_id, node in latest.items()
+            if node.get("archivedAt") and issue_id in cached
+        ]
+        updated = [
+            node
+            for issue_id, node in latest.items()
+            if not node.get("archivedAt")
+            and (cached.get(issue_id) or {}).get("updatedAt") != node["updatedAt"]
+        ]
+        self.remove(team_id, removed)
+        self.upsert(team_id, updated)
+        watermark = max(
+            [node["updatedAt"] for node in nodes] + [self.watermark(team_id) or ""]
+        )
+        if watermark:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+                    (team_id, watermark),
+                )
+        self._last_synced[team_id] = time.monotonic()
+        return len(removed) + len(updated)
+
+    def needs_sync(self, team_id: str) -> bool:
+        last_synced = self._last_synced.get(team_id)
+        return (
+            last_synced is None or time.monotonic() - last_synced >= self.sync_interval
+        )
+
+    def sync(self, client: Client, team_id: str, force: bool = False) -> int:
+        """Brings the team's cached issues up to date, returning how many of them
+        changed"""
+        if not force and not self.needs_sync(team_id):
+            return 0
+        watermark = self.watermark(team_id)
+        # Incremental syncs include archived issues so we can drop them from the cache
+        nodes = list_issues(
+            client,
+            team_id,
+            updated_after=watermark,
+            include_archived=watermark is not None,
+        )
+        return self.apply_sync(team_id, nodes)
+
+    async def sync_async(
+        self, session: AsyncClientSession, team_id: str, force: bool = False
+    ) -> int:
+        if not force and not self.needs_sync(team_id):
+            return 0
+        watermark = self.watermark(team_id)
+        nodes = await alist_issues(
+            session,
+            team_id,
+            updated_after=watermark,
+            include_archived=watermark is not None,
+        )
+        return self.apply_sync(team_id, nodes)
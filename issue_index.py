@@ -0,0 +1,263 @@
+from typing import Dict, Iterable, List
+import asyncio
+import hashlib
+import math
+import os
+import re
+import threading
+
+import numpy as np
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Where the command line tools keep their index unless told otherwise
+ISSUE_INDEX_PATH = ".cache/issue_index"
+EMBEDDERS = ("hashing", "openai")
+
+
+def issue_text(issue: Dict) -> str:
+    return f"{issue.get('title') or ''}\n{issue.get('description') or ''}"
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def lexical_shortlist(text: str, issues: List[Dict], k: int) -> List[Dict]:
+    """The k issues sharing the most words with the text, rarer words counting
+    for more (by their inverse document frequency among the issues). A cheap
+    stand-in for an IssueIndex, with nothing to build or store"""
+    if len(issues) <= k:
+        return issues
+    words = set(_words(text))
+    shared = [words.intersection(_words(issue_text(issue))) for issue in issues]
+    frequencies: Dict[str, int] = {}
+    for issue_words in shared:
+        for word in issue_words:
+            frequencies[word] = frequencies.get(word, 0) + 1
+    scores = [
+        sum(math.log(len(issues) / frequencies[word]) for word in issue_words)
+        for issue_words in shared
+    ]
+    top = sorted(range(len(issues)), key=lambda i: -scores[i])[:k]
+    return [issues[i] for i in top]
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+class HashingEmbedder:
+    """Deterministic, dependency free embedder based on feature hashing of words
+    and word bigrams. Good enough to shortlist issues offline and in tests"""
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = _words(text)
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                h = int.from_bytes(
+                    hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(),
+                    "little",
+                )
+                matrix[row, h % self.dimensions] += 1.0 if h >> 63 else -1.0
+        return _normalize(matrix)
+
+
+class OpenAIEmbedder:
+    """Embeds with the OpenAI API through an IntegrationContext, so the calls share
+    its client and RateGovernor. `embed()` waits for the context's event loop to
+    make the calls, so while that loop is running, call it from a worker thread
+    (as IssueIndex methods are, through asyncio.to_thread), never on the loop"""
+
+    def __init__(self, ctx, model: str = EMBEDDING_MODEL, batch_size: int = 256):
+        self.ctx = ctx
+        self.model = model
+        self.batch_size = batch_size
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            response = self._run(
+                self.ctx.create_embeddings(
+                    model=self.model, input=texts[start : start + self.batch_size]
+                )
+            )
+            vectors.extend(item.embedding for item in response.data)
+        return _normalize(np.asarray(vectors, dtype=np.float32))
+
+    def _run(self, coroutine):
+        loop = self.ctx.event_loop
+        if loop is None:
+            coroutine.close()
+            raise RuntimeError("OpenAIEmbedder needs an open IntegrationContext")
+        if not loop.is_running():
+            # A sync context between calls, whose private loop we can run ourselves
+            return self.ctx.run(coroutine)
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            coroutine.close()
+            raise RuntimeError(
+                "OpenAIEmbedder.embed() would block the event loop it needs, so run it in a worker thread"
+            )
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+def make_embedder(name: str, ctx=None):
+    """The embedder called `name` in EMBEDDERS. "openai" needs the context whose
+    client and rate limits it uses"""
+    if name == "openai":
+        return OpenAIEmbedder(ctx)
+    if name == "hashing":
+        return HashingEmbedder()
+    raise ValueError(f"Unknown embedder {name!r}, expected one of {EMBEDDERS}")
+
+
+class IssueIndex:
+    """Nearest neighbour index over issue titles and descriptions.
+
+    Vectors are stored as a normalized float32 matrix in `vectors.npy`, memory
+    mapped from disk, with the issue ID of every row in `ids.npy` and a digest of
+    the embedded text in `digests.npy` so unchanged issues are never re-embedded.
+    Searches may run in worker threads, so every method holds the index lock.
+    """
+
+    def __init__(self, path: str, embedder):
+        self.path = path
+        self.embedder = embedder
+        os.makedirs(path, exist_ok=True)
+        self._vectors_path = os.path.join(path, "vectors.npy")
+        self._ids_path = os.path.join(path, "ids.npy")
+        self._digests_path = os.path.join(path, "digests.npy")
+        self._lock = threading.RLock()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _load(self) -> None:
+        if os.path.exists(self._vectors_path):
+            self.vectors = np.load(self._vectors_path, mmap_mode="r")
+            self.ids = np.load(self._ids_path)
+            self.digests = np.load(self._digests_path)
+        else:
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+            self.ids = np.array([], dtype=str)
+            self.digests = np.array([], dtype=str)
+        self._positions = {str(issue_id): i for i, issue_id in enumerate(self.ids)}
+
+    def _save(self, vectors: np.ndarray, ids: np.ndarray, digests: np.ndarray) -> None:
+        # Write to temporary files first so a crash never leaves the matrix and
+        # the sidecar arrays out of sync with each other
+        for target, array in (
+            (self._vectors_path, vectors),
+            (self._ids_path, ids),
+            (self._digests_path, digests),
+        ):
+            tmp_path = target + ".tmp.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, target)
+        self._load()
+
+    def upsert(self, issues: Iterable[Dict]) -> int:
+        """Embeds issues that are new or whose title/description changed, and
+        returns how many were (re-)embedded"""
+        with self._lock:
+            return self._upsert(issues)
+
+    def _upsert(self, issues: Iterable[Dict]) -> int:
+        pending = {}
+        for issue in issues:
+            text = issue_text(issue)
+            digest = _digest(text)
+            position = self._positions.get(issue["id"])
+            if position is not None and self.digests[position] == digest:
+                continue
+            pending[issue["id"]] = (text, digest)
+        if not pending:
+            return 0
+
+        issue_ids = list(pending)
+        new_vectors = self.embedder.embed([pending[i][0] for i in issue_ids])
+        if len(self) and new_vectors.shape[1] != self.vectors.shape[1]:
+            raise ValueError(
+                f"Embedding dimension {new_vectors.shape[1]} doesn't match the index dimension {self.vectors.shape[1]}"
+            )
+
+        updated = [i for i in issue_ids if i in self._positions]
+        appended = [i for i in issue_ids if i not in self._positions]
+        rows = {issue_id: new_vectors[n] for n, issue_id in enumerate(issue_ids)}
+        if not appended:
+            # Edited issues only touch their own rows, so write them in place
+            vectors = np.load(self._vectors_path, mmap_mode="r+")
+            digests = self.digests.copy()
+            for issue_id in updated:
+                vectors[self._positions[issue_id]] = rows[issue_id]
+                digests[self._positions[issue_id]] = pending[issue_id][1]
+            vectors.flush()
+            del vectors
+            np.save(self._digests_path, digests)
+            self._load()
+            return len(pending)
+
+        vectors = np.array(self.vectors) if len(self) else None
+        digests = self.digests.astype(object)
+        for issue_id in updated:
+            vectors[self._positions[issue_id]] = rows[issue_id]
+            digests[self._positions[issue_id]] = pending[issue_id][1]
+        appended_vectors = np.stack([rows[i] for i in appended])
+        self._save(
+            (
+                appended_vectors
+                if vectors is None
+                else np.concatenate([vectors, appended_vectors])
+            ),
+            np.concatenate([self.ids.astype(object), appended]).astype(str),
+            np.concatenate([digests, [pending[i][1] for i in appended]]).astype(str),
+        )
+        return len(pending)
+
+    def remove(self, issue_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._remove(issue_ids)
+
+    def _remove(self, issue_ids: Iterable[str]) -> None:
+        positions = [self._positions[i] for i in issue_ids if i in self._positions]
+        if not positions:
+            return
+        keep = np.ones(len(self), dtype=bool)
+        keep[positions] = False
+        self._save(np.array(self.vectors[keep]), self.ids[keep], self.digests[keep])
+
+    def sync(self, issues: List[Dict]) -> None:
+        """Makes the index contain exactly the given issues"""
+        with self._lock:
+            self._upsert(issues)
+            current_ids = {issue["id"] for issue in issues}
+            self._remove([str(i) for i in self.ids if str(i) not in current_ids])
+
+    def search(self, text: str, k: int) -> List[str]:
+        """Returns the IDs of the k issues most similar to the given text"""
+        if not len(self) or k <= 0:
+            return []
+        query = self.embedder.embed([text])[0]
+        with self._lock:
+            if not len(self) or k <= 0:
+                return []
+            scores = self.vectors @ query
+            k = min(k, len(self))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [str(self.ids[i]) for i in top]
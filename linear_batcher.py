@@ -0,0 +1,217 @@
+from gql import gql, GraphQLRequest
+from gql.client import AsyncClientSession
+from gql.transport.exceptions import TransportQueryError
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import functools
+
+from linear_helpers import comment_create_input, issue_create_input
+
+# Flush once this many mutations are pending, or once the oldest has waited this long
+DEFAULT_MAX_BATCH_SIZE = 20
+DEFAULT_MAX_WAIT = 0.05
+
+_ISSUE_PAYLOAD = "success issue { id title description }"
+_COMMENT_PAYLOAD = "success comment { id body }"
+# Name of the top-level result field each kind of mutation returns on its own, so
+# batched and unbatched callers get results of the same shape
+_RESULT_FIELDS = {
+    "create": "issueCreate",
+    "comment": "commentCreate",
+}
+
+
+@functools.lru_cache(maxsize=256)
+def batch_document(kinds: Tuple[str, ...]) -> GraphQLRequest:
+    """Builds one mutation with an aliased field per operation. Documents are
+    cached by their sequence of operation kinds, so each shape is parsed once"""
+    variables, fields = [], []
+    for n, kind in enumerate(kinds):
+        if kind == "create":
+            variables.append(f"$input{n}: IssueCreateInput!")
+            fields.append(f"m{n}: issueCreate(input: $input{n}) {{ {_ISSUE_PAYLOAD} }}")
+        elif kind == "comment":
+            variables.append(f"$input{n}: CommentCreateInput!")
+            fields.append(
+                f"m{n}: commentCreate(input: $input{n}) {{ {_COMMENT_PAYLOAD} }}"
+            )
+        else:
+            raise ValueError(f"Unknown mutation kind {kind!r}")
+    return gql(
+        f"mutation BatchedMutations({', '.join(variables)}) {{ {' '.join(fields)} }}"
+    )
+
+
+class MutationBatcher:
+    """Collects issueCreate and commentCreate mutations from concurrent
+    callers and sends them to Linear as a single aliased GraphQL document.
+
+    A batch is sent once `max_batch_size` mutations are pending or `max_wait`
+    seconds after the first one arrived. Each caller gets back the same result (or
+    exception) it would have gotten from acreate_issue/aadd_comment.
+    """
+
+    def __init__(
+        self,
+        session: AsyncClientSession,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait: float = DEFAULT_MAX_WAIT,
+    ):
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches_sent = 0
+        self.mutations_sent = 0
+        self._pending: List[Tuple[str, Dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._in_flight: Set[asyncio.Task] = set()
+
+    async def create_issue(
+        self,
+        title: str,
+        description: str,
+        team_id: str,
+        issue_id: Optional[str] = None,
+    ) -> Dict:
+        return await self._submit(
+            "create",
+            {"input": issue_create_input(title, description, team_id, issue_id)},
+        )
+
+    async def add_comment(
+        self, issue_id: str, body: str, comment_id: Optional[str] = None
+    ) -> Dict:
+        return await self._submit(
+            "comment", {"input": comment_create_input(issue_id, body, comment_id)}
+        )
+
+    async def _submit(self, kind: str, variables: Dict) -> Dict:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((kind, variables, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush_pending)
+        return await future
+
+    def _flush_pending(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def flush(self) -> None:
+        """Sends anything pending and waits for every batch in flight"""
+        self._flush_pending()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    async def _send(self, batch: List[Tuple[str, Dict, asyncio.Future]]) -> None:
+        variables = {}
+        for n, (kind, operation_variables, _) in enumerate(batch):
+            variables[f"input{n}"] = operation_variables["input"]
+        request = GraphQLRequest(
+            batch_document(tuple(kind for kind, _, _ in batch)),
+            variable_values=variables,
+        )
+        self.batches_sent += 1
+        self.mutations_sent += len(batch)
+        try:
+            data = await self.session.execute(request)
+            errors = {}
+        except TransportQueryError as e:
+            data = e.data
+            errors = {
+                error["path"][0]: error
+                for error in (e.errors or [])
+                if isinstance(error, dict) and error.get("path")
+            }
+            if data is None:
+                await self._recover(batch, errors, e)
+                return
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self._resolve(batch, data, errors)
+
+    async def _recover(
+        self,
+        batch: List[Tuple[str, Dict, asyncio.Future]],
+        errors: Dict[str, Dict],
+        error: TransportQueryError,
+    ) -> None:
+        # A failing non-null field nulls out the whole result. Linear runs the
+        # aliased mutations in order and stops at the failing one, so the ones
+        # before it were applied (and must not be sent again) and the ones after
+        # it never ran
+        failed = min(
+            (int(alias[1:]) for alias in errors if alias[1:].isdigit()),
+            default=None,
+        )
+        if failed is None:
+            # No way to tell which operations went through, so don't resend any
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for kind, variables, future in batch[:failed]:
+            if not future.done():
+                _set_applied_result(future, kind, variables)
+        if not batch[failed][2].done():
+            batch[failed][2].set_exception(
+                TransportQueryError(
+                    str(errors[f"m{failed}"]), errors=[errors[f"m{failed}"]], data=None
+                )
+            )
+        if batch[failed + 1 :]:
+            await self._send(batch[failed + 1 :])
+
+    def _resolve(
+        self,
+        batch: List[Tuple[str, Dict, asyncio.Future]],
+        data: Dict,
+        errors: Dict[str, Dict],
+    ) -> None:
+        for n, (kind, _, future) in enumerate(batch):
+            alias = f"m{n}"
+            if future.done():
+                continue
+            if alias in errors or data.get(alias) is None:
+                error = errors.get(alias, {"message": f"No result for {alias}"})
+                future.set_exception(
+                    TransportQueryError(str(error), errors=[error], data=None)
+                )
+            else:
+                future.set_result({_RESULT_FIELDS[kind]: data[alias]})
+
+
+def _set_applied_result(future: asyncio.Future, kind: str, variables: Dict) -> None:
+    """Resolves an operation that went through in a batch whose results were lost,
+    with the result rebuilt from what was sent"""
+    values = variables["input"]
+    if kind == "comment":
+        future.set_result(
+            {"commentCreate": {"success": True, "comment": {"id": None, **values}}}
+        )
+    elif values.get("id") is not None:
+        issue = {
+            "id": values["id"],
+            "title": values["title"],
+            "description": values.get("description"),
+        }
+        future.set_result({"issueCreate": {"success": True, "issue": issue}})
+    else:
+        # Without a client-chosen ID there's no telling which issue was created
+        future.set_exception(
+            TransportQueryError(
+                "The issue was created, but its result was lost with its batch's"
+            )
+        )
@@ -1,124 +1,287 @@
-from gql import gql, Client
-from typing import Optional, Dict
+from gql import gql, Client, GraphQLRequest
+from gql.client import AsyncClientSession
+from typing import Optional, Dict, List
+import hashlib
+import uuid
 
 
-def get_issue(client: Client, issue_id: str) -> Dict:
-    query = gql(
-        """
-        query Issue {{
-            issue(id: "{issue_id}") {{
+# Operations are parsed once at import time and take GraphQL variables, so nothing
+# is re-parsed per call and titles/descriptions never need escaping
+ISSUE = gql(
+    """
+    query Issue($id: String!) {
+        issue(id: $id) {
+            id
+            title
+            description
+        }
+    }
+    """
+)
+
+ISSUE_CREATE = gql(
+    """
+    mutation IssueCreate($input: IssueCreateInput!) {
+        issueCreate(input: $input) {
+            success
+            issue {
                 id
                 title
                 description
-            }}
-        }}
-        """.format(
-            issue_id=issue_id
-        )
+            }
+        }
+    }
+    """
+)
+
+COMMENT = gql(
+    """
+    query Comment($id: String!) {
+        comment(id: $id) {
+            id
+            body
+        }
+    }
+    """
+)
+
+COMMENT_CREATE = gql(
+    """
+    mutation CommentCreate($input: CommentCreateInput!) {
+        commentCreate(input: $input) {
+            success
+            comment {
+                id
+                body
+            }
+        }
+    }
+    """
+)
+
+
+def get_issue(client: Client, issue_id: str) -> Dict:
+    result = client.execute(GraphQLRequest(ISSUE, variable_values={"id": issue_id}))
+    return result
+
+
+async def aget_issue(session: AsyncClientSession, issue_id: str) -> Dict:
+    result = await session.execute(
+        GraphQLRequest(ISSUE, variable_values={"id": issue_id})
     )
-    result = client.execute(query)
     return result
 
 
-# TODO(vcd): Maybe we can use GPT or some basic string parsing
-# to get the team id from a list of teams in linear?
-def list_issues(client: Client, team_id: str) -> Dict:
-    query = gql(
-        """
-        query Team {{
-        team(id: "{team_id}") {{
-            id
-            name
+TEAM_ISSUES_PAGE = gql(
+    """
+    query TeamIssues(
+        $teamId: String!
+        $first: Int!
+        $after: String
+        $filter: IssueFilter
+        $includeArchived: Boolean
+    ) {
+        team(id: $teamId) {
+            issues(
+                first: $first
+                after: $after
+                filter: $filter
+                includeArchived: $includeArchived
+                orderBy: updatedAt
+            ) {
+                nodes {
+                    id
+                    title
+                    description
+                    updatedAt
+                    archivedAt
+                }
+                pageInfo {
+                    hasNextPage
+                    endCursor
+                }
+            }
+        }
+    }
+    """
+)
 
-            issues {{
-            nodes {{
-                id
-                title
-                description
-                assignee {{
-                id
-                name
-                }}
-                createdAt
-                archivedAt
-            }}
-            }}
-        }}
-        }}
-        """.format(
-            team_id=team_id
+ISSUES_PAGE_SIZE = 100
+
+
+def list_issues(
+    client: Client,
+    team_id: str,
+    updated_after: Optional[str] = None,
+    include_archived: bool = False,
+    page_size: int = ISSUES_PAGE_SIZE,
+) -> List[Dict]:
+    """Pages through a team's issues with cursors. Archived issues are filtered out
+    on the server unless `include_archived` is set, and `updated_after` (an ISO 8601
+    timestamp) restricts the result to issues updated at or after it"""
+    variables = _list_issues_variables(
+        team_id, updated_after, include_archived, page_size
+    )
+    issues = []
+    while True:
+        result = client.execute(
+            GraphQLRequest(TEAM_ISSUES_PAGE, variable_values=variables)
         )
+        connection = result["team"]["issues"]
+        issues.extend(connection["nodes"])
+        if not connection["pageInfo"]["hasNextPage"]:
+            return issues
+        variables["after"] = connection["pageInfo"]["endCursor"]
+
+
+async def alist_issues(
+    session: AsyncClientSession,
+    team_id: str,
+    updated_after: Optional[str] = None,
+    include_archived: bool = False,
+    page_size: int = ISSUES_PAGE_SIZE,
+) -> List[Dict]:
+    variables = _list_issues_variables(
+        team_id, updated_after, include_archived, page_size
+    )
+    issues = []
+    while True:
+        result = await session.execute(
+            GraphQLRequest(TEAM_ISSUES_PAGE, variable_values=variables)
+        )
+        connection = result["team"]["issues"]
+        issues.extend(connection["nodes"])
+        if not connection["pageInfo"]["hasNextPage"]:
+            return issues
+        variables["after"] = connection["pageInfo"]["endCursor"]
+
+
+def _list_issues_variables(
+    team_id: str, updated_after: Optional[str], include_archived: bool, page_size: int
+) -> Dict:
+    variables = {
+        "teamId": team_id,
+        "first": page_size,
+        "includeArchived": include_archived,
+    }
+    if updated_after is not None:
+        # Inclusive, as another issue can be updated in the same millisecond as the
+        # last one we saw; callers drop the ones they already have
+        variables["filter"] = {"updatedAt": {"gte": updated_after}}
+    return variables
+
+
+# Linear accepts a client-chosen UUID for new issues and comments, so deriving it
+# from the record an issue or comment is created for makes retried and replayed
+# creates idempotent. The key identifies the record (e.g. its source and line), not
+# its text: two conversations with the same text are still two mentions
+ISSUE_ID_NAMESPACE = uuid.UUID("6f1c8a52-3f1e-4b8e-9a57-2f0c1d7e4b61")
+COMMENT_ID_NAMESPACE = uuid.UUID("b3d7e0a4-8c2f-4f61-9e15-7a4d2c9b0e38")
+
+
+def _idempotent_id(namespace: uuid.UUID, record_key: str) -> str:
+    digest = hashlib.sha256(namespace.bytes + record_key.encode()).digest()
+    # Linear expects version 4 UUIDs, so set its version and variant bits
+    return str(uuid.UUID(bytes=digest[:16], version=4))
+
+
+def idempotent_issue_id(record_key: str) -> str:
+    return _idempotent_id(ISSUE_ID_NAMESPACE, record_key)
+
+
+def idempotent_comment_id(record_key: str) -> str:
+    return _idempotent_id(COMMENT_ID_NAMESPACE, record_key)
+
+
+def issue_create_input(
+    title: str, description: str, team_id: str, issue_id: Optional[str] = None
+) -> Dict:
+    create = {"title": title, "description": description, "teamId": team_id}
+    if issue_id is not None:
+        create["id"] = issue_id
+    return create
+
+
+def _create_issue_request(
+    title: str, description: str, team_id: str, issue_id: Optional[str] = None
+) -> GraphQLRequest:
+    return GraphQLRequest(
+        ISSUE_CREATE,
+        variable_values={
+            "input": issue_create_input(title, description, team_id, issue_id)
+        },
+    )
+
+
+def create_issue(
+    client: Client,
+    title: str,
+    description: str,
+    team_id: str,
+    issue_id: Optional[str] = None,
+) -> Dict:
+    """Creates an issue. Pass an `issue_id` (e.g. from idempotent_issue_id) to make
+    the create safe to retry: a second create with the same ID fails instead of
+    creating a duplicate"""
+    result = client.execute(
+        _create_issue_request(title, description, team_id, issue_id)
     )
-    result = client.execute(query)
     return result
 
 
-def create_issue(client: Client, title: str, description: str, team_id: str) -> Dict:
-    query = gql(
-        """
-        mutation IssueCreate {{
-            issueCreate(
-                input: {{
-                title: "{title}"
-                description: "{description}"
-                teamId: "{linear_team_id}"
-                }}
-            ) {{
-                success
-                issue {{
-                id
-                title
-                description
-                }}
-            }}
-        }}
-        """.format(
-            title=title,
-            description=description,
-            linear_team_id=team_id,
-        )
+async def acreate_issue(
+    session: AsyncClientSession,
+    title: str,
+    description: str,
+    team_id: str,
+    issue_id: Optional[str] = None,
+) -> Dict:
+    result = await session.execute(
+        _create_issue_request(title, description, team_id, issue_id)
     )
-    result = client.execute(query)
     return result
 
 
-def edit_issue(
-    client: Client,
+def comment_create_input(
+    issue_id: str, body: str, comment_id: Optional[str] = None
+) -> Dict:
+    create = {"issueId": issue_id, "body": body}
+    if comment_id is not None:
+        create["id"] = comment_id
+    return create
+
+
+def _add_comment_request(
+    issue_id: str, body: str, comment_id: Optional[str] = None
+) -> GraphQLRequest:
+    return GraphQLRequest(
+        COMMENT_CREATE,
+        variable_values={"input": comment_create_input(issue_id, body, comment_id)},
+    )
+
+
+def add_comment(
+    client: Client, issue_id: str, body: str, comment_id: Optional[str] = None
+) -> Dict:
+    """Appends a comment to an issue, leaving its title and description alone.
+    Like create_issue's `issue_id`, a `comment_id` (e.g. from
+    idempotent_comment_id) makes it safe to retry"""
+    result = client.execute(_add_comment_request(issue_id, body, comment_id))
+    return result
+
+
+async def aadd_comment(
+    session: AsyncClientSession,
     issue_id: str,
-    new_title: Optional[str] = None,
-    new_description: Optional[str] = None,
+    body: str,
+    comment_id: Optional[str] = None,
 ) -> Dict:
-    issue = get_issue(client, issue_id)["issue"]
-    if new_title is None:
-        new_title = issue["title"]
-    if new_description is None:
-        new_description = issue["description"]
-
-    # Replace double quotes with single quotes to avoid string
-    # parsing errors in GraphQL Query
-    query = gql(
-        """
-        mutation IssueUpdate {{
-        issueUpdate(
-            id: "{issue_id}",
-            input: {{
-            title: "{new_title}"
-            description: "{new_description}"
-            }}
-        ) {{
-            success
-            issue {{
-            id
-            title
-            description
-            }}
-        }}
-        }}
-        """.format(
-            issue_id=issue_id,
-            new_title=new_title.replace('"', "'"),
-            new_description=new_description.replace('"', "'"),
-        )
+    result = await session.execute(_add_comment_request(issue_id, body, comment_id))
+    return result
+
+
+async def aget_comment(session: AsyncClientSession, comment_id: str) -> Dict:
+    result = await session.execute(
+        GraphQLRequest(COMMENT, variable_values={"id": comment_id})
     )
-    result = client.execute(query)
     return result
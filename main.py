@@ -1,165 +1,570 @@
-from openai import OpenAI
-from gql import Client
-from gql.transport.aiohttp import AIOHTTPTransport
-import json
+from contextlib import nullcontext
+from gql.transport.exceptions import TransportQueryError
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+import asyncio
+import time
+import uuid
 
-from linear_helpers import list_issues, create_issue, edit_issue
-from constants import LINEAR_KEY, LINEAR_TEAM_ID, OPENAI_KEY
+from gpt_helpers import check_issue_match, propose_new_issue, rank_candidates
+from integration_context import IntegrationContext
+from issue_index import lexical_shortlist
+from linear_helpers import (
+    aadd_comment,
+    acreate_issue,
+    aget_comment,
+    aget_issue,
+    alist_issues,
+    idempotent_comment_id,
+    idempotent_issue_id,
+)
+from mentions import mention_comment
+from ranking_batcher import RankingBatcher
 
-# TODO: Should we pull out GPT API calls into a separate gpt_helpers.py file?
-# TODO: Should we have one team for FRs and one team for BRs?
+# Everything here works on the context's team. To spread conversations over several
+# teams (e.g. one for FRs and one for BRs), see routing.py
+
+# "ranked" puts a shortlist of existing tasks into a single prompt per conversation,
+# "per_issue" asks the model about each existing task one at a time, and "batched"
+# ranks several concurrent conversations in one prompt (see ranking_batcher.py)
+MATCHING_MODES = ("ranked", "per_issue", "batched")
+
+# A conversation, or a `(record_key, conversation)` pair naming the record it came
+# from, such as its file and line
+Conversation = Union[str, Tuple[str, str]]
+
+# Number of existing tasks shortlisted by the issue index before any OpenAI calls
+DEFAULT_TOP_K = 20
+
+# Without an issue index, backlogs larger than this are narrowed down to the tasks
+# sharing the most words with the conversation, so prompts don't grow with them
+MAX_UNINDEXED_CANDIDATES = 100
+
+# Number of conversations categorize_conversations() processes at the same time
+DEFAULT_CONCURRENCY = 8
 
 
 # Is it advantageous to have one prompt per linear task? Or one prompt for all linear tasks?
-# An evaluation suite will help answer this question.
-def categorize_conversation(conversation: str) -> None:
-    """ """
-    transport = AIOHTTPTransport(
-        url="https://api.linear.app/graphql",
-        headers={"Authorization": LINEAR_KEY},
+# `matching_mode` lets us compare both, and benchmarks/evaluate.py measures their precision
+# and recall next to their cost on a labelled corpus.
+def categorize_conversation(
+    conversation: str,
+    ctx: Optional[IntegrationContext] = None,
+    matching_mode: str = "ranked",
+    top_k: int = DEFAULT_TOP_K,
+    record_key: Optional[str] = None,
+) -> Dict:
+    """Categorizes a conversation and files it in Linear, returning what was done.
+    Pass a shared, open `ctx` when processing many conversations so the API clients
+    and caches are reused, and a `record_key` that identifies where the conversation
+    came from to make creating its task idempotent (see idempotent_issue_id)"""
+    if ctx is None:
+        with IntegrationContext() as ctx:
+            return categorize_conversation(
+                conversation, ctx, matching_mode, top_k, record_key
+            )
+    return ctx.run(
+        categorize_conversation_async(
+            conversation, ctx, matching_mode, top_k, record_key
+        )
     )
-    linear_client = Client(transport=transport, fetch_schema_from_transport=True)
-    openai_client = OpenAI(
-        api_key=OPENAI_KEY,
+
+
+async def categorize_conversations(
+    conversations: Union[Iterable[Conversation], AsyncIterable[Conversation]],
+    ctx: Optional[IntegrationContext] = None,
+    matching_mode: str = "ranked",
+    top_k: int = DEFAULT_TOP_K,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> List[Union[Dict, Exception]]:
+    """Categorizes many conversations concurrently. Returns one result per
+    conversation, in input order, which is either the outcome dict or the exception
+    raised while processing that conversation"""
+    _check_matching_mode(matching_mode)
+    if ctx is None:
+        async with IntegrationContext() as ctx:
+            return await categorize_conversations(
+                conversations, ctx, matching_mode, top_k, concurrency
+            )
+
+    results = {}
+    async for index, result in categorize_stream(
+        conversations, ctx, matching_mode, top_k, concurrency
+    ):
+        results[index] = result
+    return [results[index] for index in range(len(results))]
+
+
+async def categorize_stream(
+    conversations: Union[Iterable[Conversation], AsyncIterable[Conversation]],
+    ctx: IntegrationContext,
+    matching_mode: str = "ranked",
+    top_k: int = DEFAULT_TOP_K,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> AsyncIterator[Tuple[int, Union[Dict, Exception]]]:
+    """Categorizes conversations concurrently, yielding `(index, result)` pairs in
+    the order they finish. Conversations are only read as workers free up, so a
+    stream of any length is processed in constant memory. Each one is either a
+    string or a `(record_key, conversation)` pair"""
+    _check_matching_mode(matching_mode)
+    # A bounded queue means we never read further ahead of the workers than we need to
+    queue = asyncio.Queue(maxsize=concurrency)
+    results = asyncio.Queue()
+
+    async def worker() -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, (record_key, conversation) = item
+            try:
+                result = await categorize_conversation_async(
+                    conversation, ctx, matching_mode, top_k, record_key
+                )
+            except Exception as e:
+                result = e
+            await results.put((index, result))
+
+    async def feed() -> None:
+        try:
+            count = 0
+            async for conversation in _aiter(conversations):
+                await queue.put((count, keyed_conversation(conversation)))
+                count += 1
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            results.put_nowait(None)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    feeder = asyncio.create_task(feed())
+    try:
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            yield item
+        # Surfaces errors from reading the conversations themselves
+        await feeder
+    finally:
+        for task in workers + [feeder]:
+            task.cancel()
+
+
+async def _aiter(
+    conversations: Union[Iterable[Conversation], AsyncIterable[Conversation]]
+):
+    if hasattr(conversations, "__aiter__"):
+        async for conversation in conversations:
+            yield conversation
+    else:
+        for conversation in conversations:
+            yield conversation
+
+
+def keyed_conversation(conversation: Conversation) -> Tuple[Optional[str], str]:
+    """The `(record_key, conversation)` pair for a stream item"""
+    if isinstance(conversation, tuple):
+        return conversation
+    return None, conversation
+
+
+def _check_matching_mode(matching_mode: str) -> None:
+    if matching_mode not in MATCHING_MODES:
+        raise ValueError(
+            f"Unknown matching mode {matching_mode!r}, expected one of {MATCHING_MODES}"
+        )
+
+
+async def categorize_conversation_async(
+    conversation: str,
+    ctx: IntegrationContext,
+    matching_mode: str = "ranked",
+    top_k: int = DEFAULT_TOP_K,
+    record_key: Optional[str] = None,
+) -> Dict:
+    _check_matching_mode(matching_mode)
+    if ctx.metrics is None:
+        return await _categorize(conversation, ctx, matching_mode, top_k, record_key)
+    started = time.perf_counter()
+    action = "error"
+    with ctx.metrics.span("categorize_conversation", matching_mode=matching_mode):
+        try:
+            outcome = await _categorize(
+                conversation, ctx, matching_mode, top_k, record_key
+            )
+            action = outcome["action"]
+            return outcome
+        finally:
+            ctx.metrics.record_conversation(time.perf_counter() - started, action)
+
+
+def _stage(ctx: IntegrationContext, stage: str):
+    return ctx.metrics.stage(stage) if ctx.metrics is not None else nullcontext()
+
+
+async def _categorize(
+    conversation: str,
+    ctx: IntegrationContext,
+    matching_mode: str,
+    top_k: int,
+    record_key: Optional[str] = None,
+) -> Dict:
+    with _stage(ctx, "dedup"):
+        duplicate = await known_duplicate(conversation, ctx, record_key)
+    if duplicate is not None:
+        return duplicate
+    with _stage(ctx, "prefilter"):
+        dropped = prefiltered(conversation, ctx)
+    if dropped is not None:
+        return remember_outcome(ctx, conversation, dropped)
+
+    with _stage(ctx, "candidates"):
+        prompt_conversation, issues, tokens_saved = await prepare_conversation(
+            conversation, ctx, top_k
+        )
+    if matching_mode in ("ranked", "batched"):
+        with _stage(ctx, "rank"):
+            if matching_mode == "batched":
+                if ctx.ranking_batcher is None:
+                    ctx.ranking_batcher = RankingBatcher(ctx)
+                # The decision may match a task from another conversation's shortlist
+                decision, issues = await ctx.ranking_batcher.rank(
+                    prompt_conversation, issues
+                )
+            else:
+                decision = await rank_candidates(ctx, prompt_conversation, issues)
+        with _stage(ctx, "apply"):
+            outcome = await apply_decision(
+                ctx, conversation, issues, decision, record_key
+            )
+    else:
+        with _stage(ctx, "per_issue"):
+            outcome = await _categorize_per_issue(
+                prompt_conversation, issues, ctx, conversation, record_key
+            )
+    return remember_outcome(ctx, conversation, outcome, tokens_saved)
+
+
+async def known_duplicate(
+    conversation: str, ctx: IntegrationContext, record_key: Optional[str] = None
+) -> Optional[Dict]:
+    """Attributes a conversation the context's DedupIndex has already seen to the
+    same task as before, returning the outcome, or None if it's new"""
+    if ctx.dedup is None:
+        return None
+    # Repeats of a conversation we've already categorized don't need any API calls
+    known = ctx.dedup.lookup(conversation)
+    if known is None:
+        return None
+    return await _duplicate_outcome(ctx, conversation, known, record_key)
+
+
+def prefiltered(conversation: str, ctx: IntegrationContext) -> Optional[Dict]:
+    """The ignore outcome for a conversation the context's PreClassifier is
+    confident needs nothing filed, or None if it should go to the LLM"""
+    if ctx.prefilter is None:
+        return None
+    drop, probability = ctx.prefilter.should_drop(conversation)
+    if not drop:
+        return None
+    print(
+        "Did not create a new task for the input conversation because the pre-classifier is confident it doesn't describe a bug report or feature request!"
     )
+    return {
+        "action": "ignore",
+        "prefiltered": True,
+        "confidence": round(probability, 4),
+    }
+
+
+async def prepare_conversation(
+    conversation: str, ctx: IntegrationContext, top_k: int = DEFAULT_TOP_K
+) -> Tuple[str, List[Dict], int]:
+    """Returns the conversation as it should appear in prompts, the candidate tasks
+    to put next to it, and the number of tokens compaction saved"""
+    # Everything from here on, including the prompts, sees the compacted conversation
+    prompt_conversation, tokens_saved = conversation, 0
+    if ctx.compactor is not None:
+        prompt_conversation, tokens_saved = ctx.compactor.compact_conversation(
+            conversation
+        )
+    issues = await _candidate_issues(prompt_conversation, ctx, top_k)
+    if ctx.compactor is not None:
+        issues, descriptions_saved = ctx.compactor.compact_issues(issues)
+        tokens_saved += descriptions_saved
+    return prompt_conversation, issues, tokens_saved
+
 
+def remember_outcome(
+    ctx: IntegrationContext, conversation: str, outcome: Dict, tokens_saved: int = 0
+) -> Dict:
+    if ctx.dedup is not None:
+        ctx.dedup.remember(conversation, outcome)
+    if ctx.compactor is not None:
+        outcome["tokens_saved"] = tokens_saved
+    return outcome
+
+
+async def _duplicate_outcome(
+    ctx: IntegrationContext,
+    conversation: str,
+    known: Dict,
+    record_key: Optional[str] = None,
+) -> Dict:
+    return await attach_to_outcome(
+        ctx,
+        conversation,
+        known,
+        {"duplicate": True, "similarity": known["similarity"]},
+        record_key,
+    )
+
+
+async def attach_to_outcome(
+    ctx: IntegrationContext,
+    conversation: str,
+    outcome: Dict,
+    details: Dict,
+    record_key: Optional[str] = None,
+) -> Dict:
+    """Files a conversation the same way as an earlier one about the same problem,
+    without asking the model, and adds `details` to the outcome"""
+    if outcome.get("issue_id") is None:
+        print(
+            "Did not create a new task for the input conversation because it repeats one that was ignored!"
+        )
+        return {"action": "ignore", **details}
+    # Whether the original created the task or matched it, this one mentions it
+    mention = await _record_mention(
+        ctx, outcome["issue_id"], outcome.get("title"), conversation, record_key
+    )
+    return {**mention, **details}
+
+
+async def _candidate_issues(
+    conversation: str, ctx: IntegrationContext, top_k: int
+) -> List[Dict]:
+    async with ctx.sync_lock:
+        if ctx.issue_cache is not None:
+            # Only fetches issues updated since the last sync, and only every so often
+            changed = await ctx.issue_cache.sync_async(ctx.linear, ctx.team_id)
+            issues = ctx.issue_cache.issues(ctx.team_id)
+        else:
+            issues = await alist_issues(ctx.linear, ctx.team_id)
+            changed = True
+        if ctx.issue_index is not None and (
+            changed or len(ctx.issue_index) != len(issues)
+        ):
+            await asyncio.to_thread(ctx.issue_index.sync, issues)
+    if ctx.issue_index is None:
+        return await asyncio.to_thread(
+            lexical_shortlist, conversation, issues, MAX_UNINDEXED_CANDIDATES
+        )
+
+    # Narrow the backlog down to the most similar tasks so we only send those to GPT
+    issues_by_id = {issue["id"]: issue for issue in issues}
+    candidate_ids = await asyncio.to_thread(ctx.issue_index.search, conversation, top_k)
+    # Tasks created by concurrent conversations can be in the index but not (yet)
+    # in the list we read above
+    return [issues_by_id[i] for i in candidate_ids if i in issues_by_id]
+
+
+async def apply_decision(
+    ctx: IntegrationContext,
+    conversation: str,
+    issues: List[Dict],
+    decision: Dict,
+    record_key: Optional[str] = None,
+) -> Dict:
+    """Carries out a rank_candidates decision in Linear. Pass the original
+    `conversation`, not the compacted one, as it's what Linear is given"""
+    if decision["action"] == "match":
+        matched_issue = next(
+            issue for issue in issues if issue["id"] == decision["issue_id"]
+        )
+        return await _record_mention(
+            ctx, matched_issue["id"], matched_issue["title"], conversation, record_key
+        )
+    elif decision["action"] == "create":
+        return await _create_new_task(
+            ctx,
+            title=decision.get("title"),
+            description=decision.get("description"),
+            conversation=conversation,
+            record_key=record_key,
+        )
+    print(
+        "Did not create a new task for the input conversation because it didn't describe a bug report or feature request!"
+    )
+    return {"action": "ignore"}
+
+
+async def _categorize_per_issue(
+    prompt_conversation: str,
+    issues: List[Dict],
+    ctx: IntegrationContext,
+    conversation: str,
+    record_key: Optional[str] = None,
+) -> Dict:
+    # The prompts get the compacted conversation, and Linear the original
     # First, we iterate over every task to see if this conversation matches any existing tasks
-    issues = list_issues(client=linear_client, team_id=LINEAR_TEAM_ID)["team"][
-        "issues"
-    ]["nodes"]
     for issue in issues:
-        # Perhaps instead of this binary yes/no decision and iterating over each issue,
-        # we can get something analogous to a confidence score from the model and maximize
-        # that across all existing issues? Or we could prompt the model to tell us which
-        # issue the conversation most closely resembles, if any?
-        prompt = f"""Does the following conversation describe a new bug report and/or feature request that isn't described in the following existing task?
-        Conversation: {conversation}. Existing Task Title: {issue["title"]}. Existing Task Description: {issue["description"]}. 
-        If this issue is already described in the existing task, can you update that task's title and description, especially noting the number of times the issue described in the task has been mentioned by users?
-        If the issue described in the conversation is different from the issue described in the existing task, please do not update the existing task!
-        If the conversation captures neither a feature request nor a bug report (e.g. if the Agent was able to successfully answer the User's question), please don't update an existing task!
-        """
-        messages = [
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ]
-        tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "edit_issue",
-                    "description": "Updates the title and description of a task in Linear using the Linear GraphQL API",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "new_title": {
-                                "type": "string",
-                                "description": "The updated title of the existing task resulting from the bug report and/or feature request described in the conversation",
-                            },
-                            "new_description": {
-                                "type": "string",
-                                "description": "The updated description of the existing task resulting from the bug report and/or feature request described in the conversation",
-                            },
-                        },
-                    },
-                },
-            },
-        ]
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            tools=tools,
-            tool_choice="auto",
-        )
-        response_message = response.choices[0].message
-        tool_calls = response_message.tool_calls
-        if tool_calls:
-            available_functions = {
-                "edit_issue": edit_issue,
-            }
-            for tool_call in tool_calls:
-                function_name = tool_call.function.name
-                function_to_call = available_functions[function_name]
-                function_args = json.loads(tool_call.function.arguments)
-                function_response = function_to_call(
-                    client=linear_client,
-                    issue_id=issue["id"],
-                    new_title=function_args.get("new_title"),
-                    new_description=function_args.get("new_description"),
-                )
-                issue_dict = function_response["issueUpdate"]["issue"]
-                print(
-                    f"Added information from this conversation to an existing linear task! \nID: {issue_dict['id']} \nTitle: {issue_dict['title']} \nDescription: {issue_dict['description']}"
-                )
-                return
+        if await check_issue_match(ctx, prompt_conversation, issue):
+            return await _record_mention(
+                ctx, issue["id"], issue["title"], conversation, record_key
+            )
 
     # Since this conversation didn't match any of the existing tasks, or isn't describing a
     # bug report or feature request, we either make a new task if this does describe a bug
     # report or feature request, or discard this altogether
-    new_task_prompt = f"""
-    If there is a feature request or bug report described in the following conversation, please create a new task for it. 
-    Otherwise, for example if the Agent was successfully able to answer a user's question, please do not create a new task!
-    Conversation: {conversation}
-    """
-    new_task_messages = [
-        {
-            "role": "user",
-            "content": new_task_prompt,
-        }
-    ]
-    new_issue_function_tools = [
-        {
-            "type": "function",
-            "function": {
-                "name": "create_issue",
-                "description": "Creates a new task in linear using the GraphQL API",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "title": {
-                            "type": "string",
-                            "description": "Title for the task. This title summarizes the feature request/bug report described in the conversation",
-                        },
-                        "description": {
-                            "type": "string",
-                            "description": "Description for the task. This description is a more length summary of the feature request/bug report described in the conversation",
-                        },
-                    },
-                },
-            },
-        },
-    ]
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=new_task_messages,
-        tools=new_issue_function_tools,
-        tool_choice="auto",
+    function_args = await propose_new_issue(ctx, prompt_conversation)
+    if function_args is not None:
+        return await _create_new_task(
+            ctx,
+            title=function_args.get("title"),
+            description=function_args.get("description"),
+            conversation=conversation,
+            record_key=record_key,
+        )
+    print(
+        "Did not create a new task for the input conversation because it didn't describe a bug report or feature request!"
     )
-    response_message = response.choices[0].message
-    tool_calls = response_message.tool_calls
-    if tool_calls:
-        available_functions = {
-            "create_issue": create_issue,
+    return {"action": "ignore"}
+
+
+async def _remember_issue(ctx: IntegrationContext, issue_dict: Dict) -> None:
+    if ctx.issue_index is not None:
+        # Embedding the task can mean an API call, which mustn't block the loop
+        await asyncio.to_thread(ctx.issue_index.upsert, [issue_dict])
+    if ctx.issue_cache is not None:
+        ctx.issue_cache.upsert(ctx.team_id, [issue_dict])
+
+
+async def _record_mention(
+    ctx: IntegrationContext,
+    issue_id: str,
+    title: Optional[str],
+    conversation: str,
+    record_key: Optional[str] = None,
+) -> Dict:
+    # The count lives in our own table and the conversation is appended as a comment,
+    # so the task's title and description are left as they are. Like a created
+    # task's, the comment's ID is derived from the record, so a record replayed
+    # after a crash can't post it twice
+    comment_id = idempotent_comment_id(record_key) if record_key is not None else None
+    mentions = ctx.mentions.record(issue_id, conversation)
+    body = mention_comment(mentions, conversation)
+    try:
+        if ctx.mutation_batcher is not None:
+            await ctx.mutation_batcher.add_comment(
+                issue_id=issue_id, body=body, comment_id=comment_id
+            )
+        else:
+            await aadd_comment(
+                ctx.linear, issue_id=issue_id, body=body, comment_id=comment_id
+            )
+    except TransportQueryError:
+        if comment_id is None or await _existing_comment(ctx, comment_id) is None:
+            raise
+        print(
+            f"A mention of this linear task was already recorded for this conversation! \nID: {issue_id} \nTitle: {title}"
+        )
+        return {
+            "action": "match",
+            "issue_id": issue_id,
+            "title": title,
+            "mentions": mentions,
+            "replayed": True,
         }
-        for tool_call in tool_calls:
-            function_name = tool_call.function.name
-            function_to_call = available_functions[function_name]
-            function_args = json.loads(tool_call.function.arguments)
-            function_response = function_to_call(
-                client=linear_client,
-                title=function_args.get("title"),
-                description=function_args.get("description"),
-                team_id=LINEAR_TEAM_ID,
+    print(
+        f"Recorded a mention of an existing linear task! \nID: {issue_id} \nTitle: {title} \nMentions: {mentions}"
+    )
+    return {
+        "action": "match",
+        "issue_id": issue_id,
+        "title": title,
+        "mentions": mentions,
+    }
+
+
+async def _create_new_task(
+    ctx: IntegrationContext,
+    title: str,
+    description: str,
+    conversation: str,
+    record_key: Optional[str] = None,
+) -> Dict:
+    # The task's ID is derived from the record, so if this create already went
+    # through (before a crash, or with its response lost) it can't happen twice.
+    # Without one, it's only fixed for this attempt
+    issue_id = (
+        idempotent_issue_id(record_key) if record_key is not None else str(uuid.uuid4())
+    )
+    try:
+        if ctx.mutation_batcher is not None:
+            function_response = await ctx.mutation_batcher.create_issue(
+                title=title,
+                description=description,
+                team_id=ctx.team_id,
+                issue_id=issue_id,
             )
-            issue_dict = function_response["issueCreate"]["issue"]
-            print(
-                f"Created new linear task for this conversation! \nID: {issue_dict['id']} \nTitle: {issue_dict['title']} \nDescription: {issue_dict['description']}"
+        else:
+            function_response = await acreate_issue(
+                ctx.linear,
+                title=title,
+                description=description,
+                team_id=ctx.team_id,
+                issue_id=issue_id,
             )
-    else:
+    except TransportQueryError:
+        existing = await _existing_issue(ctx, issue_id)
+        if existing is None:
+            raise
         print(
-            "Did not create a new task for the input conversation because it didn't describe a bug report or feature request!"
+            f"A linear task was already created for this conversation! \nID: {existing['id']} \nTitle: {existing['title']}"
         )
+        return {
+            "action": "create",
+            "issue_id": existing["id"],
+            "title": existing["title"],
+            "replayed": True,
+        }
+    issue_dict = function_response["issueCreate"]["issue"]
+    await _remember_issue(ctx, issue_dict)
+    print(
+        f"Created new linear task for this conversation! \nID: {issue_dict['id']} \nTitle: {issue_dict['title']} \nDescription: {issue_dict['description']}"
+    )
+    return {
+        "action": "create",
+        "issue_id": issue_dict["id"],
+        "title": issue_dict["title"],
+    }
+
+
+async def _existing_issue(ctx: IntegrationContext, issue_id: str) -> Optional[Dict]:
+    try:
+        result = await aget_issue(ctx.linear, issue_id)
+    except TransportQueryError:
+        return None
+    return result.get("issue")
+
+
+async def _existing_comment(ctx: IntegrationContext, comment_id: str) -> Optional[Dict]:
+    try:
+        result = await aget_comment(ctx.linear, comment_id)
+    except TransportQueryError:
+        return None
+    return result.get("comment")
 
 
 def test_cases() -> None:
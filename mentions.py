@@ -0,0 +1,91 @@
+from typing import Dict, List, Optional
+import os
+import sqlite3
+import time
+
+# Conversations can be long, so linked excerpts only keep their beginning
+EXCERPT_CHARS = 500
+
+
+def conversation_excerpt(conversation: str, max_chars: int = EXCERPT_CHARS) -> str:
+    if len(conversation) <= max_chars:
+        return conversation
+    return conversation[:max_chars].rstrip() + "..."
+
+
+def mention_comment(count: int, conversation: str) -> str:
+    """Body of the Linear comment appended to a task each time a conversation
+    mentions it"""
+    quoted = "\n".join(
+        f"> {line}" for line in conversation_excerpt(conversation).splitlines()
+    )
+    times = "once" if count == 1 else f"{count} times"
+    return f"Mentioned in another support conversation (mentioned {times} so far):\n\n{quoted}"
+
+
+class MentionCounter:
+    """Counts how many conversations mention each task and keeps an excerpt of each
+    one, so matches don't need GPT to rewrite the task's description to track them.
+
+    Counts are kept in memory, and in SQLite at `path` if one is given so they
+    persist across runs.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self._counts: Dict[str, int] = {}
+        self._excerpts: Dict[str, List[str]] = {}
+        self._db = None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS mentions (
+                    issue_id TEXT NOT NULL,
+                    excerpt TEXT NOT NULL,
+                    mentioned_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS mentions_issue_id ON mentions (issue_id);
+                """
+            )
+            for issue_id, count in self._db.execute(
+                "SELECT issue_id, COUNT(*) FROM mentions GROUP BY issue_id"
+            ):
+                self._counts[issue_id] = count
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def record(self, issue_id: str, conversation: str) -> int:
+        """Records a mention of the task and returns its updated count"""
+        excerpt = conversation_excerpt(conversation)
+        self._counts[issue_id] = self._counts.get(issue_id, 0) + 1
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO mentions VALUES (?, ?, ?)",
+                    (issue_id, excerpt, time.time()),
+                )
+        else:
+            self._excerpts.setdefault(issue_id, []).append(excerpt)
+        return self._counts[issue_id]
+
+    def count(self, issue_id: str) -> int:
+        return self._counts.get(issue_id, 0)
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._counts)
+
+    def excerpts(self, issue_id: str) -> List[str]:
+        if self._db is None:
+            return list(self._excerpts.get(issue_id, []))
+        return [
+            excerpt
+            for (excerpt,) in self._db.execute(
+                "SELECT excerpt FROM mentions WHERE issue_id = ? ORDER BY mentioned_at",
+                (issue_id,),
+            )
+        ]
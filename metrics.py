@@ -0,0 +1,206 @@
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, Optional, Tuple
+import os
+import threading
+import time
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_PREFIX = "linear_integration_"
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> _Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: _Labels, extra: Tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def openai_operation(request: Dict) -> str:
+    """Labels an OpenAI request with the tool it offers the model, which tells the
+    prompts in gpt_helpers.py apart"""
+    if "input" in request and "messages" not in request:
+        return "embeddings"
+    tools = request.get("tools") or []
+    if tools:
+        return tools[0].get("function", {}).get("name", "chat_completion")
+    return "chat_completion"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metrics:
+    """Counters and latency histograms for every OpenAI and Linear call and every
+    stage of categorizing a conversation, exported in the Prometheus text format.
+
+    Calls record their wall time, outcome and (for OpenAI) prompt and completion
+    tokens, and the RateGovernor counts its retries here. With `tracing`, each
+    conversation is also an OpenTelemetry span with a child span per stage and per
+    call, sent wherever the application configured the OpenTelemetry SDK to send
+    them. A context without Metrics skips all of this.
+    """
+
+    def __init__(
+        self,
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+        tracing: bool = False,
+        prefix: str = METRIC_PREFIX,
+    ):
+        if tracing and trace is None:
+            raise ImportError("Tracing needs the opentelemetry-api package")
+        self.buckets = buckets
+        self.prefix = prefix
+        self.tracer = trace.get_tracer(__name__) if tracing else None
+        self.counters: Dict[str, Dict[_Labels, float]] = {}
+        self.histograms: Dict[str, Dict[_Labels, Histogram]] = {}
+        # Histograms can be observed from worker threads (e.g. index searches)
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(self.buckets)
+            series[key].observe(value)
+
+    def span(self, name: str, **attributes):
+        """Context manager for an OpenTelemetry span, or a no-op without tracing"""
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.start_as_current_span(
+            name, attributes={k: v for k, v in attributes.items() if v is not None}
+        )
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Times one stage of categorizing a conversation"""
+        started = time.perf_counter()
+        with self.span(stage):
+            try:
+                yield
+            finally:
+                self.observe(
+                    "stage_duration_seconds", time.perf_counter() - started, stage=stage
+                )
+
+    def record_call(
+        self,
+        service: str,
+        operation: str,
+        seconds: float,
+        outcome: str,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+    ) -> None:
+        self.inc("calls_total", service=service, operation=operation, outcome=outcome)
+        self.observe(
+            "call_duration_seconds", seconds, service=service, operation=operation
+        )
+        if prompt_tokens is not None:
+            self.inc("prompt_tokens_total", prompt_tokens, operation=operation)
+        if completion_tokens is not None:
+            self.inc("completion_tokens_total", completion_tokens, operation=operation)
+
+    def record_retry(self, service: str, operation: str) -> None:
+        self.inc("retries_total", service=service, operation=operation)
+
+    def record_conversation(self, seconds: float, action: str) -> None:
+        self.inc("conversations_total", action=action)
+        self.observe("conversation_duration_seconds", seconds)
+
+    def prometheus_text(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                metric = self.prefix + name
+                lines.append(f"# TYPE {metric} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{metric}{_format_labels(labels)} {value:g}")
+            for name, series in sorted(self.histograms.items()):
+                metric = self.prefix + name
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        bucket_labels = _format_labels(labels, (("le", f"{bound:g}"),))
+                        lines.append(f"{metric}_bucket{bucket_labels} {cumulative}")
+                    inf_labels = _format_labels(labels, (("le", "+Inf"),))
+                    lines.append(f"{metric}_bucket{inf_labels} {histogram.count}")
+                    lines.append(
+                        f"{metric}_sum{_format_labels(labels)} {histogram.sum:g}"
+                    )
+                    lines.append(
+                        f"{metric}_count{_format_labels(labels)} {histogram.count}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Writes the metrics for Prometheus' node exporter textfile collector, or
+        anything else that reads the text format from a file"""
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def summary(self) -> Dict[str, Dict]:
+        """Call counts, total seconds and tokens per operation, for printing"""
+        operations: Dict[str, Dict] = {}
+        with self._lock:
+            for labels, histogram in self.histograms.get(
+                "call_duration_seconds", {}
+            ).items():
+                labels = dict(labels)
+                operation = f"{labels['service']}:{labels['operation']}"
+                operations[operation] = {
+                    "calls": histogram.count,
+                    "seconds": round(histogram.sum, 3),
+                }
+            for name in ("prompt_tokens_total", "completion_tokens_total"):
+                for labels, value in self.counters.get(name, {}).items():
+                    operation = f"openai:{dict(labels)['operation']}"
+                    if operation in operations:
+                        operations[operation][name[: -len("_total")]] = int(value)
+            for labels, value in self.counters.get("retries_total", {}).items():
+                labels = dict(labels)
+                operation = f"{labels['service']}:{labels['operation']}"
+                operations.setdefault(operation, {})["retries"] = int(value)
+        return operations
@@ -0,0 +1,294 @@
+from typing import Dict, Iterable, List, Tuple
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from dedup import normalize_conversation
+
+PREFILTER_MODEL_PATH = ".cache/prefilter.npz"
+# Conversations are only dropped when the model gives them at least this probability
+# of needing nothing filed. Anything less certain goes to the LLM
+DEFAULT_THRESHOLD = 0.9
+DEFAULT_MIN_DF = 2
+DEFAULT_MAX_FEATURES = 50_000
+DEFAULT_EPOCHS = 300
+DEFAULT_LEARNING_RATE = 2.0
+DEFAULT_L2 = 1e-4
+# Outcome actions that mean something was (or would have been) filed
+ACTIONABLE_LABELS = ("actionable", "match", "create", "bug_report", "feature_request")
+IGNORE_LABELS = ("ignore", "general_query")
+
+
+def tokenize(conversation: str) -> List[str]:
+    """Words and word bigrams of the normalized conversation"""
+    words = normalize_conversation(conversation).split()
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def label_value(label: str) -> int:
+    """1 for conversations that needed a task, 0 for ones that didn't"""
+    if label in ACTIONABLE_LABELS:
+        return 1
+    if label in IGNORE_LABELS:
+        return 0
+    raise ValueError(
+        f"Unknown label {label!r}, expected one of {ACTIONABLE_LABELS + IGNORE_LABELS}"
+    )
+
+
+class PreClassifier:
+    """TF-IDF features over words and word bigrams with a logistic regression on
+    top, which estimates the probability that a conversation needs nothing filed
+    (the agent answered the question) in a few microseconds, without calling any
+    API.
+
+    Only conversations it puts at or above `threshold` are dropped; everything else
+    goes on to the LLM as usual. Train it on labelled transcripts with
+    `python prefilter.py train`, and pick a threshold with
+    `python prefilter.py evaluate`.
+    """
+
+    def __init__(
+        self,
+        vocabulary: Dict[str, int],
+        idf: np.ndarray,
+        weights: np.ndarray,
+        bias: float,
+        threshold: float = DEFAULT_THRESHOLD,
+    ):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.threshold = threshold
+        self.checked = 0
+        self.dropped = 0
+
+    @classmethod
+    def train(
+        cls,
+        conversations: List[str],
+        labels: List[int],
+        min_df: int = DEFAULT_MIN_DF,
+        max_features: int = DEFAULT_MAX_FEATURES,
+        epochs: int = DEFAULT_EPOCHS,
+        learning_rate: float = DEFAULT_LEARNING_RATE,
+        l2: float = DEFAULT_L2,
+        threshold: float = DEFAULT_THRESHOLD,
+    ) -> "PreClassifier":
+        """Fits the model, where `labels` are 1 for conversations that needed a
+        task and 0 for those that didn't"""
+        if len(set(labels)) < 2:
+            raise ValueError("Training needs both actionable and ignored conversations")
+        documents = [set(tokenize(c)) for c in conversations]
+        document_frequency: Dict[str, int] = {}
+        for tokens in documents:
+            for token in tokens:
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        terms = sorted(
+            (t for t, df in document_frequency.items() if df >= min_df),
+            key=lambda t: (-document_frequency[t], t),
+        )[:max_features]
+        vocabulary = {term: i for i, term in enumerate(terms)}
+        idf = np.array(
+            [
+                np.log((1 + len(documents)) / (1 + document_frequency[t])) + 1
+                for t in terms
+            ],
+            dtype=np.float32,
+        )
+        model = cls(vocabulary, idf, np.zeros(len(terms), np.float32), 0.0, threshold)
+
+        # Logistic regression by full-batch gradient descent over the sparse rows.
+        # The negative class is the one we act on, so classes are weighted equally
+        rows, indices, values = model._features_batch(conversations)
+        y = 1 - np.asarray(labels, dtype=np.float32)
+        class_weight = np.where(y == 1, 0.5 / y.mean(), 0.5 / (1 - y.mean()))
+        count = len(conversations)
+        for _ in range(epochs):
+            scores = (
+                np.bincount(rows, model.weights[indices] * values, minlength=count)
+                + model.bias
+            )
+            error = (_sigmoid(scores) - y) * class_weight / count
+            gradient = np.bincount(
+                indices, values * error[rows], minlength=len(terms)
+            ).astype(np.float32)
+            model.weights -= learning_rate * (gradient + l2 * model.weights)
+            model.bias -= learning_rate * float(error.sum())
+        return model
+
+    def _features(self, conversation: str) -> Tuple[np.ndarray, np.ndarray]:
+        counts: Dict[int, int] = {}
+        for token in tokenize(conversation):
+            index = self.vocabulary.get(token)
+            if index is not None:
+                counts[index] = counts.get(index, 0) + 1
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        values *= self.idf[indices]
+        norm = np.linalg.norm(values)
+        return indices, values / norm if norm else values
+
+    def _features_batch(
+        self, conversations: Iterable[str]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        rows, indices, values = [], [], []
+        for row, conversation in enumerate(conversations):
+            row_indices, row_values = self._features(conversation)
+            rows.append(np.full(len(row_indices), row, dtype=np.int64))
+            indices.append(row_indices)
+            values.append(row_values)
+        return np.concatenate(rows), np.concatenate(indices), np.concatenate(values)
+
+    def ignore_probability(self, conversation: str) -> float:
+        """Probability that the conversation needs nothing filed"""
+        indices, values = self._features(conversation)
+        return float(_sigmoid(float(self.weights[indices] @ values) + self.bias))
+
+    def should_drop(self, conversation: str) -> Tuple[bool, float]:
+        """Whether the conversation can be ignored without asking the LLM, and the
+        model's probability that it needs nothing filed"""
+        probability = self.ignore_probability(conversation)
+        self.checked += 1
+        drop = probability >= self.threshold
+        self.dropped += drop
+        return drop, probability
+
+    def stats(self) -> Dict:
+        return {
+            "checked": self.checked,
+            "dropped": self.dropped,
+            "drop_rate": self.dropped / self.checked if self.checked else 0.0,
+        }
+
+    def save(self, path: str = PREFILTER_MODEL_PATH) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        # np.savez adds .npz to paths that don't end in it, so write through a file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                terms=np.array(terms, dtype=str),
+                idf=self.idf,
+                weights=self.weights,
+                bias=np.array(self.bias),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(
+        cls, path: str = PREFILTER_MODEL_PATH, threshold: float = DEFAULT_THRESHOLD
+    ) -> "PreClassifier":
+        with np.load(path) as data:
+            vocabulary = {str(term): i for i, term in enumerate(data["terms"])}
+            return cls(
+                vocabulary,
+                data["idf"],
+                data["weights"],
+                float(data["bias"]),
+                threshold,
+            )
+
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-np.clip(x, -30, 30)))
+
+
+def read_labelled(path: str) -> Tuple[List[str], List[int]]:
+    """Reads a JSONL file of objects with a "conversation" field and a "label"
+    field, or an "action" field in its place. Outcome logs only hold each
+    conversation's source and line, so join their actions back onto the
+    conversations before training on them"""
+    conversations, labels = [], []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            conversations.append(record["conversation"])
+            labels.append(label_value(record.get("label", record.get("action"))))
+    return conversations, labels
+
+
+def evaluate(
+    model: PreClassifier,
+    conversations: List[str],
+    labels: List[int],
+    thresholds: Iterable[float] = (0.5, 0.7, 0.8, 0.9, 0.95, 0.99),
+) -> List[Dict]:
+    """How many conversations each threshold would drop, and how many of those
+    actually needed a task"""
+    probabilities = np.array([model.ignore_probability(c) for c in conversations])
+    labels = np.asarray(labels)
+    report = []
+    for threshold in thresholds:
+        dropped = probabilities >= threshold
+        wrongly_dropped = int((dropped & (labels == 1)).sum())
+        report.append(
+            {
+                "threshold": threshold,
+                "drop_rate": float(dropped.mean()),
+                # Of the conversations dropped, the share that really needed nothing
+                "precision": (
+                    float(1 - wrongly_dropped / dropped.sum()) if dropped.any() else 1.0
+                ),
+                # Of the conversations that needed nothing, the share dropped
+                "recall": (
+                    float(dropped[labels == 0].mean()) if (labels == 0).any() else 0.0
+                ),
+                "missed_tasks": wrongly_dropped,
+            }
+        )
+    return report
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Train or evaluate the local pre-classifier that drops conversations needing nothing filed"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser("train")
+    train_parser.add_argument(
+        "data",
+        help='JSONL file of {"conversation": ..., "label": "actionable"|"ignore"} objects',
+    )
+    train_parser.add_argument("--model", default=PREFILTER_MODEL_PATH)
+    train_parser.add_argument("--min-df", type=int, default=DEFAULT_MIN_DF)
+    train_parser.add_argument("--epochs", type=int, default=DEFAULT_EPOCHS)
+    evaluate_parser = commands.add_parser("evaluate")
+    evaluate_parser.add_argument("data", help="Held-out JSONL file, as for train")
+    evaluate_parser.add_argument("--model", default=PREFILTER_MODEL_PATH)
+    args = parser.parse_args()
+
+    conversations, labels = read_labelled(args.data)
+    if args.command == "train":
+        model = PreClassifier.train(
+            conversations, labels, min_df=args.min_df, epochs=args.epochs
+        )
+        model.save(args.model)
+        print(
+            f"Trained on {len(conversations)} conversations with {len(model.vocabulary)} features, saved to {args.model}"
+        )
+        return
+
+    model = PreClassifier.load(args.model)
+    started = time.perf_counter()
+    for conversation in conversations:
+        model.ignore_probability(conversation)
+    microseconds = (time.perf_counter() - started) / len(conversations) * 1e6
+    print(f"{len(conversations)} conversations, {microseconds:.0f}us per prediction")
+    print("threshold  drop rate  precision  recall  missed tasks")
+    for row in evaluate(model, conversations, labels):
+        print(
+            f"{row['threshold']:>9}  {row['drop_rate']:>9.1%}  {row['precision']:>9.1%}  {row['recall']:>6.1%}  {row['missed_tasks']:>12}"
+        )
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,154 @@
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import time
+
+from gpt_helpers import batch_ranking_request, parse_batch_ranking, rank_candidates
+from integration_context import IntegrationContext
+
+# Rank once this many conversations are pending, or once the oldest has waited this
+# long
+DEFAULT_MAX_BATCH_SIZE = 4
+DEFAULT_MAX_WAIT = 0.25
+
+
+def merge_candidates(shortlists: List[List[Dict]]) -> List[Dict]:
+    """One list of every candidate across the shortlists, in order of first
+    appearance"""
+    merged, seen = [], set()
+    for shortlist in shortlists:
+        for issue in shortlist:
+            if issue["id"] not in seen:
+                seen.add(issue["id"])
+                merged.append(issue)
+    return merged
+
+
+class RankingBatcher:
+    """Collects rank_candidates calls from concurrent conversations and ranks them
+    in one prompt against the union of their shortlists, so the instructions, tool
+    schema and shared candidates are paid for once per batch instead of once per
+    conversation.
+
+    A batch is sent once `max_batch_size` conversations are pending or `max_wait`
+    seconds after the first one arrived, so each conversation can wait up to
+    `max_wait` longer for its decision. Conversations the model leaves without a
+    decision are ranked again on their own.
+    """
+
+    def __init__(
+        self,
+        ctx: IntegrationContext,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait: float = DEFAULT_MAX_WAIT,
+    ):
+        self.ctx = ctx
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches_sent = 0
+        self.conversations_sent = 0
+        self.fallbacks = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds_waited = 0.0
+        self._pending: List[Tuple[str, List[Dict], float, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._in_flight: Set[asyncio.Task] = set()
+
+    async def rank(
+        self, conversation: str, candidates: List[Dict]
+    ) -> Tuple[Dict, List[Dict]]:
+        """Returns the decision for the conversation and the candidates it was
+        made against, which may include other conversations' candidates"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((conversation, candidates, time.perf_counter(), future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush_pending)
+        return await future
+
+    def _flush_pending(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def flush(self) -> None:
+        """Sends anything pending and waits for every batch in flight"""
+        self._flush_pending()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    async def _send(
+        self, batch: List[Tuple[str, List[Dict], float, asyncio.Future]]
+    ) -> None:
+        sent_at = time.perf_counter()
+        self.batches_sent += 1
+        self.conversations_sent += len(batch)
+        self.seconds_waited += sum(sent_at - queued_at for _, _, queued_at, _ in batch)
+        candidates = merge_candidates([shortlist for _, shortlist, _, _ in batch])
+
+        if len(batch) == 1:
+            decisions = [None]
+        else:
+            try:
+                response = await self.ctx.chat_completion(
+                    **batch_ranking_request(
+                        [conversation for conversation, _, _, _ in batch], candidates
+                    )
+                )
+            except Exception as e:
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            self._count_usage(response)
+            decisions = parse_batch_ranking(response, len(batch), candidates)
+
+        for (conversation, shortlist, _, future), decision in zip(batch, decisions):
+            if future.done():
+                continue
+            if decision is not None:
+                future.set_result((decision, candidates))
+                continue
+            # A batch of one, or a conversation the model skipped, is ranked with
+            # the single-conversation prompt against its own shortlist
+            self.fallbacks += len(batch) > 1
+            try:
+                decision = await rank_candidates(self.ctx, conversation, shortlist)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result((decision, shortlist))
+
+    def _count_usage(self, response) -> None:
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.prompt_tokens += usage.prompt_tokens
+            self.completion_tokens += usage.completion_tokens
+
+    def stats(self) -> Dict:
+        return {
+            "batches": self.batches_sent,
+            "conversations": self.conversations_sent,
+            "mean_batch_size": (
+                round(self.conversations_sent / self.batches_sent, 2)
+                if self.batches_sent
+                else 0
+            ),
+            "mean_seconds_waited": (
+                round(self.seconds_waited / self.conversations_sent, 4)
+                if self.conversations_sent
+                else 0
+            ),
+            "fallbacks": self.fallbacks,
+            "batch_prompt_tokens": self.prompt_tokens,
+            "batch_completion_tokens": self.completion_tokens,
+        }
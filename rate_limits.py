@@ -0,0 +1,346 @@
+from gql.transport.exceptions import (
+    TransportConnectionFailed,
+    TransportQueryError,
+    TransportServerError,
+)
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+from typing import Awaitable, Callable, Dict, Mapping, Optional
+import asyncio
+import json
+import random
+import re
+import time
+
+import aiohttp
+
+from metrics import Metrics, openai_operation
+
+# OpenAI's limits depend on the account's usage tier, so these are conservative
+# defaults that the response headers will correct
+DEFAULT_OPENAI_REQUESTS_PER_MINUTE = 500
+DEFAULT_OPENAI_TOKENS_PER_MINUTE = 30_000
+# Linear's documented limits for API key authentication
+DEFAULT_LINEAR_REQUESTS_PER_HOUR = 1_500
+DEFAULT_LINEAR_COMPLEXITY_PER_HOUR = 250_000
+# Complexity we assume for an operation until Linear has told us its actual cost
+DEFAULT_LINEAR_COMPLEXITY = 100
+# Expected completion length, since the response size isn't known up front
+DEFAULT_COMPLETION_TOKENS = 256
+# Fraction of each limit we aim to use, so we stay just under it instead of on it
+DEFAULT_HEADROOM = 0.9
+DEFAULT_MAX_ATTEMPTS = 6
+BASE_RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 60.0
+
+
+class TokenBucket:
+    """Continuously refilling token bucket. Callers wait in FIFO order for
+    capacity, which applies backpressure to every coroutine sharing the bucket"""
+
+    def __init__(self, limit: float, period: float):
+        self.capacity = limit
+        self.rate = limit / period
+        self.tokens = limit
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                paused_for = self._paused_until - time.monotonic()
+                if paused_for > 0:
+                    await asyncio.sleep(paused_for)
+                elif self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                else:
+                    await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def charge(self, amount: float) -> None:
+        """Adjusts for the difference between what was acquired and what a call
+        actually cost. Negative amounts refund tokens"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def observe(self, remaining: Optional[float], reset_in: Optional[float]) -> None:
+        """Aligns the bucket with the remaining budget reported by the server"""
+        if remaining is None:
+            return
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0 and reset_in:
+            self.pause(reset_in)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(MAX_RETRY_DELAY, BASE_RETRY_DELAY * 2**attempt))
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    # OpenAI reports resets as durations like "20ms", "1s" or "6m0s"
+    if not value:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return _parse_float(value)
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def _parse_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_epoch_ms(value: Optional[str]) -> Optional[float]:
+    # Linear reports resets as UTC epoch timestamps in milliseconds
+    timestamp = _parse_float(value)
+    if timestamp is None:
+        return None
+    return max(0.0, timestamp / 1000 - time.time())
+
+
+def _retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    if not headers:
+        return None
+    retry_after_ms = _parse_float(headers.get("retry-after-ms"))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return _parse_float(headers.get("retry-after"))
+
+
+def _linear_rate_limited(error: Exception) -> bool:
+    """Whether Linear refused the request for exceeding a rate limit, in which case
+    it wasn't carried out"""
+    if isinstance(error, TransportQueryError):
+        return any(
+            (e.get("extensions") or {}).get("code") == "RATELIMITED"
+            for e in (error.errors or [])
+            if isinstance(e, dict)
+        )
+    return isinstance(error, TransportServerError) and error.code == 429
+
+
+def estimate_prompt_tokens(request: Dict) -> int:
+    # Roughly four characters per token for English text and JSON
+    size = len(json.dumps(request.get("messages", [])))
+    size += len(json.dumps(request.get("tools", [])))
+    size += len(json.dumps(request.get("input", [])))
+    return size // 4
+
+
+class RateGovernor:
+    """Keeps OpenAI and Linear traffic just under their rate limits.
+
+    OpenAI calls draw from requests-per-minute and tokens-per-minute buckets, and
+    Linear calls from requests-per-hour and complexity-per-hour buckets. Response
+    headers keep the buckets in line with the servers' own accounting, and throttled
+    or transiently failing calls are retried with jittered exponential backoff. One
+    governor can be shared between several IntegrationContexts.
+    """
+
+    def __init__(
+        self,
+        openai_requests_per_minute: float = DEFAULT_OPENAI_REQUESTS_PER_MINUTE,
+        openai_tokens_per_minute: float = DEFAULT_OPENAI_TOKENS_PER_MINUTE,
+        linear_requests_per_hour: float = DEFAULT_LINEAR_REQUESTS_PER_HOUR,
+        linear_complexity_per_hour: float = DEFAULT_LINEAR_COMPLEXITY_PER_HOUR,
+        headroom: float = DEFAULT_HEADROOM,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.headroom = headroom
+        self.metrics = metrics
+        self.max_attempts = max_attempts
+        self.openai_requests = TokenBucket(openai_requests_per_minute * headroom, 60)
+        self.openai_tokens = TokenBucket(openai_tokens_per_minute * headroom, 60)
+        self.linear_requests = TokenBucket(linear_requests_per_hour * headroom, 3600)
+        self.linear_complexity = TokenBucket(
+            linear_complexity_per_hour * headroom, 3600
+        )
+        self.retries = 0
+        self._linear_complexity_estimates: Dict[str, float] = {}
+
+    def share(self, fraction: float) -> "RateGovernor":
+        """A separate governor for `fraction` of this one's limits, e.g. to give
+        each team its own budget so a busy one can't use up the others'"""
+        return RateGovernor(
+            openai_requests_per_minute=self.openai_requests.capacity
+            / self.headroom
+            * fraction,
+            openai_tokens_per_minute=self.openai_tokens.capacity
+            / self.headroom
+            * fraction,
+            linear_requests_per_hour=self.linear_requests.capacity
+            / self.headroom
+            * fraction,
+            linear_complexity_per_hour=self.linear_complexity.capacity
+            / self.headroom
+            * fraction,
+            headroom=self.headroom,
+            max_attempts=self.max_attempts,
+            metrics=self.metrics,
+        )
+
+    async def _with_retries(
+        self,
+        attempt: Callable[[], Awaitable],
+        retry_delay: Callable[[Exception, int], Optional[float]],
+        service: str,
+        operation: str,
+    ):
+        for attempt_number in range(self.max_attempts):
+            try:
+                return await attempt()
+            except Exception as e:
+                delay = retry_delay(e, attempt_number)
+                if delay is None or attempt_number == self.max_attempts - 1:
+                    raise
+                self.retries += 1
+                if self.metrics is not None:
+                    self.metrics.record_retry(service, operation)
+                await asyncio.sleep(delay)
+
+    async def openai_call(self, create: Callable[[], Awaitable], request: Dict):
+        """Runs `create`, which must return a raw (`with_raw_response`) response,
+        under the OpenAI limits and returns the parsed response"""
+        estimated_tokens = estimate_prompt_tokens(request) + request.get(
+            "max_tokens", DEFAULT_COMPLETION_TOKENS
+        )
+
+        async def attempt():
+            await self.openai_requests.acquire()
+            await self.openai_tokens.acquire(estimated_tokens)
+            try:
+                raw_response = await create()
+            except APIStatusError as e:
+                self._observe_openai(e.response.headers)
+                raise
+            self._observe_openai(raw_response.headers)
+            response = raw_response.parse()
+            if getattr(response, "usage", None) is not None:
+                self.openai_tokens.charge(
+                    response.usage.total_tokens - estimated_tokens
+                )
+            return response
+
+        return await self._with_retries(
+            attempt, self._openai_retry_delay, "openai", openai_operation(request)
+        )
+
+    def _observe_openai(self, headers: Mapping[str, str]) -> None:
+        self.openai_requests.observe(
+            _parse_float(headers.get("x-ratelimit-remaining-requests")),
+            _parse_duration(headers.get("x-ratelimit-reset-requests")),
+        )
+        self.openai_tokens.observe(
+            _parse_float(headers.get("x-ratelimit-remaining-tokens")),
+            _parse_duration(headers.get("x-ratelimit-reset-tokens")),
+        )
+
+    def _openai_retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        if isinstance(error, (APIConnectionError, APITimeoutError)):
+            return backoff_delay(attempt)
+        if not isinstance(error, APIStatusError):
+            return None
+        if error.status_code == 429:
+            delay = max(
+                _retry_after(error.response.headers) or 0, backoff_delay(attempt)
+            )
+            # Make every other caller back off too, instead of piling onto the limit
+            self.openai_requests.pause(delay)
+            return delay
+        if error.status_code >= 500:
+            return backoff_delay(attempt)
+        return None
+
+    async def linear_call(
+        self,
+        execute: Callable[[], Awaitable],
+        operation_name: str,
+        response_headers: Callable[[], Optional[Mapping[str, str]]],
+        idempotent: bool = True,
+    ):
+        """Runs `execute` under the Linear limits. `response_headers` returns the
+        headers of the response to the latest attempt. Unless it's `idempotent`,
+        the call is only retried when Linear rate limited it, as a server error or
+        lost connection may come after it was carried out"""
+        estimated_complexity = self._linear_complexity_estimates.get(
+            operation_name, DEFAULT_LINEAR_COMPLEXITY
+        )
+
+        async def attempt():
+            await self.linear_requests.acquire()
+            await self.linear_complexity.acquire(estimated_complexity)
+            try:
+                return await execute()
+            finally:
+                self._observe_linear(
+                    response_headers(), operation_name, estimated_complexity
+                )
+
+        def retry_delay(error: Exception, attempt_number: int) -> Optional[float]:
+            if not idempotent and not _linear_rate_limited(error):
+                return None
+            return self._linear_retry_delay(error, attempt_number)
+
+        return await self._with_retries(attempt, retry_delay, "linear", operation_name)
+
+    def _observe_linear(
+        self,
+        headers: Optional[Mapping[str, str]],
+        operation_name: str,
+        estimated_complexity: float,
+    ) -> None:
+        if not headers:
+            return
+        complexity = _parse_float(headers.get("X-Complexity"))
+        if complexity is not None:
+            self._linear_complexity_estimates[operation_name] = complexity
+            self.linear_complexity.charge(complexity - estimated_complexity)
+        self.linear_requests.observe(
+            _parse_float(headers.get("X-RateLimit-Requests-Remaining")),
+            _parse_epoch_ms(headers.get("X-RateLimit-Requests-Reset")),
+        )
+        self.linear_complexity.observe(
+            _parse_float(headers.get("X-RateLimit-Complexity-Remaining")),
+            _parse_epoch_ms(headers.get("X-RateLimit-Complexity-Reset")),
+        )
+
+    def _linear_retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        if isinstance(error, TransportQueryError):
+            if not _linear_rate_limited(error):
+                return None
+            delay = backoff_delay(attempt)
+            self.linear_requests.pause(delay)
+            return delay
+        if isinstance(error, TransportServerError):
+            if error.code == 429 or (error.code or 0) >= 500:
+                return backoff_delay(attempt)
+            return None
+        if isinstance(
+            error,
+            (
+                TransportConnectionFailed,
+                aiohttp.ClientConnectionError,
+                asyncio.TimeoutError,
+            ),
+        ):
+            return backoff_delay(attempt)
+        return None
@@ -0,0 +1,332 @@
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+import asyncio
+import json
+import os
+import re
+
+from gpt_helpers import parse_routing, routing_request
+from integration_context import IntegrationContext
+from issue_cache import IssueCache
+from issue_index import IssueIndex, make_embedder
+from main import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_TOP_K,
+    MATCHING_MODES,
+    Conversation,
+    categorize_conversation_async,
+    keyed_conversation,
+)
+from rate_limits import RateGovernor
+
+TEAMS_STATE_DIR = ".cache/teams"
+# Conversations waiting for each team's workers before submitting more blocks
+DEFAULT_TEAM_QUEUE_SIZE = 100
+# Share of the rate limits kept for the router's own calls to the model
+DEFAULT_ROUTER_SHARE = 0.05
+
+
+class Team:
+    """A Linear team conversations can be routed to. `keywords` route a
+    conversation without asking the model, and `description` is what the model
+    is shown when no keyword settles it. `share` is the team's fraction of the
+    rate limits (by default, an equal split of what isn't given out explicitly),
+    and `concurrency` the number of conversations it works on at once"""
+
+    def __init__(
+        self,
+        name: str,
+        team_id: str,
+        description: str = "",
+        keywords: Iterable[str] = (),
+        share: Optional[float] = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        self.name = name
+        self.team_id = team_id
+        self.description = description
+        self.keywords = list(keywords)
+        self.share = share
+        self.concurrency = concurrency
+        self._keyword_pattern = (
+            re.compile(
+                r"\b(?:" + "|".join(map(re.escape, self.keywords)) + r")\b",
+                re.IGNORECASE,
+            )
+            if self.keywords
+            else None
+        )
+
+    def keyword_hits(self, conversation: str) -> int:
+        if self._keyword_pattern is None:
+            return 0
+        return len(self._keyword_pattern.findall(conversation))
+
+
+def load_teams(path: str) -> List[Team]:
+    """Reads a JSON list of objects with Team's arguments"""
+    with open(path) as f:
+        return [Team(**team) for team in json.load(f)]
+
+
+def team_shares(teams: List[Team], reserved: float = 0.0) -> Dict[str, float]:
+    """Each team's fraction of the rate limits. Teams without an explicit share
+    split whatever the others and `reserved` leave over equally"""
+    explicit = sum(team.share for team in teams if team.share is not None)
+    implicit = [team for team in teams if team.share is None]
+    remaining = 1.0 - reserved - explicit
+    if remaining < 0 or (implicit and remaining <= 0):
+        raise ValueError("The teams' shares of the rate limits add up to more than 1")
+    return {
+        team.name: (team.share if team.share is not None else remaining / len(implicit))
+        for team in teams
+    }
+
+
+def team_context(
+    team: Team,
+    governor: RateGovernor,
+    state_dir: str = TEAMS_STATE_DIR,
+    embedder=None,
+    **kwargs,
+) -> IntegrationContext:
+    """An IntegrationContext for one team, with its own issue cache and index (its
+    shard of the backlog) under `state_dir` and its own `governor`. `embedder` is
+    an embedder, or the name of one in issue_index.EMBEDDERS to make for the
+    team's context ("hashing" by default). Other IntegrationContext arguments are
+    passed through"""
+    directory = os.path.join(state_dir, team.name)
+    os.makedirs(directory, exist_ok=True)
+    ctx = IntegrationContext(
+        team_id=team.team_id,
+        issue_cache=IssueCache(os.path.join(directory, "issues.db")),
+        governor=governor,
+        **kwargs,
+    )
+    if embedder is None or isinstance(embedder, str):
+        embedder = make_embedder(embedder or "hashing", ctx)
+    ctx.issue_index = IssueIndex(os.path.join(directory, "index"), embedder)
+    return ctx
+
+
+class TeamRouter:
+    """Decides which team a conversation goes to. The team with the most keyword
+    hits wins; if no team has any, or several tie, the model picks between the
+    teams' descriptions when the router has a context to ask it through, and the
+    conversation goes to the `default` team (the first one, unless named)
+    otherwise"""
+
+    def __init__(
+        self,
+        teams: List[Team],
+        ctx: Optional[IntegrationContext] = None,
+        default: Optional[str] = None,
+    ):
+        if not teams:
+            raise ValueError("Routing needs at least one team")
+        self.teams = {team.name: team for team in teams}
+        self.ctx = ctx
+        self.default = self.teams[default] if default is not None else teams[0]
+        self.routed: Dict[str, int] = {"keyword": 0, "model": 0, "default": 0}
+
+    def keyword_route(self, conversation: str) -> Optional[Team]:
+        hits = [(team.keyword_hits(conversation), team) for team in self.teams.values()]
+        best = max(count for count, _ in hits)
+        winners = [team for count, team in hits if count == best]
+        if best == 0 or len(winners) > 1:
+            return None
+        return winners[0]
+
+    async def route(self, conversation: str) -> Team:
+        team = self.keyword_route(conversation)
+        if team is not None:
+            self.routed["keyword"] += 1
+            return team
+        if self.ctx is not None and len(self.teams) > 1:
+            response = await self.ctx.chat_completion(
+                **routing_request(
+                    conversation,
+                    [
+                        {"name": team.name, "description": team.description}
+                        for team in self.teams.values()
+                    ],
+                )
+            )
+            name = parse_routing(response)
+            if name in self.teams:
+                self.routed["model"] += 1
+                return self.teams[name]
+        self.routed["default"] += 1
+        return self.default
+
+
+class MultiTeamCategorizer:
+    """Routes conversations to teams and categorizes each one with its team's
+    context, so it's only matched against that team's shard of the backlog and new
+    tasks are created in that team.
+
+    Every team has its own queue, pool of `Team.concurrency` workers and rate
+    budget (the contexts' governors), so a busy team only slows itself down:
+    conversations for other teams keep their workers and calls. Use it as an
+    async context manager, which opens the teams' and the router's contexts and
+    starts the workers.
+    """
+
+    def __init__(
+        self,
+        router: TeamRouter,
+        contexts: Dict[str, IntegrationContext],
+        matching_mode: str = "ranked",
+        top_k: int = DEFAULT_TOP_K,
+        queue_size: int = DEFAULT_TEAM_QUEUE_SIZE,
+    ):
+        if matching_mode not in MATCHING_MODES:
+            raise ValueError(
+                f"Unknown matching mode {matching_mode!r}, expected one of {MATCHING_MODES}"
+            )
+        if set(contexts) != set(router.teams):
+            raise ValueError("Expected exactly one context per team")
+        self.router = router
+        self.contexts = contexts
+        self.matching_mode = matching_mode
+        self.top_k = top_k
+        self.queue_size = queue_size
+        self.processed: Dict[str, int] = {name: 0 for name in router.teams}
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._workers: List[asyncio.Task] = []
+
+    async def __aenter__(self) -> "MultiTeamCategorizer":
+        if self.router.ctx is not None:
+            await self.router.ctx.aopen()
+        for name, ctx in self.contexts.items():
+            await ctx.aopen()
+            self._queues[name] = asyncio.Queue(maxsize=self.queue_size)
+            self._workers += [
+                asyncio.create_task(self._worker(name, ctx))
+                for _ in range(self.router.teams[name].concurrency)
+            ]
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for ctx in self.contexts.values():
+            await ctx.aclose()
+        if self.router.ctx is not None:
+            await self.router.ctx.aclose()
+
+    async def _worker(self, name: str, ctx: IntegrationContext) -> None:
+        queue = self._queues[name]
+        while True:
+            conversation, record_key, future = await queue.get()
+            try:
+                outcome = await categorize_conversation_async(
+                    conversation, ctx, self.matching_mode, self.top_k, record_key
+                )
+                if not future.done():
+                    future.set_result(outcome)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.processed[name] += 1
+                queue.task_done()
+
+    async def categorize(
+        self, conversation: str, record_key: Optional[str] = None
+    ) -> Dict:
+        """Routes and categorizes one conversation, returning its outcome with
+        the name of the team it went to"""
+        team = await self.router.route(conversation)
+        future = asyncio.get_running_loop().create_future()
+        await self._queues[team.name].put((conversation, record_key, future))
+        return {**await future, "team": team.name}
+
+    async def categorize_stream(
+        self,
+        conversations: Union[Iterable[Conversation], AsyncIterable[Conversation]],
+        lookahead: Optional[int] = None,
+    ) -> AsyncIterator[Tuple[int, Union[Dict, Exception]]]:
+        """Like main.categorize_stream, takes strings or `(record_key,
+        conversation)` pairs and yields `(index, result)` pairs in the order
+        they finish. Up to `lookahead` conversations (by default, as many as the
+        teams' queues and workers hold) are read ahead, so when one team falls
+        behind, the others keep going until that many are waiting for it"""
+        if lookahead is None:
+            lookahead = sum(
+                self.queue_size + team.concurrency
+                for team in self.router.teams.values()
+            )
+        slots = asyncio.Semaphore(lookahead)
+        results: asyncio.Queue = asyncio.Queue()
+        tasks = set()
+
+        async def categorize(index: int, conversation: Conversation) -> None:
+            record_key, conversation = keyed_conversation(conversation)
+            try:
+                result = await self.categorize(conversation, record_key)
+            except Exception as e:
+                result = e
+            finally:
+                slots.release()
+            await results.put((index, result))
+
+        async def submit(index: int, conversation: Conversation) -> None:
+            await slots.acquire()
+            task = asyncio.create_task(categorize(index, conversation))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        async def feed() -> None:
+            try:
+                if hasattr(conversations, "__aiter__"):
+                    index = 0
+                    async for conversation in conversations:
+                        await submit(index, conversation)
+                        index += 1
+                else:
+                    for index, conversation in enumerate(conversations):
+                        await submit(index, conversation)
+                if tasks:
+                    await asyncio.gather(*tasks)
+            finally:
+                results.put_nowait(None)
+
+        feeder = asyncio.create_task(feed())
+        try:
+            while True:
+                item = await results.get()
+                if item is None:
+                    break
+                yield item
+            await feeder
+        finally:
+            for task in list(tasks) + [feeder]:
+                task.cancel()
+
+    def stats(self) -> Dict:
+        return {
+            "routed": dict(self.router.routed),
+            "teams": {
+                name: {
+                    "processed": self.processed[name],
+                    "queued": queue.qsize(),
+                    "issues": (
+                        len(self.contexts[name].issue_index)
+                        if self.contexts[name].issue_index is not None
+                        else None
+                    ),
+                }
+                for name, queue in self._queues.items()
+            },
+        }
@@ -0,0 +1,343 @@
+from aiohttp import web
+from collections import OrderedDict
+from typing import Dict, Optional
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import math
+import os
+import time
+import uuid
+
+from completion_cache import CompletionCache
+from dedup import DedupIndex
+from integration_context import IntegrationContext
+from issue_cache import ISSUE_CACHE_PATH, IssueCache
+from issue_index import EMBEDDERS, ISSUE_INDEX_PATH, IssueIndex, make_embedder
+from main import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_TOP_K,
+    MATCHING_MODES,
+    categorize_conversation_async,
+)
+from mentions import MentionCounter
+from metrics import Metrics
+
+DEFAULT_QUEUE_SIZE = 1000
+# Finished jobs are kept for status lookups, oldest dropped first, up to this many
+DEFAULT_MAX_RESULTS = 10_000
+# Webhook deliveries older than this are rejected as possible replays
+WEBHOOK_MAX_AGE = 60.0
+# How long shutdown waits for queued conversations before dropping them
+DEFAULT_DRAIN_TIMEOUT = 30.0
+
+
+def verify_linear_signature(secret: str, body: bytes, signature: Optional[str]) -> bool:
+    """Checks the Linear-Signature header, an HMAC-SHA256 of the raw body"""
+    if not signature:
+        return False
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+class IngestService:
+    """Long-running categorization service.
+
+    Conversations POSTed to /conversations are put on a bounded queue and drained
+    by a pool of workers sharing one IntegrationContext; once the queue is full,
+    requests are refused with 503 and a Retry-After header so senders back off.
+    With a `webhook_secret`, Linear webhooks POSTed to /webhooks/linear keep the
+    context's issue cache and index current as issues are created, updated and
+    archived, so the backlog is only listed once, at startup. Without one, there's
+    no webhook route and the issue cache polls Linear for changes instead. /healthz and /queue report liveness and queue
+    depth.
+
+    Queued conversations only live in memory. Use ingest.py where every
+    conversation must survive a restart.
+    """
+
+    def __init__(
+        self,
+        ctx: IntegrationContext,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        workers: int = DEFAULT_CONCURRENCY,
+        matching_mode: str = "ranked",
+        top_k: int = DEFAULT_TOP_K,
+        webhook_secret: Optional[str] = None,
+        max_results: int = DEFAULT_MAX_RESULTS,
+        drain_timeout: float = DEFAULT_DRAIN_TIMEOUT,
+    ):
+        if ctx.issue_cache is None:
+            ctx.issue_cache = IssueCache(":memory:")
+        if webhook_secret:
+            # Webhooks keep it current, so it never needs to re-poll Linear
+            ctx.issue_cache.sync_interval = math.inf
+        self.ctx = ctx
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.worker_count = workers
+        self.matching_mode = matching_mode
+        self.top_k = top_k
+        self.webhook_secret = webhook_secret
+        self.max_results = max_results
+        self.drain_timeout = drain_timeout
+        self.results: "OrderedDict[str, Dict]" = OrderedDict()
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.webhook_events = 0
+        self.started_at = time.time()
+        self._workers = []
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/conversations", self.handle_conversations)
+        app.router.add_get("/conversations/{job_id}", self.handle_job)
+        # Unsigned deliveries could rewrite the backlog, so there's no webhook
+        # route without a secret to check them against
+        if self.webhook_secret:
+            app.router.add_post("/webhooks/linear", self.handle_webhook)
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/queue", self.handle_queue)
+        if self.ctx.metrics is not None:
+            app.router.add_get("/metrics", self.handle_metrics)
+        app.on_startup.append(self._start)
+        app.on_cleanup.append(self._stop)
+        return app
+
+    async def _start(self, app: web.Application) -> None:
+        await self.ctx.aopen()
+        # Load the backlog now rather than on the first conversation
+        await self.ctx.issue_cache.sync_async(self.ctx.linear, self.ctx.team_id)
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.worker_count)
+        ]
+
+    async def _stop(self, app: web.Application) -> None:
+        try:
+            await asyncio.wait_for(self.queue.join(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            print(
+                f"Dropping {self.queue.qsize()} queued conversations after waiting {self.drain_timeout}s"
+            )
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        await self.ctx.aclose()
+
+    async def _worker(self) -> None:
+        while True:
+            job_id, conversation = await self.queue.get()
+            self.in_flight += 1
+            try:
+                # Each job is its own record, even if another has the same text
+                outcome = await categorize_conversation_async(
+                    conversation, self.ctx, self.matching_mode, self.top_k, job_id
+                )
+                self._finish(job_id, {"status": "done", "outcome": outcome})
+                self.processed += 1
+            except Exception as e:
+                self._finish(job_id, {"status": "failed", "error": repr(e)})
+                self.failed += 1
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    def _finish(self, job_id: str, result: Dict) -> None:
+        self.results[job_id] = result
+        self.results.move_to_end(job_id)
+        while len(self.results) > self.max_results:
+            self.results.popitem(last=False)
+
+    async def handle_conversations(self, request: web.Request) -> web.Response:
+        """Accepts {"conversation": ...} or {"conversations": [...]}, returning a
+        job ID per conversation"""
+        try:
+            body = await request.json()
+            if isinstance(body.get("conversations"), list):
+                conversations = body["conversations"]
+            else:
+                conversations = [body["conversation"]]
+            if not all(isinstance(c, str) and c.strip() for c in conversations):
+                raise ValueError
+        except (ValueError, KeyError, AttributeError):
+            return web.json_response(
+                {
+                    "error": 'Expected {"conversation": "..."} or {"conversations": ["...", ...]}'
+                },
+                status=400,
+            )
+        # All or nothing, so a sender never has to work out which ones got in
+        if self.queue.maxsize - self.queue.qsize() < len(conversations):
+            self.rejected += len(conversations)
+            return web.json_response(
+                {"error": "Queue is full, retry later"},
+                status=503,
+                headers={"Retry-After": "1"},
+            )
+        job_ids = []
+        for conversation in conversations:
+            job_id = str(uuid.uuid4())
+            self.results[job_id] = {"status": "queued"}
+            self.queue.put_nowait((job_id, conversation))
+            job_ids.append(job_id)
+        return web.json_response({"job_ids": job_ids}, status=202)
+
+    async def handle_job(self, request: web.Request) -> web.Response:
+        result = self.results.get(request.match_info["job_id"])
+        if result is None:
+            return web.json_response({"error": "Unknown job"}, status=404)
+        return web.json_response(result)
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        if not self.webhook_secret or not verify_linear_signature(
+            self.webhook_secret, body, request.headers.get("Linear-Signature")
+        ):
+            return web.json_response({"error": "Invalid signature"}, status=401)
+        try:
+            event = json.loads(body)
+        except ValueError:
+            return web.json_response({"error": "Invalid JSON"}, status=400)
+        sent_at = event.get("webhookTimestamp")
+        if sent_at is not None and time.time() - sent_at / 1000 > WEBHOOK_MAX_AGE:
+            return web.json_response({"error": "Stale delivery"}, status=400)
+        await self.apply_issue_event(event)
+        return web.json_response({"ok": True})
+
+    async def apply_issue_event(self, event: Dict) -> None:
+        """Applies a Linear Issue webhook event to the context's issue cache and
+        index. An issue that moved to another team is dropped from them, and other
+        events for other teams or other entity types are ignored"""
+        data = event.get("data") or {}
+        if event.get("type") != "Issue":
+            return
+        moved_away = data.get("teamId") != self.ctx.team_id
+        if (
+            moved_away
+            and self.ctx.issue_cache.get(self.ctx.team_id, data["id"]) is None
+        ):
+            return
+        self.webhook_events += 1
+        issue = {
+            "id": data["id"],
+            "title": data.get("title"),
+            "description": data.get("description"),
+            "updatedAt": data.get("updatedAt"),
+        }
+        if moved_away or event.get("action") == "remove" or data.get("archivedAt"):
+            self.ctx.issue_cache.remove(self.ctx.team_id, [issue["id"]])
+            if self.ctx.issue_index is not None:
+                await asyncio.to_thread(self.ctx.issue_index.remove, [issue["id"]])
+        else:
+            self.ctx.issue_cache.upsert(self.ctx.team_id, [issue])
+            if self.ctx.issue_index is not None:
+                await asyncio.to_thread(self.ctx.issue_index.upsert, [issue])
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        dead = sum(worker.done() for worker in self._workers)
+        healthy = self.ctx.linear is not None and dead == 0
+        return web.json_response(
+            {
+                "status": "ok" if healthy else "unhealthy",
+                "workers": len(self._workers) - dead,
+                "uptime": round(time.time() - self.started_at, 1),
+            },
+            status=200 if healthy else 503,
+        )
+
+    async def handle_queue(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "depth": self.queue.qsize(),
+                "capacity": self.queue.maxsize,
+                "in_flight": self.in_flight,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "webhook_events": self.webhook_events,
+            }
+        )
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.ctx.metrics.prometheus_text(), content_type="text/plain"
+        )
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Serve conversation categorization over HTTP"
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE)
+    parser.add_argument("--matching-mode", choices=MATCHING_MODES, default="ranked")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K)
+    parser.add_argument("--batch-mutations", action="store_true")
+    parser.add_argument(
+        "--issue-cache", default=ISSUE_CACHE_PATH, help="SQLite file to cache issues in"
+    )
+    parser.add_argument(
+        "--no-issue-cache",
+        action="store_true",
+        help="Keep the issue cache in memory only",
+    )
+    parser.add_argument(
+        "--issue-index",
+        default=ISSUE_INDEX_PATH,
+        help="Directory of the index that shortlists --top-k candidate tasks",
+    )
+    parser.add_argument(
+        "--no-issue-index",
+        action="store_true",
+        help="Put every task in the backlog up for matching instead",
+    )
+    parser.add_argument("--embedder", choices=EMBEDDERS, default="hashing")
+    parser.add_argument("--dedup", help="SQLite file to keep fingerprints in")
+    parser.add_argument(
+        "--completion-cache", help="SQLite file to cache completions in"
+    )
+    parser.add_argument("--mentions", help="SQLite file to count mentions in")
+    parser.add_argument(
+        "--webhook-secret",
+        default=os.environ.get("LINEAR_WEBHOOK_SECRET"),
+        help="Signing secret of the Linear webhook. Defaults to $LINEAR_WEBHOOK_SECRET",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="Serve Prometheus metrics at /metrics",
+    )
+    args = parser.parse_args()
+
+    ctx = IntegrationContext(
+        batch_mutations=args.batch_mutations,
+        issue_cache=IssueCache(":memory:" if args.no_issue_cache else args.issue_cache),
+        dedup=DedupIndex(args.dedup) if args.dedup else None,
+        completion_cache=(
+            CompletionCache(args.completion_cache) if args.completion_cache else None
+        ),
+        mentions=MentionCounter(args.mentions) if args.mentions else None,
+        metrics=Metrics() if args.metrics else None,
+    )
+    if not args.no_issue_index:
+        ctx.issue_index = IssueIndex(
+            args.issue_index, make_embedder(args.embedder, ctx)
+        )
+    service = IngestService(
+        ctx,
+        queue_size=args.queue_size,
+        workers=args.workers,
+        matching_mode=args.matching_mode,
+        top_k=args.top_k,
+        webhook_secret=args.webhook_secret,
+    )
+    web.run_app(service.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    _main()
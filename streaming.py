@@ -0,0 +1,182 @@
+from openai.types.chat import ChatCompletion
+from typing import Callable, Dict, List, Optional, Tuple
+import json
+import re
+import time
+import uuid
+
+from completion_cache import completion_key
+from integration_context import IntegrationContext
+from metrics import openai_operation
+
+# Given the tool arguments streamed so far, returns the complete arguments once
+# they're certain, or None to keep reading
+EarlyDecision = Callable[[str], Optional[Dict]]
+
+_ACTION = re.compile(r'"action"\s*:\s*"(\w+)"')
+_ISSUE_ID = re.compile(r'"issue_id"\s*:\s*"([^"\\]*)"')
+
+
+def early_ranking_decision(arguments: str) -> Optional[Dict]:
+    """The categorize_conversation decision as soon as the model has committed to
+    it: an ignore needs nothing else, and a match only needs the task's ID"""
+    action = _ACTION.search(arguments)
+    if action is None:
+        return None
+    if action.group(1) == "ignore":
+        return {"action": "ignore"}
+    if action.group(1) == "match":
+        issue_id = _ISSUE_ID.search(arguments)
+        if issue_id is not None:
+            return {"action": "match", "issue_id": issue_id.group(1)}
+    return None
+
+
+async def stream_completion(
+    ctx: IntegrationContext, request: Dict, early: Optional[EarlyDecision] = None
+) -> ChatCompletion:
+    """Streams a chat completion and stops reading as soon as the answer is
+    decided: once the model starts answering in text instead of calling a tool,
+    once the first tool call's arguments are complete JSON, or once `early` can
+    tell what they'll be. The stream is closed there and then, and the answer is
+    returned as a ChatCompletion, so callers parse it the same way as
+    ctx.chat_completion()'s. Its usage is only set if the stream was read to the
+    end."""
+    if ctx.metrics is None:
+        response, _ = await _stream_completion(ctx, request, early)
+        return response
+    started = time.perf_counter()
+    with ctx.metrics.span(
+        "openai." + openai_operation(request), model=request["model"]
+    ):
+        outcome, response = "error", None
+        try:
+            response, outcome = await _stream_completion(ctx, request, early)
+            return response
+        finally:
+            usage = getattr(response, "usage", None) if outcome != "cached" else None
+            ctx.metrics.record_call(
+                "openai",
+                openai_operation(request),
+                time.perf_counter() - started,
+                outcome,
+                usage.prompt_tokens if usage is not None else None,
+                usage.completion_tokens if usage is not None else None,
+            )
+
+
+async def _stream_completion(
+    ctx: IntegrationContext, request: Dict, early: Optional[EarlyDecision]
+) -> Tuple[ChatCompletion, str]:
+    # Returns the answer and whether it was "cached", read to the end ("ok") or
+    # cut short ("short_circuit")
+    key = completion_key(request) if ctx.completion_cache is not None else None
+    if key is not None:
+        cached = ctx.completion_cache.get(key)
+        if cached is not None:
+            return cached, "cached"
+    stream = await ctx.governor.openai_call(
+        lambda: ctx.openai.chat.completions.with_raw_response.create(
+            **request, stream=True, stream_options={"include_usage": True}
+        ),
+        request,
+    )
+    try:
+        response, finished, whole = await _read_until_decided(stream, request, early)
+    finally:
+        await stream.close()
+    # An answer `early` decided, or text we stopped reading, is only what this
+    # caller needed (e.g. a match without the rest of its arguments), so only
+    # whole answers are cached
+    if key is not None and whole:
+        ctx.completion_cache.put(key, response)
+    return response, "ok" if finished else "short_circuit"
+
+
+async def _read_until_decided(
+    stream, request: Dict, early: Optional[EarlyDecision]
+) -> Tuple[ChatCompletion, bool, bool]:
+    # Returns the answer so far, whether the stream was read to the end, and
+    # whether the answer is whole: read to the end, or a tool call's complete
+    # arguments
+    content: List[str] = []
+    arguments: List[str] = []
+    call_id, name, usage = None, None, None
+    async for chunk in stream:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.tool_calls:
+            call = delta.tool_calls[0]
+            # Only the first tool call is ever used
+            if call.index != 0:
+                continue
+            call_id = call.id or call_id
+            if call.function is not None:
+                name = call.function.name or name
+                arguments.append(call.function.arguments or "")
+            text = "".join(arguments)
+            decided = _complete_arguments(text)
+            whole = decided is not None
+            if decided is None and early is not None:
+                decided = early(text)
+            if decided is not None:
+                return _completion(request, call_id, name, decided, None), False, whole
+        elif delta.content:
+            content.append(delta.content)
+            if not arguments:
+                # The model is answering in text, so it won't call the tool
+                answer = _completion(request, None, None, None, "".join(content))
+                return answer, False, False
+    args = json.loads("".join(arguments)) if arguments else None
+    return (
+        _completion(request, call_id, name, args, "".join(content), usage),
+        True,
+        True,
+    )
+
+
+def _complete_arguments(text: str) -> Optional[Dict]:
+    if not text.rstrip().endswith("}"):
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def _completion(
+    request: Dict,
+    call_id: Optional[str],
+    name: Optional[str],
+    arguments: Optional[Dict],
+    content: Optional[str],
+    usage=None,
+) -> ChatCompletion:
+    message = {"role": "assistant", "content": content or None}
+    if arguments is not None:
+        message["tool_calls"] = [
+            {
+                "id": call_id or f"call_{uuid.uuid4().hex[:12]}",
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(arguments)},
+            }
+        ]
+    return ChatCompletion.model_validate(
+        {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "stop" if arguments is None else "tool_calls",
+                }
+            ],
+            "usage": usage.model_dump() if usage is not None else None,
+        }
+    )
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# The pipeline's modules live in the repo root and the stub servers in benchmarks/.
+# Both read their API keys at import time, so point them at the stubs first
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LINEAR_API_KEY", "test")
+
+
+@pytest.fixture(autouse=True)
+def _state_in_tmp_path(tmp_path, monkeypatch):
+    # Contexts keep their issue cache under .cache/ by default, which mustn't be
+    # shared between tests with different stub backlogs
+    monkeypatch.chdir(tmp_path)
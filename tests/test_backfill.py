@@ -0,0 +1,95 @@
+from aiohttp import web
+import asyncio
+import os
+
+from backfill import Backfill
+from corpus import synthetic_corpus
+from integration_context import IntegrationContext
+from metrics import Metrics
+from stub_servers import LinearStub, OpenAIStub, start_stub_servers
+
+
+class LosesBatchResponses(OpenAIStub):
+    """Creates batches but answers the first `lost` requests with an error, as if
+    the connection dropped before the response arrived"""
+
+    def __init__(self, lost: int):
+        super().__init__()
+        self.lost = lost
+
+    async def create_batch(self, request: web.Request) -> web.Response:
+        response = await super().create_batch(request)
+        if self.lost:
+            self.lost -= 1
+            return web.json_response({"error": {"message": "Lost"}}, status=400)
+        return response
+
+
+def run_backfill(openai, steps, tmp_path, **ctx_kwargs):
+    async def run():
+        runner, url = await start_stub_servers(LinearStub(backlog_size=5), openai)
+        try:
+            async with IntegrationContext(
+                linear_url=f"{url}/graphql",
+                openai_url=f"{url}/v1",
+                schema_cache_path=os.path.join(tmp_path, "schema.json"),
+                **ctx_kwargs,
+            ) as ctx:
+                backfill = Backfill(
+                    ctx, os.path.join(tmp_path, "backfill.db"), poll_interval=0
+                )
+                try:
+                    return await steps(backfill)
+                finally:
+                    backfill.close()
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_backfill_submits_polls_and_applies(tmp_path):
+    conversations = synthetic_corpus(6)
+    openai = OpenAIStub()
+    outcomes = run_backfill(
+        openai, lambda backfill: backfill.run(conversations), tmp_path
+    )
+    assert len(openai.batches) == 1
+    assert all(outcome is not None for outcome in outcomes)
+
+
+def test_preparing_lists_the_backlog_once(tmp_path):
+    metrics = Metrics()
+    run_backfill(
+        OpenAIStub(),
+        lambda backfill: backfill.prepare(synthetic_corpus(6)),
+        tmp_path,
+        metrics=metrics,
+    )
+    assert metrics.summary()["linear:TeamIssues"]["calls"] == 1
+
+
+def test_resumed_submit_reuses_the_batch_of_an_uploaded_file(tmp_path):
+    conversations = synthetic_corpus(6)
+    openai = LosesBatchResponses(lost=1)
+
+    async def crash_while_creating_the_batch(backfill):
+        await backfill.prepare(conversations)
+        try:
+            await backfill.submit()
+        except Exception:
+            return
+        raise AssertionError("submit should have failed")
+
+    async def resume(backfill):
+        await backfill.prepare(conversations)
+        batch_ids = await backfill.submit()
+        await backfill.wait()
+        return batch_ids, await backfill.apply()
+
+    run_backfill(openai, crash_while_creating_the_batch, tmp_path)
+    assert len(openai.batches) == 1
+    batch_ids, outcomes = run_backfill(openai, resume, tmp_path)
+    assert batch_ids == list(openai.batches)
+    assert len(openai.batches) == 1
+    assert all(outcome is not None for outcome in outcomes)
@@ -0,0 +1,41 @@
+import clustering
+from clustering import categorize_clustered, cluster_conversations
+from corpus import conversation
+from stub_servers import LinearStub, OpenAIStub
+from test_main import run_with_stubs
+
+
+def test_repeats_join_the_first_conversation_across_chunks(monkeypatch):
+    monkeypatch.setattr(clustering, "_CHUNK_SIZE", 2)
+    password = conversation("bug_report", "password")
+    avatar = conversation("feature_request", "profile picture")
+    representatives, similarities = cluster_conversations(
+        [password, avatar, password, conversation("general_query", "invoice"), avatar]
+    )
+    assert representatives == [0, 1, 0, 3, 1]
+    assert similarities[2] == similarities[4] == 1.0
+
+
+def test_members_are_filed_like_their_representative(tmp_path):
+    linear, openai = LinearStub(), OpenAIStub()
+    report = conversation("bug_report", "password")
+    query = conversation("general_query", "invoice")
+
+    results = run_with_stubs(
+        linear,
+        lambda ctx: categorize_clustered([report, query, report, report, query], ctx),
+        tmp_path,
+        openai=openai,
+    )
+    assert [result["action"] for result in results] == [
+        "create",
+        "ignore",
+        "match",
+        "match",
+        "ignore",
+    ]
+    assert results[2]["issue_id"] == results[3]["issue_id"] == results[0]["issue_id"]
+    assert results[2]["clustered"] and results[2]["representative"] == 0
+    # Only the two representatives are categorized, and one task is created
+    assert openai.requests == 2
+    assert len(linear.issues) == 1 and len(linear.comments) == 2
@@ -0,0 +1,31 @@
+from compaction import Compactor, strip_agent_boilerplate, parse_turns
+
+BUG_REPORT = "[User]: 'I can't change my delivery address', [Agent]: 'Sorry for the inconvenience we will get that fixed right away'"
+FEATURE_REQUEST = "[User]: 'I would like to be able to change my delivery address', [Agent]: 'Thanks for the suggestion!'"
+
+
+def test_agent_confirmations_survive_compaction():
+    compactor = Compactor()
+    bug_report, _ = compactor.compact_conversation(BUG_REPORT)
+    feature_request, _ = compactor.compact_conversation(FEATURE_REQUEST)
+    assert "we will get that fixed" in bug_report
+    assert "Thanks for the suggestion" in feature_request
+
+
+def test_pure_pleasantries_are_dropped():
+    turns = parse_turns(
+        "[User]: 'My password reset email never arrives', "
+        "[Agent]: 'Hi there, thanks for reaching out! We're looking into it. "
+        "Is there anything else I can help you with? Have a great day!'"
+    )
+    assert strip_agent_boilerplate(turns) == [
+        ("User", "My password reset email never arrives"),
+        ("Agent", "We're looking into it."),
+    ]
+
+
+def test_description_cache_is_bounded():
+    compactor = Compactor(description_tokens=5, max_descriptions=2)
+    for n in range(5):
+        compactor.compact_description(f"description number {n} " * 10)
+    assert len(compactor._descriptions) == 2
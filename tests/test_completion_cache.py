@@ -0,0 +1,61 @@
+import os
+
+from completion_cache import CompletionCache, completion_key
+from corpus import conversation
+from gpt_helpers import ranking_request
+from stub_servers import LinearStub, OpenAIStub
+from test_main import run_with_stubs
+
+
+def test_repeated_requests_are_answered_from_the_cache(tmp_path):
+    openai = OpenAIStub()
+    path = os.path.join(tmp_path, "completions.db")
+    request = ranking_request(conversation("bug_report", "password"), [])
+
+    async def ask_twice(ctx):
+        return [await ctx.chat_completion(**request) for _ in range(2)]
+
+    cache = CompletionCache(path)
+    first, second = run_with_stubs(
+        LinearStub(), ask_twice, tmp_path, openai=openai, completion_cache=cache
+    )
+    assert openai.requests == 1
+    assert second.choices[0].message == first.choices[0].message
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["saved_prompt_tokens"] == first.usage.prompt_tokens
+    cache.close()
+
+    # The SQLite tier outlives the process, and keys don't depend on key order
+    reopened = CompletionCache(path)
+    reordered = dict(reversed(list(request.items())))
+    assert reopened.get(completion_key(reordered)) == first
+
+
+def test_expired_and_evicted_completions_are_misses(tmp_path):
+    openai = OpenAIStub()
+    requests = [
+        ranking_request(conversation("bug_report", topic), [])
+        for topic in ("password", "profile picture", "invoice")
+    ]
+
+    async def ask(ctx):
+        return [await ctx.chat_completion(**request) for request in requests]
+
+    path = os.path.join(tmp_path, "completions.db")
+    cache = CompletionCache(path, max_memory_entries=2)
+    run_with_stubs(LinearStub(), ask, tmp_path, openai=openai, completion_cache=cache)
+    # The least recently used entry left memory, but is still on disk
+    assert cache.get(completion_key(requests[0])) is not None
+    assert CompletionCache(path, ttl=-1).get(completion_key(requests[0])) is None
+
+    # Past the size limit, entries go least recently used first, and reading the
+    # first one from disk made the second the least recently used
+    (size,) = cache._db.execute(
+        "SELECT SUM(LENGTH(response)) FROM completions"
+    ).fetchone()
+    cache.max_disk_bytes = size * 5 // 6
+    cache.evict()
+    reopened = CompletionCache(path)
+    assert [
+        reopened.get(completion_key(request)) is not None for request in requests
+    ] == [True, False, True]
@@ -0,0 +1,54 @@
+import os
+
+from corpus import backlog_issues, conversation
+from dedup import DedupIndex
+from main import categorize_conversation_async
+from stub_servers import LinearStub, OpenAIStub
+from test_main import run_with_stubs
+
+
+def test_exact_and_near_duplicates_reuse_the_outcome(tmp_path):
+    path = os.path.join(tmp_path, "dedup.db")
+    text = conversation("bug_report", "password") + (
+        ", [User]: 'It says my old password is wrong even though I just used it to"
+        " log in, and I tried twice on the web app and once on my phone', [Agent]:"
+        " 'Thanks, I have passed this on to the team under ticket 1234'"
+    )
+    outcome = {"action": "match", "issue_id": "issue-1", "title": "Password"}
+    dedup = DedupIndex(path)
+    dedup.remember(text, outcome)
+
+    # Case, punctuation and numbers don't make a conversation new
+    reformatted = text.upper().replace(".", "!").replace("'", "").replace("1234", "87")
+    assert dedup.lookup(reformatted) == {**outcome, "similarity": 1.0}
+    # Nor does a word or two in a long transcript
+    near = text.replace("on my phone", "on my tablet")
+    match = DedupIndex(path).lookup(near)
+    assert match["issue_id"] == "issue-1"
+    assert dedup.threshold <= match["similarity"] < 1.0
+    assert dedup.lookup(conversation("bug_report", "invoice")) is None
+    assert dedup.stats()["exact_hits"] == 1
+
+
+def test_duplicates_are_attributed_without_calling_openai(tmp_path):
+    linear = LinearStub(backlog_size=1)
+    openai = OpenAIStub()
+    (issue,) = backlog_issues(1)
+    topic = issue["description"].split("their ")[-1].rstrip(".")
+    kind = "feature_request" if issue["title"].startswith("Feature") else "bug_report"
+    text = conversation(kind, topic)
+
+    async def categorize_twice(ctx):
+        first = await categorize_conversation_async(text, ctx)
+        requests = openai.requests
+        second = await categorize_conversation_async(text, ctx)
+        return first, second, openai.requests - requests
+
+    first, second, requests = run_with_stubs(
+        linear, categorize_twice, tmp_path, openai=openai, dedup=DedupIndex()
+    )
+    assert first["action"] == "match"
+    assert requests == 0
+    assert second["duplicate"] and second["issue_id"] == first["issue_id"]
+    assert second["mentions"] == 2
+    assert len(linear.comments) == 2
@@ -0,0 +1,32 @@
+import os
+
+from constants import LINEAR_TEAM_ID
+from integration_context import IntegrationContext
+from issue_cache import ISSUE_CACHE_PATH, IssueCache
+from stub_servers import LinearStub
+from test_main import run_with_stubs
+
+
+def test_incremental_syncs_catch_updates_at_the_watermark(tmp_path):
+    linear = LinearStub(backlog_size=3)
+    cache = IssueCache(":memory:")
+
+    async def sync_twice_then_add(ctx):
+        changes = [await cache.sync_async(ctx.linear, ctx.team_id, force=True)]
+        # The issue at the watermark comes back again, but isn't a change
+        changes.append(await cache.sync_async(ctx.linear, ctx.team_id, force=True))
+        # Updated in the same millisecond as the last issue we saw
+        issue = linear._create({"title": "Bug report: I can't change my avatar"})
+        issue["updatedAt"] = cache.watermark(ctx.team_id)
+        changes.append(await cache.sync_async(ctx.linear, ctx.team_id, force=True))
+        return changes
+
+    assert run_with_stubs(linear, sync_twice_then_add, tmp_path) == [3, 0, 1]
+    cached = cache.issues(LINEAR_TEAM_ID)
+    assert sorted(issue["id"] for issue in cached) == sorted(linear.issues)
+
+
+def test_contexts_keep_a_persistent_issue_cache_unless_opted_out():
+    assert IntegrationContext().issue_cache is not None
+    assert os.path.exists(ISSUE_CACHE_PATH)
+    assert IntegrationContext(issue_cache_path=None).issue_cache is None
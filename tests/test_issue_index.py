@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from corpus import conversation
+from issue_index import IssueIndex, OpenAIEmbedder, lexical_shortlist
+from main import categorize_conversation_async
+from metrics import Metrics
+from stub_servers import LinearStub
+from test_main import run_with_stubs
+
+
+def test_openai_embeddings_go_through_the_context(tmp_path):
+    metrics = Metrics()
+
+    async def categorize(ctx):
+        embedder = OpenAIEmbedder(ctx)
+        # It waits for the loop to make the call, so it can't run on the loop
+        with pytest.raises(RuntimeError):
+            embedder.embed(["I can't change my password"])
+        ctx.issue_index = IssueIndex(os.path.join(tmp_path, "index"), embedder)
+        return await categorize_conversation_async(
+            conversation("bug_report", "password"), ctx, top_k=3
+        )
+
+    outcome = run_with_stubs(
+        LinearStub(backlog_size=5), categorize, tmp_path, metrics=metrics
+    )
+    assert outcome["action"] == "create"
+    # The backlog, the conversation and the task it created
+    assert metrics.summary()["openai:embeddings"]["calls"] == 3
+
+
+def test_lexical_shortlists_weigh_rare_words_more():
+    issues = [
+        {"id": "1", "title": "I can't change my password on iOS"},
+        {"id": "2", "title": "I can't change my avatar on iOS"},
+        {"id": "3", "title": "I can't change my avatar on Android"},
+    ]
+    shortlist = lexical_shortlist("Changing my avatar fails on Android", issues, 2)
+    assert [issue["id"] for issue in shortlist] == ["3", "2"]
+    assert lexical_shortlist("anything", issues, 5) == issues
@@ -0,0 +1,38 @@
+import asyncio
+import os
+
+from gql.transport.exceptions import TransportQueryError
+
+from integration_context import IntegrationContext
+from stub_servers import LinearStub, OpenAIStub, start_stub_servers
+
+
+def test_mixed_success_batch_applies_each_mutation_once(tmp_path):
+    async def run():
+        linear = LinearStub(backlog_size=1)
+        runner, url = await start_stub_servers(linear, OpenAIStub())
+        (issue_id,) = linear.issues
+        try:
+            async with IntegrationContext(
+                linear_url=f"{url}/graphql",
+                openai_url=f"{url}/v1",
+                schema_cache_path=os.path.join(tmp_path, "schema.json"),
+                batch_mutations=True,
+                mutation_batch_size=3,
+                mutation_batch_wait=10,
+            ) as ctx:
+                results = await asyncio.gather(
+                    ctx.mutation_batcher.add_comment(issue_id, "first"),
+                    ctx.mutation_batcher.add_comment("missing", "second"),
+                    ctx.mutation_batcher.add_comment(issue_id, "third"),
+                    return_exceptions=True,
+                )
+                return results, linear.comments
+        finally:
+            await runner.cleanup()
+
+    results, comments = asyncio.run(run())
+    assert results[0]["commentCreate"]["success"]
+    assert isinstance(results[1], TransportQueryError)
+    assert results[2]["commentCreate"]["comment"]["body"] == "third"
+    assert sorted(comment["body"] for comment in comments) == ["first", "third"]
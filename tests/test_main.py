@@ -0,0 +1,116 @@
+import asyncio
+import os
+import uuid
+
+from compaction import Compactor
+from corpus import backlog_issues, conversation
+from integration_context import IntegrationContext
+from linear_helpers import idempotent_issue_id
+from main import (
+    MAX_UNINDEXED_CANDIDATES,
+    apply_decision,
+    categorize_conversation_async,
+    prepare_conversation,
+)
+from stub_servers import LinearStub, OpenAIStub, start_stub_servers
+
+
+def run_with_stubs(linear, coroutine_factory, tmp_path, openai=None, **kwargs):
+    async def run():
+        runner, url = await start_stub_servers(linear, openai or OpenAIStub())
+        try:
+            async with IntegrationContext(
+                linear_url=f"{url}/graphql",
+                openai_url=f"{url}/v1",
+                schema_cache_path=os.path.join(tmp_path, "schema.json"),
+                **kwargs,
+            ) as ctx:
+                return await coroutine_factory(ctx)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_linear_gets_the_original_conversation_when_compacting(tmp_path):
+    linear = LinearStub(backlog_size=1)
+    (issue,) = backlog_issues(1)
+    topic = issue["description"].split("their ")[-1].rstrip(".")
+    kind = "feature_request" if issue["title"].startswith("Feature") else "bug_report"
+    text = conversation(kind, topic)
+
+    for matching_mode in ("ranked", "per_issue"):
+        outcome = run_with_stubs(
+            linear,
+            lambda ctx: categorize_conversation_async(text, ctx, matching_mode),
+            tmp_path,
+            compactor=Compactor(),
+        )
+        assert outcome["action"] == "match"
+        assert "[Agent]: '" in linear.comments[-1]["body"]
+
+
+def test_issue_ids_are_version_4_and_keyed_by_record():
+    issue_id = uuid.UUID(idempotent_issue_id("corpus.jsonl:1"))
+    assert issue_id.version == 4
+    assert str(issue_id) == idempotent_issue_id("corpus.jsonl:1")
+    assert str(issue_id) != idempotent_issue_id("corpus.jsonl:2")
+
+
+def test_identical_conversations_from_different_records_both_create(tmp_path):
+    linear = LinearStub()
+    text = conversation("bug_report", "profile picture")
+    decision = {"action": "create", "title": "Bug", "description": "Broken"}
+
+    def create(record_key):
+        return run_with_stubs(
+            linear,
+            lambda ctx: apply_decision(ctx, text, [], decision, record_key),
+            tmp_path,
+        )
+
+    first = create("corpus.jsonl:1")
+    second = create("corpus.jsonl:2")
+    assert "replayed" not in first and "replayed" not in second
+    assert first["issue_id"] != second["issue_id"]
+    # Retrying a record finds the task it already created
+    retried = create("corpus.jsonl:1")
+    assert retried["replayed"] and retried["issue_id"] == first["issue_id"]
+    assert len(linear.issues) == 2
+
+
+def test_replayed_records_post_their_mention_once(tmp_path):
+    linear = LinearStub(backlog_size=1)
+    (issue,) = linear.issues.values()
+    text = conversation("bug_report", "profile picture")
+    decision = {"action": "match", "issue_id": issue["id"]}
+
+    def mention(record_key):
+        return run_with_stubs(
+            linear,
+            lambda ctx: apply_decision(ctx, text, [issue], decision, record_key),
+            tmp_path,
+        )
+
+    first = mention("corpus.jsonl:1")
+    # Killed after posting but before the record was checkpointed
+    retried = mention("corpus.jsonl:1")
+    assert "replayed" not in first and retried["replayed"]
+    other = mention("corpus.jsonl:2")
+    assert "replayed" not in other
+    assert len(linear.comments) == 2
+
+
+def test_large_backlogs_are_shortlisted_without_an_index(tmp_path):
+    size = MAX_UNINDEXED_CANDIDATES + 50
+    issue = backlog_issues(size)[-1]
+    topic = issue["description"].split("their ")[-1].rstrip(".")
+    text = conversation("bug_report", topic)
+
+    _, candidates, _ = run_with_stubs(
+        LinearStub(backlog_size=size),
+        lambda ctx: prepare_conversation(text, ctx),
+        tmp_path,
+    )
+    assert len(candidates) == MAX_UNINDEXED_CANDIDATES
+    assert candidates[0]["title"] == issue["title"]
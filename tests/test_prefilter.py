@@ -0,0 +1,53 @@
+import json
+import os
+
+from corpus import conversation, labelled_corpus, topics
+from main import categorize_conversation_async
+from prefilter import PreClassifier, evaluate, label_value, read_labelled
+from stub_servers import LinearStub, OpenAIStub
+from test_main import run_with_stubs
+
+
+def trained_prefilter(tmp_path):
+    path = os.path.join(tmp_path, "labelled.jsonl")
+    with open(path, "w") as f:
+        for text, kind in labelled_corpus(300, topic_count=60, seed=1):
+            f.write(json.dumps({"conversation": text, "action": kind}) + "\n")
+    return PreClassifier.train(*read_labelled(path))
+
+
+def test_general_queries_are_dropped_and_tasks_kept(tmp_path):
+    assert [label_value(label) for label in ("create", "general_query")] == [1, 0]
+    model = trained_prefilter(tmp_path)
+    # Topics the model never saw
+    held_out = topics(80)[60:]
+    kinds = ("bug_report", "feature_request", "general_query")
+    conversations = [conversation(kind, topic) for topic in held_out for kind in kinds]
+    labels = [0 if kind == "general_query" else 1 for _ in held_out for kind in kinds]
+    report = {row["threshold"]: row for row in evaluate(model, conversations, labels)}
+    assert report[0.9]["missed_tasks"] == 0
+    assert report[0.9]["recall"] == 1.0
+
+    path = os.path.join(tmp_path, "prefilter.npz")
+    model.save(path)
+    loaded = PreClassifier.load(path)
+    assert loaded.ignore_probability(conversations[0]) == model.ignore_probability(
+        conversations[0]
+    )
+
+
+def test_dropped_conversations_make_no_api_calls(tmp_path):
+    linear, openai = LinearStub(backlog_size=3), OpenAIStub()
+    prefilter = trained_prefilter(tmp_path)
+    text = conversation("general_query", topics(80)[70])
+
+    outcome = run_with_stubs(
+        linear,
+        lambda ctx: categorize_conversation_async(text, ctx),
+        tmp_path,
+        openai=openai,
+        prefilter=prefilter,
+    )
+    assert outcome["action"] == "ignore" and outcome["prefiltered"]
+    assert openai.requests == 0
+    assert prefilter.stats()["dropped"] == 1
@@ -0,0 +1,73 @@
+import asyncio
+
+from gql import GraphQLRequest
+from gql.transport.exceptions import TransportQueryError, TransportServerError
+
+import rate_limits
+from integration_context import _is_idempotent
+from linear_helpers import _add_comment_request, _create_issue_request
+from rate_limits import RateGovernor
+from test_main import run_with_stubs
+from stub_servers import LinearStub
+
+
+def attempts_until_done(monkeypatch, error, idempotent):
+    monkeypatch.setattr(rate_limits, "backoff_delay", lambda attempt: 0.0)
+    governor = RateGovernor(max_attempts=3)
+    attempts = []
+
+    async def execute():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise error
+        return {}
+
+    async def call():
+        try:
+            await governor.linear_call(
+                execute, "CommentCreate", lambda: None, idempotent=idempotent
+            )
+        except type(error):
+            pass
+
+    asyncio.run(call())
+    return len(attempts)
+
+
+def test_mutations_are_only_retried_when_rate_limited(monkeypatch):
+    server_error = TransportServerError("Service unavailable", 503)
+    rate_limited = TransportQueryError(
+        "Rate limit exceeded",
+        errors=[
+            {"message": "Rate limit exceeded", "extensions": {"code": "RATELIMITED"}}
+        ],
+    )
+    assert attempts_until_done(monkeypatch, server_error, idempotent=False) == 1
+    assert attempts_until_done(monkeypatch, server_error, idempotent=True) == 2
+    assert attempts_until_done(monkeypatch, rate_limited, idempotent=False) == 2
+    too_many = TransportServerError("Too many requests", 429)
+    assert attempts_until_done(monkeypatch, too_many, idempotent=False) == 2
+
+
+def test_only_creates_with_an_id_are_idempotent():
+    assert _is_idempotent(_create_issue_request("Bug", "", "team", issue_id="abc"))
+    assert not _is_idempotent(_create_issue_request("Bug", "", "team"))
+    assert not _is_idempotent(_add_comment_request("abc", "Mentioned again"))
+    query = GraphQLRequest("query Issue($id: String!) { issue(id: $id) { id } }")
+    assert _is_idempotent(query)
+
+
+def test_complexity_is_read_from_each_response(tmp_path):
+    governor = RateGovernor()
+    linear = LinearStub(backlog_size=2)
+
+    async def comment_concurrently(ctx):
+        await asyncio.gather(
+            *(
+                ctx.linear.execute(_add_comment_request(issue_id, "Mentioned"))
+                for issue_id in linear.issues
+            )
+        )
+
+    run_with_stubs(linear, comment_concurrently, tmp_path, governor=governor)
+    assert governor._linear_complexity_estimates["CommentCreate"] == 10
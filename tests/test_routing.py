@@ -0,0 +1,72 @@
+import asyncio
+import os
+
+import pytest
+
+from corpus import conversation
+from rate_limits import RateGovernor
+from routing import MultiTeamCategorizer, Team, TeamRouter, team_context, team_shares
+from stub_servers import LinearStub, OpenAIStub, start_stub_servers
+
+TEAMS = [
+    Team("accounts", "team-accounts", keywords=["password", "email"]),
+    Team("profiles", "team-profiles", keywords=["picture", "address"], share=0.5),
+]
+
+
+def test_keywords_route_and_ties_go_to_the_default():
+    router = TeamRouter(TEAMS)
+    assert router.keyword_route("My profile picture is blurry").name == "profiles"
+    assert router.keyword_route("My email and my address are wrong") is None
+    assert team_shares(TEAMS, reserved=0.1) == pytest.approx(
+        {"accounts": 0.4, "profiles": 0.5}
+    )
+    with pytest.raises(ValueError):
+        team_shares(TEAMS, reserved=0.5)
+
+
+def test_conversations_are_filed_in_their_teams_shard(tmp_path):
+    linear = LinearStub(
+        backlog_size=6, teams={"team-accounts": "password", "team-profiles": "picture"}
+    )
+    conversations = [
+        conversation("feature_request", "password on iOS"),
+        conversation("bug_report", "profile picture"),
+        # No keyword, and no router context to ask, so it goes to the default
+        conversation("bug_report", "username"),
+    ]
+
+    async def run():
+        runner, url = await start_stub_servers(linear, OpenAIStub())
+        try:
+            contexts = {
+                team.name: team_context(
+                    team,
+                    RateGovernor(),
+                    state_dir=os.path.join(tmp_path, "teams"),
+                    linear_url=f"{url}/graphql",
+                    openai_url=f"{url}/v1",
+                    schema_cache_path=os.path.join(tmp_path, "schema.json"),
+                )
+                for team in TEAMS
+            }
+            router = TeamRouter(TEAMS)
+            async with MultiTeamCategorizer(router, contexts) as categorizer:
+                outcomes = [await categorizer.categorize(c) for c in conversations]
+                return outcomes, categorizer.stats()
+        finally:
+            await runner.cleanup()
+
+    outcomes, stats = asyncio.run(run())
+    assert [outcome["team"] for outcome in outcomes] == [
+        "accounts",
+        "profiles",
+        "accounts",
+    ]
+    assert outcomes[0]["action"] == "match"
+    assert linear.issues[outcomes[0]["issue_id"]]["teamId"] == "team-accounts"
+    assert [outcome["action"] for outcome in outcomes[1:]] == ["create", "create"]
+    assert linear.issues[outcomes[1]["issue_id"]]["teamId"] == "team-profiles"
+    assert linear.issues[outcomes[2]["issue_id"]]["teamId"] == "team-accounts"
+    assert stats["routed"] == {"keyword": 2, "model": 0, "default": 1}
+    assert stats["teams"]["profiles"]["processed"] == 1
@@ -0,0 +1,145 @@
+from aiohttp.test_utils import TestClient, TestServer
+import asyncio
+import hashlib
+import hmac
+import json
+import math
+import os
+import time
+
+from corpus import conversation
+from integration_context import IntegrationContext
+from issue_index import HashingEmbedder, IssueIndex
+from service import IngestService
+from stub_servers import LinearStub, OpenAIStub, start_stub_servers
+
+SECRET = "webhook-secret"
+
+
+def signed(event):
+    body = json.dumps(event).encode()
+    signature = hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return body, signature
+
+
+def run_service(linear, test, tmp_path, webhook_secret=SECRET):
+    async def run():
+        runner, url = await start_stub_servers(linear, OpenAIStub())
+        ctx = IntegrationContext(
+            linear_url=f"{url}/graphql",
+            openai_url=f"{url}/v1",
+            schema_cache_path=os.path.join(tmp_path, "schema.json"),
+        )
+        service = IngestService(ctx, workers=2, webhook_secret=webhook_secret)
+        client = TestClient(TestServer(service.app()))
+        await client.start_server()
+        try:
+            return await test(service, client)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+async def job_result(client, job_id):
+    while True:
+        result = await (await client.get(f"/conversations/{job_id}")).json()
+        if result["status"] != "queued":
+            return result
+        await asyncio.sleep(0.01)
+
+
+def test_conversations_are_categorized_against_webhook_updates(tmp_path):
+    linear = LinearStub()
+
+    async def test(service, client):
+        # Linear tells us about a task the service hasn't listed
+        event = {
+            "type": "Issue",
+            "action": "create",
+            "webhookTimestamp": time.time() * 1000,
+            "data": {
+                "id": "issue-1",
+                "teamId": service.ctx.team_id,
+                "title": "Bug report: I can't change my password",
+                "description": "Users can't change their password.",
+                "updatedAt": "2024-01-01T00:00:00.000Z",
+            },
+        }
+        linear._create(event["data"])
+        body, signature = signed(event)
+        response = await client.post(
+            "/webhooks/linear", data=body, headers={"Linear-Signature": signature}
+        )
+        assert response.status == 200
+
+        response = await client.post(
+            "/conversations",
+            json={"conversation": conversation("bug_report", "password")},
+        )
+        (job_id,) = (await response.json())["job_ids"]
+        return await job_result(client, job_id)
+
+    result = run_service(linear, test, tmp_path)
+    assert result["status"] == "done"
+    assert result["outcome"]["action"] == "match"
+    assert result["outcome"]["issue_id"] == "issue-1"
+
+
+def test_webhooks_need_a_valid_signature(tmp_path):
+    async def test(service, client):
+        event = {"type": "Issue", "action": "create", "data": {}}
+        body, signature = signed(event)
+        statuses = []
+        for headers in ({"Linear-Signature": "0" * 64}, {}):
+            response = await client.post("/webhooks/linear", data=body, headers=headers)
+            statuses.append(response.status)
+        return statuses
+
+    assert run_service(LinearStub(), test, tmp_path) == [401, 401]
+
+
+def test_no_webhook_route_without_a_secret(tmp_path):
+    async def test(service, client):
+        body, signature = signed({"type": "Issue", "data": {}})
+        response = await client.post(
+            "/webhooks/linear", data=body, headers={"Linear-Signature": signature}
+        )
+        return response.status, service.ctx.issue_cache.sync_interval
+
+    status, sync_interval = run_service(LinearStub(), test, tmp_path, None)
+    assert status in (404, 405)
+    assert sync_interval != math.inf
+
+
+def test_issues_moved_to_another_team_are_dropped(tmp_path):
+    async def test(service, client):
+        service.ctx.issue_index = IssueIndex(
+            os.path.join(tmp_path, "index"), HashingEmbedder()
+        )
+        issue = {
+            "id": "issue-1",
+            "teamId": service.ctx.team_id,
+            "title": "Bug report: I can't change my password",
+            "description": "Users can't change their password.",
+            "updatedAt": "2024-01-01T00:00:00.000Z",
+        }
+        await service.apply_issue_event(
+            {"type": "Issue", "action": "create", "data": issue}
+        )
+        assert service.ctx.issue_cache.get(service.ctx.team_id, "issue-1")
+        assert len(service.ctx.issue_index) == 1
+
+        moved = {**issue, "teamId": "other-team"}
+        for _ in range(2):
+            await service.apply_issue_event(
+                {"type": "Issue", "action": "update", "data": moved}
+            )
+        return service
+
+    service = run_service(LinearStub(), test, tmp_path)
+    assert service.ctx.issue_cache.get(service.ctx.team_id, "issue-1") is None
+    assert len(service.ctx.issue_index) == 0
+    # Once it's gone, the other team's updates to it are ignored again
+    assert service.webhook_events == 2
@@ -0,0 +1,66 @@
+from cascade import ModelCascade
+from completion_cache import CompletionCache, completion_key
+from corpus import backlog_issues, conversation
+from gpt_helpers import check_issue_match, ranking_request
+from streaming import stream_completion
+from stub_servers import LinearStub, OpenAIStub
+from test_main import run_with_stubs
+
+
+def test_only_whole_streamed_answers_are_cached(tmp_path):
+    issues = [
+        {"id": str(i), "title": issue["title"]}
+        for i, issue in enumerate(backlog_issues(3))
+    ]
+    topic = backlog_issues(3)[0]["description"].split("their ")[-1].rstrip(".")
+    kind = (
+        "feature_request" if issues[0]["title"].startswith("Feature") else "bug_report"
+    )
+    request = ranking_request(conversation(kind, topic), issues)
+    cache = CompletionCache()
+
+    async def stream(ctx, early):
+        response = await stream_completion(ctx, request, early)
+        return response, cache.get(completion_key(request))
+
+    def decided_on_the_action(arguments):
+        # Stops reading before the issue ID arrives
+        return {"action": "match"} if "match" in arguments else None
+
+    response, cached = run_with_stubs(
+        LinearStub(),
+        lambda ctx: stream(ctx, decided_on_the_action),
+        tmp_path,
+        completion_cache=cache,
+    )
+    assert response.usage is None
+    assert cached is None
+
+    # Stops reading once the arguments are complete, which is still the whole answer
+    response, cached = run_with_stubs(
+        LinearStub(), lambda ctx: stream(ctx, None), tmp_path, completion_cache=cache
+    )
+    assert cached is not None
+    assert cached.choices[0].message == response.choices[0].message
+
+
+def test_cascades_stream_and_escalate_declined_tool_calls(tmp_path):
+    issue, other = backlog_issues(2)
+    topic = issue["description"].split("their ")[-1].rstrip(".")
+    kind = "feature_request" if issue["title"].startswith("Feature") else "bug_report"
+    openai = OpenAIStub()
+    cascade = ModelCascade()
+
+    matched = run_with_stubs(
+        LinearStub(),
+        lambda ctx: check_issue_match(ctx, conversation(kind, topic), other),
+        tmp_path,
+        openai=openai,
+        cascade=cascade,
+        streaming=True,
+    )
+    assert not matched
+    assert openai.streams == 2
+    # Declining comes without a confidence, so the first model's "no" is confirmed
+    assert [tier["escalated"] for tier in cascade.tiers] == [1, 0]
+    assert [tier["accepted"] for tier in cascade.tiers] == [0, 1]